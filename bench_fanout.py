@@ -0,0 +1,163 @@
+"""Micro-benchmark for broadcast fan-out.
+
+Compares the original broadcast path (encode the message again for every
+recipient and issue one send() per recipient per message) with the
+outbox path (encode once, queue the shared bytes, and flush each
+recipient once per burst with a single vectored write).
+
+Recipients are local socketpairs, so the numbers measure the server-side
+cost of fan-out rather than the network.
+
+With --compress it instead compares the outbox path with and without
+per-recipient zlib streams (the COMPRESS command), on chat-like messages
+drawn from a small vocabulary, and reports bytes on the wire against the
+CPU time compression adds.
+
+    python bench_fanout.py --recipients 1000 --messages 100 --rounds 5
+    python bench_fanout.py --compress --level 6
+"""
+
+import argparse
+import random
+import socket
+import time
+import zlib
+
+from chat_outbox import Outbox, IOV_MAX
+
+
+def drain(readers):
+    """Empty the receiving ends so the next round starts with free buffers"""
+    received = 0
+    for r in readers:
+        while True:
+            try:
+                data = r.recv(1 << 20)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            received += len(data)
+    return received
+
+
+def legacy_fanout(writers, messages):
+    syscalls = 0
+    for message in messages:
+        for sock in writers:
+            sock.send(message.encode('utf-8'))
+            syscalls += 1
+    return syscalls
+
+
+def outbox_fanout(writers, outboxes, messages):
+    for message in messages:
+        data = message.encode('utf-8')
+        for outbox in outboxes:
+            outbox.push(data)
+
+    syscalls = 0
+    for sock, outbox in zip(writers, outboxes):
+        syscalls += -(-len(outbox) // IOV_MAX)  # one vectored write per IOV_MAX chunks
+        while not outbox.write_to(sock):
+            pass
+    return syscalls
+
+
+def chat_messages(count, size, seed=1):
+    """Repetitive, chat-like lines of roughly size bytes of body"""
+    vocabulary = ("the deploy build is done on staging can you check logs again "
+                  "thanks looks good to me ship it after lunch ok sure tests are "
+                  "green now merging the fix for issue in review please").split()
+    rng = random.Random(seed)
+    messages = []
+    for i in range(count):
+        words = []
+        while sum(map(len, words)) + len(words) < size:
+            words.append(rng.choice(vocabulary))
+        messages.append(f"MSG user{rng.randrange(20)} {' '.join(words)}\n")
+    return messages
+
+
+def run(name, fanout, readers, rounds, deliveries):
+    elapsed = 0.0
+    syscalls = 0
+    received = 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        syscalls += fanout()
+        elapsed += time.perf_counter() - start
+        received += drain(readers)
+    rate = deliveries * rounds / elapsed
+    print(f"{name:<24} {elapsed / rounds * 1000:>10.2f} ms/burst {rate:>14,.0f} msgs/s "
+          f"{syscalls // rounds:>10,} syscalls/burst")
+    return rate, received
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--recipients', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=100, help="messages per burst")
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--size', type=int, default=64, help="message body length")
+    parser.add_argument('--compress', action='store_true',
+                        help="measure per-recipient zlib compression instead")
+    parser.add_argument('--level', type=int, default=6, help="zlib level for --compress")
+    args = parser.parse_args()
+
+    pairs = [socket.socketpair() for _ in range(args.recipients)]
+    writers = [w for w, _ in pairs]
+    readers = [r for _, r in pairs]
+    for sock in writers + readers:
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+    outboxes = [Outbox(high_water=1 << 30) for _ in writers]
+    deliveries = args.recipients * args.messages
+
+    if args.compress:
+        compare_compression(args, writers, readers, outboxes, deliveries)
+        for sock in writers + readers:
+            sock.close()
+        return
+
+    body = 'x' * args.size
+    messages = [f"MSG bench{i % 10} {body}\n" for i in range(args.messages)]
+
+    print(f"{args.recipients} recipients x {args.messages} messages per burst, "
+          f"{args.rounds} rounds")
+    before, received_before = run("per-recipient send", lambda: legacy_fanout(writers, messages),
+                                  readers, args.rounds, deliveries)
+    after, received_after = run("encode-once + sendmsg",
+                                lambda: outbox_fanout(writers, outboxes, messages),
+                                readers, args.rounds, deliveries)
+    assert received_before == received_after, "both paths must deliver the same bytes"
+    print(f"speedup: {after / before:.1f}x")
+
+    for sock in writers + readers:
+        sock.close()
+
+
+def compare_compression(args, writers, readers, outboxes, deliveries):
+    messages = chat_messages(args.messages, args.size)
+    print(f"{args.recipients} recipients x {args.messages} messages per burst, "
+          f"{args.rounds} rounds, zlib level {args.level}")
+    plain, plain_bytes = run("encode-once + sendmsg",
+                             lambda: outbox_fanout(writers, outboxes, messages),
+                             readers, args.rounds, deliveries)
+
+    deflating = [Outbox(high_water=1 << 30) for _ in writers]
+    for outbox in deflating:
+        outbox.enable_compression(zlib.compressobj(args.level))
+    compressed, wire_bytes = run("  + zlib per recipient",
+                                 lambda: outbox_fanout(writers, deflating, messages),
+                                 readers, args.rounds, deliveries)
+
+    deflated_in = sum(outbox.deflated_in for outbox in deflating)
+    assert deflated_in == plain_bytes, "both paths must carry the same messages"
+    print(f"bytes on the wire: {plain_bytes // args.rounds:,} -> {wire_bytes // args.rounds:,} "
+          f"per burst ({wire_bytes / plain_bytes:.1%}), "
+          f"{plain / compressed:.1f}x the CPU time")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""Binary framing mode for the AlgoKart chat protocol.
+
+A client switches to binary by sending the text command BINARY (before
+or after LOGIN) and reading the text reply "OK binary". The client must
+not send anything else until that reply arrives. From then on, traffic
+in both directions is frames:
+
+    u32 length (big-endian, of the payload) | u8 opcode | payload
+
+Client to server:
+    LOGIN     username
+    MSG       text
+    ROOM_MSG  u8 room length | room | text
+    DM        u32 user id | text; with user id 0: u32 0 | u8 name length | name | text
+    PING      (empty)
+    TEXT      any text protocol command line, e.g. "JOIN #dev" or "WHO"
+
+Server to client:
+    OK, PONG  (empty)
+    ERR       error text, e.g. "username-taken"
+    MSG       u32 sender id | text
+    ROOM_MSG  u32 sender id | u8 room length | room | text
+    DM        u32 sender id | text
+    NAME      u32 user id | username
+    TEXT      any other text protocol line (INFO, USER, ROOM, ...)
+
+User ids are interned per server process. A NAME frame binding an id to
+its username is sent before the first frame that uses the id on each
+connection. Under --slow-consumer drop-oldest that NAME frame can itself
+be dropped, so clients should tolerate an unknown id.
+
+Server output is produced as text protocol lines. from_text() turns an
+encoded line into frames and is cached on the line's bytes object, so a
+broadcast is converted once no matter how many binary clients get it.
+Text and binary clients therefore share rooms and the lobby unchanged.
+"""
+
+import functools
+import itertools
+import struct
+import threading
+
+HEADER = struct.Struct('!IB')
+USER_ID = struct.Struct('!I')
+MAX_FRAME = 8192  # payload bytes; longer frames cannot be resynchronized
+
+# Client -> server opcodes
+OP_LOGIN = 0x01
+OP_MSG = 0x02
+OP_ROOM_MSG = 0x03
+OP_DM = 0x04
+OP_PING = 0x05
+OP_TEXT = 0x06
+
+# Server -> client opcodes
+OUT_OK = 0x81
+OUT_ERR = 0x82
+OUT_TEXT = 0x83
+OUT_MSG = 0x84
+OUT_ROOM_MSG = 0x85
+OUT_DM = 0x86
+OUT_PONG = 0x87
+OUT_NAME = 0x88
+
+
+def frame(opcode, *parts):
+    """Encode one frame from payload parts (bytes-like)"""
+    payload = b''.join(parts)
+    return HEADER.pack(len(payload), opcode) + payload
+
+
+class UserIds:
+    """Usernames interned as small integers, never reused"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}  # {username bytes: id}
+        self._names = {}  # {id: username bytes}
+        self._name_frames = {}  # {id: encoded NAME frame}
+        self._next = itertools.count(1)
+
+    def intern(self, name):
+        uid = self._ids.get(name)
+        if uid is None:
+            with self._lock:
+                uid = self._ids.get(name)
+                if uid is None:
+                    uid = next(self._next)
+                    self._names[uid] = name
+                    self._name_frames[uid] = frame(OUT_NAME, USER_ID.pack(uid), name)
+                    self._ids[name] = uid
+        return uid
+
+    def name(self, uid):
+        """Username bytes for uid, or None"""
+        return self._names.get(uid)
+
+    def name_frame(self, uid):
+        return self._name_frames[uid]
+
+    def export(self):
+        """{id: username str}, for handing the table to another process"""
+        with self._lock:
+            return {uid: name.decode('utf-8') for uid, name in self._names.items()}
+
+    def restore(self, table):
+        """Adopt ids exported by another process; binary clients already know them"""
+        with self._lock:
+            for uid, name in table.items():
+                uid, name = int(uid), name.encode('utf-8')
+                self._names[uid] = name
+                self._name_frames[uid] = frame(OUT_NAME, USER_ID.pack(uid), name)
+                self._ids[name] = uid
+            self._next = itertools.count(max(self._names, default=0) + 1)
+
+
+user_ids = UserIds()
+
+
+def _is_username(name):
+    # Other lines (HELP text, for one) also start with "MSG "; senders that
+    # are not plain ASCII usernames are passed through as TEXT instead
+    return 0 < len(name) <= 20 and name.replace(b'_', b'').isalnum() and name.isascii()
+
+
+@functools.lru_cache(maxsize=1024)
+def from_text(data):
+    """Convert encoded text protocol lines to (frames, sender ids)"""
+    frames = []
+    ids = []
+    for line in data.split(b'\n'):
+        if not line:
+            continue
+        kind, _, rest = line.partition(b' ')
+        if kind == b'MSG' and rest.startswith(b'#'):
+            room, _, body = rest.partition(b' ')
+            sender, _, text = body.partition(b' ')
+            if _is_username(sender) and len(room) < 256:
+                uid = user_ids.intern(sender)
+                frames.append(frame(OUT_ROOM_MSG, USER_ID.pack(uid), bytes((len(room),)), room, text))
+                ids.append(uid)
+                continue
+        elif kind in (b'MSG', b'DM'):
+            sender, _, text = rest.partition(b' ')
+            if _is_username(sender):
+                uid = user_ids.intern(sender)
+                frames.append(frame(OUT_MSG if kind == b'MSG' else OUT_DM, USER_ID.pack(uid), text))
+                ids.append(uid)
+                continue
+        elif line == b'OK':
+            frames.append(frame(OUT_OK))
+            continue
+        elif line == b'PONG':
+            frames.append(frame(OUT_PONG))
+            continue
+        elif kind == b'ERR':
+            frames.append(frame(OUT_ERR, rest))
+            continue
+        frames.append(frame(OUT_TEXT, line))
+    return b''.join(frames), tuple(ids)
+
+
+class BinaryFramer:
+    """Incremental parser of length-prefixed frames.
+
+    feed() hands each complete frame's payload to a callback as a
+    memoryview over the receive buffer, so no copy or str is made unless
+    the callback makes one. The view is only valid during the callback.
+    """
+    __slots__ = ('buffer', 'max_frame')
+
+    def __init__(self, max_frame=MAX_FRAME):
+        self.buffer = bytearray()
+        self.max_frame = max_frame
+
+    def feed(self, data, handle):
+        """Call handle(opcode, payload) for every completed frame.
+
+        If handle returns True, no further frames are handled and the
+        bytes after that frame stay in the buffer. Returns False if a
+        frame exceeds max_frame: the stream cannot be resynchronized and
+        the connection should be closed.
+        """
+        buf = self.buffer
+        buf += data
+        pos = 0
+        size = len(buf)
+        view = memoryview(buf)
+        try:
+            while size - pos >= HEADER.size:
+                length, opcode = HEADER.unpack_from(buf, pos)
+                if length > self.max_frame:
+                    return False
+                start = pos + HEADER.size
+                end = start + length
+                if end > size:
+                    break
+                stop = handle(opcode, view[start:end])
+                pos = end
+                if stop:
+                    break
+        finally:
+            view.release()
+            del buf[:pos]
+        return True
+
+
+class BinaryCodec:
+    """Binary-mode state of one connection"""
+    __slots__ = ('framer', 'known_ids')
+
+    def __init__(self):
+        self.framer = BinaryFramer()
+        self.known_ids = set()  # ids this client has received a NAME frame for
+
+    def encode(self, data):
+        """Frames for encoded text lines, preceded by any NAME frames needed"""
+        frames, ids = from_text(data)
+        missing = [uid for uid in ids if uid not in self.known_ids]
+        if not missing:
+            return frames
+        self.known_ids.update(missing)
+        names = [user_ids.name_frame(uid) for uid in dict.fromkeys(missing)]
+        names.append(frames)
+        return b''.join(names)
+
+
+def is_valid_text(text):
+    """Whether text (bytes) may be relayed as a message body: non-empty
+    UTF-8 without line breaks, which would inject lines for text clients"""
+    if not text or b'\n' in text or b'\r' in text:
+        return False
+    if text.isascii():
+        return True
+    try:
+        text.decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return True
@@ -0,0 +1,136 @@
+"""Command dispatch shared by the AlgoKart chat servers.
+
+Each server keeps a CommandTable mapping verbs to handler functions, so
+dispatching a command is one dict lookup however many verbs exist, and
+adding one never lengthens the path to MSG. A handler is registered with
+the command decorator, together with its argument rule, the login state
+it needs and its HELP lines:
+
+    @commands.command('PING', help="PING - Check connection")
+    def ping(conn, arg):
+        conn.send(PONG)
+
+Handlers only use conn.username and conn.send(bytes). They run
+unchanged under any engine, and a plugin module can add commands to a
+server's table the same way. The table answers everything that does not
+reach a handler itself (unknown verbs, missing arguments, not logged
+in), and builds the HELP text once from the registered lines.
+
+Replies that never change are encoded once, here.
+"""
+
+WELCOME_BANNER = (
+    b"Welcome to AlgoKart Chat Server!\n"
+    b"Please login with: LOGIN <username>\n"
+)
+OK = b"OK\n"
+PONG = b"PONG\n"
+ERR_NOT_LOGGED_IN = b"ERR not-logged-in (use LOGIN <username> first)\n"
+ERR_UNKNOWN_COMMAND = b"ERR unknown-command (type HELP for commands)\n"
+ERR_USERNAME_TAKEN = b"ERR username-taken\n"
+ERR_USER_NOT_FOUND = b"ERR user-not-found\n"
+ERR_LINE_TOO_LONG = b"ERR line-too-long\n"
+ERR_INVALID_ENCODING = b"ERR invalid-encoding\n"
+ERR_NOT_AUTHORIZED = b"ERR not-authorized\n"
+ERR_USERNAME_TOO_SHORT = b"ERR username-too-short (min 3 chars)\n"
+ERR_USERNAME_TOO_LONG = b"ERR username-too-long (max 20 chars)\n"
+ERR_USERNAME_INVALID = b"ERR username-invalid (alphanumeric and underscore only)\n"
+ERR_DM_FORMAT = b"ERR invalid-format (use DM <username> <message>)\n"
+ERR_WHO_FORMAT = b"ERR invalid-format (use WHO [<offset> <limit> | <prefix>*])\n"
+
+# Argument rules
+NO_ARGS = 'none'  # the verb alone
+ARG_REQUIRED = 'required'
+ARG_OPTIONAL = 'optional'
+
+# Login states a command runs in
+LOGGED_OUT = 'logged-out'  # LOGIN
+LOGGED_IN = 'logged-in'
+EITHER = 'either'
+
+
+def validate_username(name):
+    """None if name may be used as a username, otherwise the ERR line"""
+    if len(name) < 3:
+        return ERR_USERNAME_TOO_SHORT
+    if len(name) > 20:
+        return ERR_USERNAME_TOO_LONG
+    if not name.replace('_', '').isalnum():
+        return ERR_USERNAME_INVALID
+    return None
+
+
+class Command:
+    __slots__ = ('name', 'handler', 'args', 'login', 'help')
+
+    def __init__(self, name, handler, args, login, help):
+        self.name = name
+        self.handler = handler  # handler(conn, arg), arg being the rest of the line
+        self.args = args
+        self.login = login
+        self.help = help  # HELP lines, or '' to leave the command out
+
+    def accepts(self, conn, arg):
+        if self.args is ARG_REQUIRED and not arg:
+            return False
+        if self.args is NO_ARGS and arg:
+            return False
+        return self.login is not LOGGED_OUT or not conn.username
+
+
+class CommandTable:
+    """Verbs and their handlers for one server"""
+
+    def __init__(self):
+        self.commands = {}  # {verb: Command}
+        self.guard = None  # guard(conn, verb) -> True to stop a logged-in command (rate limits)
+        self._help = None
+
+    def command(self, name, args=ARG_OPTIONAL, login=LOGGED_IN, help=''):
+        """Decorator registering a handler for verb name (replacing any other)"""
+        def register(handler):
+            self.commands[name.upper()] = Command(name.upper(), handler, args, login,
+                                                  help.strip('\n'))
+            self._help = None
+            return handler
+        return register
+
+    def help_text(self):
+        """The encoded HELP reply, built once from the registered commands"""
+        if self._help is None:
+            lines = [entry.help for entry in self.commands.values() if entry.help]
+            self._help = ("Available commands:\n" + "\n".join(lines) + "\n").encode('utf-8')
+        return self._help
+
+    def dispatch(self, conn, verb, arg):
+        """Run the command verb (upper case); arg is the rest of the line.
+
+        Commands for logged-in users, and anything unknown or malformed,
+        need a login and pass the guard before a handler runs or the
+        client is told the command is unknown.
+        """
+        entry = self.commands.get(verb)
+        if entry is not None and not entry.accepts(conn, arg):
+            entry = None
+        if entry is None or entry.login is LOGGED_IN:
+            if not conn.username:
+                conn.send(ERR_NOT_LOGGED_IN)
+                return
+            if self.guard is not None and self.guard(conn, verb):
+                return
+            if entry is None:
+                conn.send(ERR_UNKNOWN_COMMAND)
+                return
+        entry.handler(conn, arg)
+
+
+def add_standard_commands(table):
+    """Register PING and HELP, which every server answers the same way"""
+
+    @table.command('PING', help="PING - Check connection")
+    def ping(conn, arg):
+        conn.send(PONG)
+
+    @table.command('HELP', help="HELP - Show this help")
+    def show_help(conn, arg):
+        conn.send(table.help_text())
@@ -0,0 +1,459 @@
+"""Federation of independent AlgoKart chat server nodes.
+
+Nodes behind a load balancer link up over TCP so that their users see
+each other. Every node listens on its own peer address (--federation)
+and dials every other node (--peers), and all nodes must be given the
+same set of addresses. A connection carries traffic in one direction
+only, from the dialing node to the listening one, so a pair of nodes uses
+two connections and never has to resolve which one to keep.
+
+Frames are single lines, as on the worker bus (see chat_workers):
+"B <line>" (broadcast), "R <room> <line>" (room message), "D <user>
+<line>" (direct message), "J <user>" / "L <user>" (presence) and
+"M <room> <user>" / "P <room> <user>" (room membership). A connection
+starts with "HELLO <address>", followed by a J and M frame for every user
+and room membership on the sending node, so a node that restarts or
+reconnects catches up at once.
+
+A broadcast crosses each link once, however many users the receiving
+node has. DMs go straight to the node the target is logged in on.
+
+Nothing here waits for a peer on the caller's thread. Outgoing frames
+are queued on the link and written by its dialer thread. A peer that
+falls PEER_HIGH_WATER bytes behind is dropped, and it gets a fresh
+snapshot when the link comes back.
+
+Usernames are claimed cluster-wide. Each username has an owner node,
+chosen by hashing the name over the sorted list of node addresses. A
+login asks the owner with "C <id> <user>", and the owner answers "A <id>
+1" or "A <id> 0". The answer is posted to the server like any other
+delivery. A login that gives up waiting sends "U <user>" after its C
+frame, so an owner that granted the claim late drops it again. When a
+node's link goes away, the owner forgets the claims held by that node.
+Presence and claims are rebuilt from the J frames sent when the link
+comes back, so an owner that restarted learns them again.
+
+Federation implements the same interface as WorkerBus, so the server
+treats the two modes alike.
+"""
+
+import itertools
+import socket
+import threading
+import time
+import zlib
+
+from chat_framing import LineFramer, LINE_TOO_LONG
+from chat_outbox import Outbox, DISCONNECT
+
+PEER_MAX_LINE = 1024 * 1024
+PEER_HIGH_WATER = 64 * 1024 * 1024  # bytes queued for a peer before it is dropped
+RECV_SIZE = 65536
+CLAIM_TIMEOUT = 2.0  # seconds to wait for a username's owner node
+SEND_TIMEOUT = 5.0  # a peer that accepts nothing for this long is dropped
+RETRY_INTERVAL = 1.0  # seconds between attempts to reach a peer that is down
+
+
+def parse_address(text):
+    """'host:port' -> (host, port)"""
+    host, _, port = text.strip().rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class _PeerLink:
+    """Outgoing connection to one peer, kept up by its own dialer thread.
+
+    send() only queues; the dialer thread writes the queue out. Up to
+    PEER_HIGH_WATER bytes can be queued while the previous write is still
+    in progress.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.sock = None
+        self.outbox = Outbox(PEER_HIGH_WATER, DISCONNECT)
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)  # output queued or link dropped
+
+    def send(self, frame):
+        """Queue frame if the link is up; returns False if it is not"""
+        with self.lock:
+            if self.sock is None:
+                return False
+            if not self.outbox.push(frame):
+                self._drop()  # too far behind: start over with a snapshot
+                return False
+            self.ready.notify()
+            return True
+
+    def publish(self, sock, first):
+        """Make sock the link, with first queued ahead of every later frame"""
+        with self.lock:
+            self.outbox.push(first)
+            self.sock = sock
+            self.ready.notify()
+
+    def take(self, sock):
+        """Wait for output; returns an Outbox of it, or None once sock is dropped"""
+        with self.lock:
+            while self.sock is sock and not self.outbox:
+                self.ready.wait()
+            if self.sock is not sock:
+                return None
+            outbox, self.outbox = self.outbox, Outbox(PEER_HIGH_WATER, DISCONNECT)
+            return outbox
+
+    def drop(self, sock):
+        with self.lock:
+            if self.sock is sock:
+                self._drop()
+
+    def _drop(self):
+        # Wakes the writer and watcher; the dialer thread closes the socket
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock = None
+        self.outbox.clear()
+        self.ready.notify_all()
+
+
+class Federation:
+    """This node's side of the peer mesh"""
+
+    def __init__(self, address, peers):
+        self.address = address  # 'host:port' peers know this node by
+        self.nodes = sorted(set(peers) | {address})  # owner hashing order
+        self.remote_names = frozenset()  # users logged in on other nodes
+        self.remote_rooms = {}  # {room: frozenset of remote members}, replaced on change
+        self.links = {peer: _PeerLink(peer) for peer in peers if peer != address}
+        self._lock = threading.Lock()
+        self._local_names = set()  # users this node has claimed
+        self._local_rooms = {}  # {room: set of local users}, replayed to new links
+        self._names = {}  # {node: set of its users}
+        self._rooms = {}  # {node: {room: set of its users}}
+        self._locations = {}  # {user: node}
+        self._claims = {}  # {user: node} for the users this node owns
+        self._replies = {}  # {claim id: (deadline, user, done)}, oldest first
+        self._replies_ready = threading.Condition()
+        self._claim_ids = itertools.count(1)
+
+    def start(self, post, on_broadcast, on_direct, on_room, on_presence=None):
+        """Listen for peers and start dialing them; callbacks as WorkerBus.start"""
+        self._post = post
+        self._on_broadcast = on_broadcast
+        self._on_direct = on_direct
+        self._on_room = on_room
+        self._on_presence = on_presence
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        host, port = parse_address(self.address)
+        listener.bind((host, port))
+        listener.listen(len(self.links) + 8)
+        threading.Thread(target=self._accept, args=(listener,), name='federation-accept',
+                         daemon=True).start()
+        threading.Thread(target=self._expire_claims, name='federation-claims',
+                         daemon=True).start()
+        for link in self.links.values():
+            threading.Thread(target=self._dial, args=(link,), name=f'federation-{link.address}',
+                             daemon=True).start()
+
+    # Outgoing traffic
+
+    def _send_all(self, frame):
+        for link in self.links.values():
+            link.send(frame)
+
+    def publish(self, line, room=None):
+        """Deliver an encoded broadcast (or room) line to every other node"""
+        if room is None:
+            self._send_all(b"B " + line)
+        else:
+            self._send_all(b"R " + room.encode('utf-8') + b" " + line)
+
+    def announce_join(self, room, username):
+        with self._lock:
+            self._local_rooms.setdefault(room, set()).add(username)
+        self._send_all(f"M {room} {username}\n".encode('utf-8'))
+
+    def announce_part(self, room, username):
+        with self._lock:
+            members = self._local_rooms.get(room)
+            if members is not None:
+                members.discard(username)
+                if not members:
+                    del self._local_rooms[room]
+        self._send_all(f"P {room} {username}\n".encode('utf-8'))
+
+    def route_dm(self, username, line):
+        """Forward an encoded DM line to the node holding username"""
+        node = self._locations.get(username)
+        if node is not None:
+            self.links[node].send(b"D " + username.encode('utf-8') + b" " + line)
+
+    def release(self, username):
+        with self._lock:
+            self._local_names.discard(username)
+            for members in self._local_rooms.values():
+                members.discard(username)
+            self._local_rooms = {room: members for room, members in self._local_rooms.items()
+                                 if members}
+            if self._claims.get(username) == self.address:
+                del self._claims[username]
+        self._send_all(b"L " + username.encode('utf-8') + b"\n")
+
+    def owner(self, username):
+        return self.nodes[zlib.crc32(username.encode('utf-8')) % len(self.nodes)]
+
+    def claim(self, username, done):
+        """Reserve username cluster-wide, without waiting for the owner.
+
+        done(granted) is posted with True if the name is ours now, False
+        if it is taken, or None if its owner node could not be asked.
+        """
+        owner = self.owner(username)
+        if owner == self.address:
+            self._claimed(username, self._grant(username, self.address), done)
+            return
+        claim_id = next(self._claim_ids)
+        with self._replies_ready:
+            self._replies[claim_id] = (time.monotonic() + CLAIM_TIMEOUT, username, done)
+            self._replies_ready.notify()
+        if not self.links[owner].send(f"C {claim_id} {username}\n".encode('utf-8')):
+            self._answer(claim_id, None)
+
+    def _answer(self, claim_id, granted):
+        """Complete a pending claim; returns its username, or None if it
+        was already answered"""
+        with self._replies_ready:
+            waiting = self._replies.pop(claim_id, None)
+        if waiting is None:
+            return None
+        _, username, done = waiting
+        self._claimed(username, granted, done)
+        return username
+
+    def _claimed(self, username, granted, done):
+        if granted:
+            with self._lock:
+                self._local_names.add(username)
+            self._send_all(b"J " + username.encode('utf-8') + b"\n")
+        self._post(done, granted)
+
+    def _expire_claims(self):
+        """Answer None to claims their owner has not answered in time"""
+        while True:
+            with self._replies_ready:
+                while not self._replies:
+                    self._replies_ready.wait()
+                claim_id, (deadline, _, _) = next(iter(self._replies.items()))
+                wait = deadline - time.monotonic()
+                if wait > 0:
+                    self._replies_ready.wait(wait)
+                    continue
+            username = self._answer(claim_id, None)
+            if username is not None:
+                # The owner may still grant it; U follows C on the same link
+                self.links[self.owner(username)].send(b"U " + username.encode('utf-8') + b"\n")
+
+    def _grant(self, username, node):
+        with self._lock:
+            holder = self._claims.get(username)
+            if holder is not None and holder != node:
+                return False
+            if node == self.address and username in self._local_names:
+                return False
+            if node != self.address and self._locations.get(username, node) != node:
+                return False  # still logged in elsewhere, from before a restart
+            self._claims[username] = node
+            return True
+
+    # Links
+
+    def _dial(self, link):
+        host, port = parse_address(link.address)
+        while True:
+            try:
+                sock = socket.create_connection((host, port), timeout=SEND_TIMEOUT)
+            except OSError:
+                time.sleep(RETRY_INTERVAL)
+                continue
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # HELLO and the snapshot must be the first frames on the link:
+            # they are queued as the link is published, and holding the
+            # state lock means a login or join missing from the snapshot is
+            # sent over the link afterwards
+            with self._lock:
+                frames = [f"HELLO {self.address}\n"]
+                frames.extend(f"J {name}\n" for name in self._local_names)
+                frames.extend(f"M {room} {name}\n" for room, members in self._local_rooms.items()
+                              for name in members)
+                link.publish(sock, "".join(frames).encode('utf-8'))
+            watcher = threading.Thread(target=self._watch, args=(link, sock),
+                                       name=f'federation-watch-{link.address}', daemon=True)
+            watcher.start()
+            self._write(link, sock)
+            watcher.join()
+            sock.close()
+
+    def _write(self, link, sock):
+        """Write the link's queued frames until it is dropped.
+
+        A peer that accepts nothing for SEND_TIMEOUT is dropped here, on
+        the dialer thread, instead of stalling whoever sent the frame.
+        """
+        while True:
+            outbox = link.take(sock)
+            if outbox is None:
+                return
+            try:
+                drained = outbox.write_to(sock)
+            except OSError:
+                drained = False
+            if not drained:
+                link.drop(sock)
+                return
+
+    def _watch(self, link, sock):
+        """Return once the peer has closed or reset the link.
+
+        Nothing is ever received on an outgoing link, so a read that ends
+        means the peer went away. Without this, the first frames sent
+        after a peer restarts would vanish into the dead connection.
+        """
+        while link.sock is sock:
+            try:
+                data = sock.recv(1)
+            except socket.timeout:
+                continue
+            except OSError:
+                data = b""
+            if not data:
+                break
+        link.drop(sock)
+
+    def _accept(self, listener):
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._read, args=(sock,), name='federation-peer',
+                             daemon=True).start()
+
+    def _read(self, sock):
+        framer = LineFramer(PEER_MAX_LINE)
+        node = None
+        try:
+            while True:
+                try:
+                    chunk = sock.recv(RECV_SIZE)
+                except OSError:
+                    chunk = b""
+                if not chunk:
+                    return
+                for frame in framer.feed(chunk):
+                    if frame is LINE_TOO_LONG:
+                        continue
+                    if node is None:
+                        kind, _, rest = frame.partition(b" ")
+                        node = rest.decode('utf-8')
+                        if kind != b"HELLO" or node not in self.links:
+                            return  # not one of our peers
+                        continue
+                    self._dispatch(node, frame)
+        finally:
+            sock.close()
+            if node in self.links:
+                self._forget(node)
+
+    def _forget(self, node):
+        """A node's link went away: its users and claims are gone"""
+        with self._lock:
+            names = self._names.pop(node, set())
+            self._rooms.pop(node, None)
+            for name in names:
+                if self._locations.get(name) == node:
+                    del self._locations[name]
+            self._claims = {name: holder for name, holder in self._claims.items()
+                            if holder != node}
+            self._publish_state()
+        if self._on_presence is not None:
+            for name in names:
+                self._post(self._on_presence, name, False)
+
+    def _publish_state(self):
+        # Readers take these without a lock, so they are replaced, never mutated
+        self.remote_names = frozenset(self._locations)
+        remote_rooms = {}
+        for rooms in self._rooms.values():
+            for room, members in rooms.items():
+                remote_rooms[room] = remote_rooms.get(room, frozenset()) | members
+        self.remote_rooms = remote_rooms
+
+    def _dispatch(self, node, frame):
+        kind, _, rest = frame.partition(b" ")
+        if kind == b"B":
+            self._post(self._on_broadcast, rest + b"\n")
+        elif kind == b"R":
+            room, _, line = rest.partition(b" ")
+            self._post(self._on_room, room.decode('utf-8'), line + b"\n")
+        elif kind == b"D":
+            target, _, line = rest.partition(b" ")
+            self._post(self._on_direct, target.decode('utf-8'), line + b"\n")
+        elif kind == b"C":
+            claim_id, _, name = rest.partition(b" ")
+            granted = self._grant(name.decode('utf-8'), node)
+            link = self.links[node]
+            link.send(b"A " + claim_id + (b" 1\n" if granted else b" 0\n"))
+        elif kind == b"A":
+            claim_id, _, answer = rest.partition(b" ")
+            self._answer(int(claim_id), answer == b"1")
+        elif kind == b"U":
+            name = rest.decode('utf-8')
+            with self._lock:
+                if self._claims.get(name) == node and name not in self._names.get(node, ()):
+                    del self._claims[name]
+        elif kind in (b"J", b"L"):
+            self._presence(node, rest.decode('utf-8'), kind == b"J")
+        elif kind in (b"M", b"P"):
+            room, _, name = rest.decode('utf-8').partition(" ")
+            with self._lock:
+                rooms = self._rooms.setdefault(node, {})
+                members = rooms.get(room, frozenset())
+                members = members | {name} if kind == b"M" else members - {name}
+                if members:
+                    rooms[room] = members
+                else:
+                    rooms.pop(room, None)
+                self._publish_state()
+
+    def _presence(self, node, name, joined):
+        with self._lock:
+            names = self._names.setdefault(node, set())
+            if joined:
+                if name in names:
+                    return  # replayed after a reconnect
+                names.add(name)
+                self._locations[name] = node
+                if self.owner(name) == self.address:
+                    self._claims.setdefault(name, node)
+            else:
+                if name not in names:
+                    return
+                names.discard(name)
+                if self._locations.get(name) == node:
+                    del self._locations[name]
+                if self._claims.get(name) == node:
+                    del self._claims[name]
+                rooms = self._rooms.get(node, {})
+                for room in [room for room, members in rooms.items() if name in members]:
+                    members = rooms[room] - {name}
+                    if members:
+                        rooms[room] = members
+                    else:
+                        del rooms[room]
+            self._publish_state()
+        if self._on_presence is not None:
+            self._post(self._on_presence, name, joined)
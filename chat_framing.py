@@ -0,0 +1,88 @@
+"""Line framing for the AlgoKart chat protocol.
+
+TCP delivers a byte stream, not commands: one recv() may hold several
+pipelined lines, or only part of one. LineFramer accumulates the stream
+per connection and hands back complete lines, so both chat servers parse
+exactly one command per line no matter how the bytes were segmented.
+"""
+
+MAX_LINE_LENGTH = 4096  # bytes, excluding the trailing newline
+
+# Placeholder returned in place of a line that exceeded the length limit
+LINE_TOO_LONG = None
+
+
+class LineFramer:
+    """Incremental splitter of a byte stream into newline-terminated lines.
+
+    Bytes that were already searched for a newline are never scanned again,
+    and the pending buffer never grows beyond max_line_length: an overlong
+    line is discarded up to its terminating newline and reported as
+    LINE_TOO_LONG so the caller can answer with an error.
+    """
+    __slots__ = ('buffer', 'max_line_length', 'discarding')
+
+    def __init__(self, max_line_length=MAX_LINE_LENGTH):
+        self.buffer = bytearray()
+        self.max_line_length = max_line_length
+        self.discarding = False
+
+    def feed(self, data):
+        """Append received bytes and return the list of completed lines.
+
+        Lines are returned as bytes without the trailing "\\n" (or "\\r\\n").
+        """
+        return list(self.lines(data))
+
+    def lines(self, data):
+        """Append received bytes and yield the completed lines one by one.
+
+        A caller that stops early (closing the generator) leaves every
+        byte after the last line it took in the buffer, exactly as
+        received. That is how a command switching the connection to
+        another framing hands the rest of the input over.
+        """
+        buf = self.buffer
+        # Everything already buffered was scanned on a previous call
+        pos = data.find(b'\n')
+        if pos == -1:
+            self._append_partial(data)
+            return
+
+        buf += data
+        pos += len(buf) - len(data)
+        start = 0
+        limit = self.max_line_length
+        try:
+            while pos != -1:
+                end = pos
+                if end > start and buf[end - 1] == 13:  # tolerate CRLF clients
+                    end -= 1
+                if self.discarding or end - start > limit:
+                    self.discarding = False
+                    line = LINE_TOO_LONG
+                else:
+                    line = bytes(buf[start:end])
+                start = pos + 1
+                yield line
+                pos = buf.find(b'\n', start)
+        finally:
+            del buf[:start]
+        if len(buf) > limit:
+            self._discard()
+
+    def _append_partial(self, data):
+        if self.discarding:
+            return
+        self.buffer += data
+        if len(self.buffer) > self.max_line_length:
+            self._discard()
+
+    def _discard(self):
+        # Drop the oversized prefix and skip input until the next newline
+        self.buffer.clear()
+        self.discarding = True
+
+    def pending(self):
+        """Number of buffered bytes still waiting for a newline"""
+        return len(self.buffer)
@@ -0,0 +1,164 @@
+"""Hot upgrade: hand a running server's sockets to a new process.
+
+The old process listens on a Unix socket (--handoff-path). A new process
+started with --takeover connects to it, and the old one sends over
+- the listening socket, so connections keep queueing in the kernel and
+  none is refused while the processes swap, and
+- every client socket, together with that session's state: username,
+  rooms, protocol mode, unparsed input and output not yet written,
+all as file descriptors passed with SCM_RIGHTS. Clients stay connected
+and logged in, and never notice the restart.
+
+Each message on the Unix socket is a u32 length and a JSON object; the
+file descriptors it carries arrive with its first bytes. The sequence is
+one "listener" message, "sessions" messages with up to MAX_FDS sockets
+each, and "done". The new process answers "ok". Only then does the old
+process stop serving: it closes its files and the connection, and exits
+without touching the sockets. Until the "ok" arrives the old process is
+still in charge, and it carries on serving if anything goes wrong.
+"""
+
+import array
+import base64
+import json
+import os
+import socket
+import struct
+
+LENGTH = struct.Struct('!I')
+MAX_FDS = 200  # sockets per message; Linux allows 253 per sendmsg()
+TIMEOUT = 30.0  # seconds either side waits for the other
+
+
+def supported():
+    return hasattr(socket, 'AF_UNIX') and hasattr(socket.socket, 'sendmsg')
+
+
+def encode_bytes(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def decode_bytes(text):
+    return base64.b64decode(text)
+
+
+def listen(path):
+    """Unix socket the next process connects to, replacing a stale one"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(path)
+        listener.listen(1)
+    except OSError:
+        listener.close()
+        raise
+    return listener
+
+
+def send_message(sock, message, fds=()):
+    """Send message (a JSON-able dict) with fds attached to its first bytes"""
+    body = json.dumps(message, separators=(',', ':')).encode('utf-8')
+    data = LENGTH.pack(len(body)) + body
+    ancillary = []
+    if fds:
+        ancillary.append((socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds)))
+    sent = sock.sendmsg([data], ancillary)
+    if sent < len(data):
+        sock.sendall(memoryview(data)[sent:])
+
+
+def recv_message(sock):
+    """(message, [fds]) for the next message, or (None, []) at EOF"""
+    fds = array.array('i')
+    data, ancillary, flags, _ = sock.recvmsg(LENGTH.size,
+                                             socket.CMSG_SPACE(MAX_FDS * fds.itemsize))
+    for level, kind, payload in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+    if flags & socket.MSG_CTRUNC:
+        for fd in fds:
+            os.close(fd)
+        raise OSError("handoff: file descriptors were truncated")
+    if not data:
+        return None, []
+    data += _recv_exactly(sock, LENGTH.size - len(data))
+    body = _recv_exactly(sock, LENGTH.unpack(data)[0])
+    return json.loads(body), list(fds)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise OSError("handoff: connection closed mid-message")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def hand_off(sock, listener, state, sessions):
+    """Send the listening socket, shared state and [(session, socket)].
+
+    Returns once the new process has confirmed it holds everything;
+    raises OSError (or ValueError on a garbled reply) otherwise.
+    """
+    sock.settimeout(TIMEOUT)
+    send_message(sock, dict(state, kind='listener'), [listener.fileno()])
+    for start in range(0, len(sessions), MAX_FDS):
+        batch = sessions[start:start + MAX_FDS]
+        send_message(sock, {'kind': 'sessions', 'sessions': [session for session, _ in batch]},
+                     [client.fileno() for _, client in batch])
+    send_message(sock, {'kind': 'done'})
+    reply, _ = recv_message(sock)
+    if reply is None or reply.get('kind') != 'ok':
+        raise OSError("handoff: the new process did not confirm")
+
+
+def take_over(path):
+    """Receive a running server's sockets from path.
+
+    Returns (listening socket, state, [(session, socket)]) after the old
+    process has let go of everything, including its files.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(TIMEOUT)
+    received = []
+    try:
+        sock.connect(path)
+        message, fds = recv_message(sock)
+        if message is None or message.get('kind') != 'listener' or len(fds) != 1:
+            raise OSError("handoff: expected the listening socket")
+        received.extend(fds)
+        state = message
+        sessions = []
+        while True:
+            message, fds = recv_message(sock)
+            received.extend(fds)
+            if message is None:
+                raise OSError("handoff: connection closed before the end")
+            if message.get('kind') == 'done':
+                break
+            if message.get('kind') != 'sessions' or len(fds) != len(message['sessions']):
+                raise OSError("handoff: session sockets missing")
+            sessions.extend(zip(message['sessions'], fds))
+        send_message(sock, {'kind': 'ok'})
+    except (OSError, ValueError):
+        sock.close()
+        for fd in received:
+            os.close(fd)
+        raise
+    # Everything is ours now. The old process closes its history and
+    # mailbox files, then hangs up
+    try:
+        while sock.recv(4096):
+            pass
+    except OSError:
+        pass
+    finally:
+        sock.close()
+    listener = socket.socket(fileno=received[0])
+    return listener, state, [(session, socket.socket(fileno=fd)) for session, fd in sessions]
@@ -0,0 +1,174 @@
+"""Message history for the AlgoKart chat server.
+
+HistoryRing keeps the most recent broadcast lines in a fixed number of
+slots, as the encoded bytes that were sent, with no per-message objects
+beyond the bytes themselves. It can be backed by a SegmentLog: an
+append-only log stored in fixed-size memory-mapped segment files, so
+history survives restarts and can be read back without loading it.
+
+Each log record is the line's bytes followed by their length as a
+4-byte trailer. Reading the last N messages therefore walks backwards
+from the write position, one record at a time: O(N), however large the
+log is.
+"""
+
+import glob
+import mmap
+import os
+import struct
+import threading
+
+DEFAULT_CAPACITY = 100
+DEFAULT_SEGMENT_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_SEGMENTS = 16
+
+_MAGIC = b'AKCHLOG1'
+_HEADER = struct.Struct('<8sQ')  # magic, end of the last complete record
+_TRAILER = struct.Struct('<I')  # record length
+
+
+class HistoryRing:
+    """Fixed-capacity ring buffer of encoded broadcast lines"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, backing=None):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.next = 0  # slot the next line goes into
+        self.count = 0
+        self.backing = backing
+        self._lock = threading.Lock()
+        if backing is not None:
+            for line in backing.last(capacity):
+                self._store(line)
+
+    def __len__(self):
+        return self.count
+
+    def _store(self, line):
+        self.slots[self.next] = line
+        self.next = (self.next + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def append(self, line):
+        with self._lock:
+            self._store(line)
+            if self.backing is not None:
+                self.backing.append(line)
+
+    def last(self, n):
+        """Up to n most recent lines, oldest first.
+
+        Requests deeper than the ring are served from the backing log.
+        """
+        with self._lock:
+            if n > self.count and self.backing is not None:
+                return self.backing.last(n)
+            n = min(n, self.count)
+            start = (self.next - n) % self.capacity
+            if start + n <= self.capacity:
+                return self.slots[start:start + n]
+            return self.slots[start:] + self.slots[:self.next]
+
+    def close(self):
+        if self.backing is not None:
+            with self._lock:
+                self.backing.close()
+
+
+class SegmentLog:
+    """Append-only message log spread over memory-mapped segment files.
+
+    Only the newest segment is kept mapped for writing; older segments
+    are mapped read-only on demand. Once more than max_segments exist
+    the oldest is deleted.
+    """
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE,
+                 max_segments=DEFAULT_MAX_SEGMENTS):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(glob.glob(os.path.join(directory, 'history-*.log')))
+        self._file = None
+        self._map = None
+        self.end = 0
+        if self.segments:
+            self._open(self.segments[-1])
+        else:
+            self._roll()
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, f'history-{number:06d}.log')
+
+    def _open(self, path):
+        self._file = open(path, 'r+b')
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), size)
+        magic, self.end = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC or not _HEADER.size <= self.end <= size:
+            raise ValueError(f"{path} is not a chat history segment")
+
+    def _roll(self):
+        """Start a new segment file and make it the write target"""
+        self._close_current()
+        number = 1
+        if self.segments:
+            number = int(os.path.basename(self.segments[-1])[8:14]) + 1
+        path = self._segment_path(number)
+        with open(path, 'wb') as f:
+            f.truncate(self.segment_size)
+            f.write(_HEADER.pack(_MAGIC, _HEADER.size))
+        self.segments.append(path)
+        while len(self.segments) > self.max_segments:
+            os.remove(self.segments.pop(0))
+        self._open(path)
+
+    def append(self, line):
+        size = len(line) + _TRAILER.size
+        if size > self.segment_size - _HEADER.size:
+            return  # cannot fit in any segment
+        if self.end + size > len(self._map):
+            self._roll()
+        end = self.end
+        self._map[end:end + len(line)] = line
+        _TRAILER.pack_into(self._map, end + len(line), len(line))
+        self.end = end + size
+        # Publish the record only once it is completely written
+        _HEADER.pack_into(self._map, 0, _MAGIC, self.end)
+
+    def last(self, n):
+        """Up to n most recent records, oldest first, reading backwards"""
+        records = []
+        for path in reversed(self.segments):
+            if len(records) >= n:
+                break
+            if path == self.segments[-1]:
+                self._read_back(self._map, self.end, n, records)
+                continue
+            with open(path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as segment:
+                    end = _HEADER.unpack_from(segment, 0)[1]
+                    self._read_back(segment, end, n, records)
+        records.reverse()
+        return records
+
+    @staticmethod
+    def _read_back(segment, end, n, records):
+        while end > _HEADER.size and len(records) < n:
+            length = _TRAILER.unpack_from(segment, end - _TRAILER.size)[0]
+            start = end - _TRAILER.size - length
+            records.append(segment[start:end - _TRAILER.size])
+            end = start
+
+    def _close_current(self):
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._file.close()
+            self._map = None
+            self._file = None
+
+    def close(self):
+        self._close_current()
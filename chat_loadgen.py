@@ -0,0 +1,288 @@
+"""Headless load generator for the AlgoKart chat server.
+
+Opens many client connections, logs each one in, then drives a mix of
+MSG, DM, WHO and PING commands at a target total rate for a fixed time.
+MSG and DM bodies carry the sender's send time, so every delivery a
+client receives gives an end-to-end latency sample (sender to receiver).
+PING and WHO are timed from request to reply.
+
+Works against either server script on localhost, as it only speaks the
+text protocol:
+
+    python chat_server_enhanced.py 4000
+    python chat_loadgen.py --clients 2000 --rate 500 --duration 30 --json results.json
+
+Results are printed as a summary and, with --json, written as one JSON
+object (use --json - for stdout) so runs can be compared across versions.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import sys
+import time
+
+from chat_server_enhanced import raise_fd_limit
+
+DEFAULT_MIX = 'msg=70,dm=10,who=5,ping=15'
+KINDS = ('msg', 'dm', 'who', 'ping')
+PERCENTILES = (50, 90, 99, 99.9)
+TICK = 0.01  # seconds between batches of commands
+STAMP_TAG = 'lg'  # marks bodies carrying a send timestamp
+
+
+class LoadClient:
+    __slots__ = ('name', 'reader', 'writer', 'pings', 'whos')
+
+    def __init__(self, name, reader, writer):
+        self.name = name
+        self.reader = reader
+        self.writer = writer
+        self.pings = collections.deque()  # send times of unanswered PINGs
+        self.whos = collections.deque()  # send times of unanswered WHOs
+
+
+class Results:
+    def __init__(self):
+        self.connected = 0
+        self.connect_failures = 0
+        self.login_failures = 0
+        self.sent = collections.Counter()
+        self.errors = collections.Counter()  # ERR replies by code
+        self.received_lines = 0
+        self.received_bytes = 0
+        self.latency = {kind: [] for kind in KINDS}  # seconds
+
+
+def parse_mix(text):
+    """'msg=70,dm=10' -> ([kinds], [weights])"""
+    kinds, weights = [], []
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip().lower()
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"unknown command '{kind}' in mix")
+        kinds.append(kind)
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+
+def summarize(samples):
+    """Latency percentiles in milliseconds"""
+    if not samples:
+        return {'count': 0}
+    samples.sort()
+    summary = {'count': len(samples)}
+    for p in PERCENTILES:
+        index = min(len(samples) - 1, int(len(samples) * p / 100))
+        summary[f'p{p:g}'] = round(samples[index] * 1000, 3)
+    summary['max'] = round(samples[-1] * 1000, 3)
+    return summary
+
+
+async def connect(args, name, results):
+    """Open a connection and log in; returns a LoadClient or None"""
+    try:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+    except OSError:
+        results.connect_failures += 1
+        return None
+    writer.write(f"LOGIN {name}\n".encode('utf-8'))
+    try:
+        while True:
+            line = await asyncio.wait_for(reader.readline(), args.timeout)
+            if not line:
+                raise ConnectionError
+            if line.startswith(b"OK"):
+                results.connected += 1
+                return LoadClient(name, reader, writer)
+            if line.startswith(b"ERR"):
+                break
+    except (OSError, ConnectionError, asyncio.TimeoutError):
+        pass
+    results.login_failures += 1
+    writer.close()
+    return None
+
+
+async def read_replies(client, results):
+    """Consume everything the server sends to client, recording latencies"""
+    latency = results.latency
+    while True:
+        try:
+            line = await client.reader.readline()
+        except OSError:
+            return
+        if not line:
+            return
+        now = time.perf_counter()
+        results.received_lines += 1
+        results.received_bytes += len(line)
+        parts = line.split(b' ', 4)
+        kind = parts[0]
+        if kind in (b"MSG", b"DM") and len(parts) >= 4 and parts[2] == STAMP_TAG.encode():
+            try:
+                latency[kind.decode().lower()].append(now - float(parts[3]))
+            except ValueError:
+                pass
+        elif kind == b"PONG\n" and client.pings:
+            latency['ping'].append(now - client.pings.popleft())
+        elif kind == b"INFO" and line.endswith(b" users online\n") and client.whos:
+            latency['who'].append(now - client.whos.popleft())
+        elif kind == b"ERR":
+            results.errors[parts[1].strip().decode('utf-8', 'replace')] += 1
+            # A refused PING or WHO gets no other reply: drop its send time
+            # so later replies are not matched to earlier requests
+            if line == b"ERR rate-limited (PING)\n" and client.pings:
+                client.pings.popleft()
+            elif line == b"ERR rate-limited (WHO)\n" and client.whos:
+                client.whos.popleft()
+
+
+def send_command(client, kind, clients, padding):
+    if kind == 'ping':
+        client.pings.append(time.perf_counter())
+        line = "PING\n"
+    elif kind == 'who':
+        client.whos.append(time.perf_counter())
+        line = "WHO\n"
+    elif kind == 'dm' and len(clients) > 1:
+        target = client
+        while target is client:
+            target = random.choice(clients)
+        line = f"DM {target.name} {STAMP_TAG} {time.perf_counter():.9f} {padding}\n"
+    else:
+        line = f"MSG {STAMP_TAG} {time.perf_counter():.9f} {padding}\n"
+    client.writer.write(line.encode('utf-8'))
+
+
+async def drive(args, clients, results):
+    """Send commands at args.rate per second for args.duration seconds"""
+    kinds, weights = parse_mix(args.mix)
+    padding = 'x' * args.size
+    started = time.perf_counter()
+    deadline = started + args.duration
+    issued = 0
+    while True:
+        now = time.perf_counter()
+        if now >= deadline or not clients:
+            break
+        due = int((now - started) * args.rate) - issued
+        if due > 0:
+            for kind in random.choices(kinds, weights, k=due):
+                client = random.choice(clients)
+                send_command(client, kind, clients, padding)
+                results.sent[kind] += 1
+            issued += due
+        await asyncio.sleep(TICK)
+    return time.perf_counter() - started
+
+
+async def run(args):
+    results = Results()
+    run_id = os.urandom(2).hex()
+    names = [f"lg{run_id}_{i}" for i in range(args.clients)]
+
+    # Connect and log in at most args.concurrency clients at a time
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def open_one(name):
+        async with semaphore:
+            return await connect(args, name, results)
+
+    connect_started = time.perf_counter()
+    opened = await asyncio.gather(*(open_one(name) for name in names))
+    connect_elapsed = time.perf_counter() - connect_started
+    clients = [client for client in opened if client is not None]
+
+    readers = [asyncio.ensure_future(read_replies(client, results)) for client in clients]
+    elapsed = await drive(args, clients, results)
+    await asyncio.sleep(args.drain)  # let in-flight deliveries arrive
+
+    for client in clients:
+        client.writer.close()
+    for task in readers:
+        task.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+
+    total_sent = sum(results.sent.values())
+    deliveries = len(results.latency['msg']) + len(results.latency['dm'])
+    return {
+        'target': f"{args.host}:{args.port}",
+        'clients': args.clients,
+        'connected': results.connected,
+        'connect_failures': results.connect_failures,
+        'login_failures': results.login_failures,
+        'connect_seconds': round(connect_elapsed, 3),
+        'connect_rate': round(results.connected / connect_elapsed, 1) if connect_elapsed else 0,
+        'duration': round(elapsed, 3),
+        'mix': args.mix,
+        'sent': dict(results.sent),
+        'send_rate': round(total_sent / elapsed, 1) if elapsed else 0,
+        'deliveries': deliveries,
+        'delivery_rate': round(deliveries / elapsed, 1) if elapsed else 0,
+        'received_lines': results.received_lines,
+        'received_bytes': results.received_bytes,
+        'errors': dict(results.errors),
+        'latency_ms': {kind: summarize(samples) for kind, samples in results.latency.items()},
+    }
+
+
+def print_summary(report):
+    out = sys.stderr
+    print(f"{report['connected']}/{report['clients']} clients logged in to {report['target']} "
+          f"in {report['connect_seconds']}s ({report['connect_rate']}/s)", file=out)
+    print(f"sent {sum(report['sent'].values())} commands in {report['duration']}s "
+          f"({report['send_rate']}/s), {report['deliveries']} deliveries "
+          f"({report['delivery_rate']}/s)", file=out)
+    if report['errors']:
+        print(f"errors: {report['errors']}", file=out)
+    for kind, summary in report['latency_ms'].items():
+        if summary['count']:
+            cells = ' '.join(f"{key}={value}" for key, value in summary.items() if key != 'count')
+            print(f"{kind:>5} latency ms: n={summary['count']} {cells}", file=out)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for the AlgoKart chat server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4000)
+    parser.add_argument('--clients', type=int, default=100, help="connections to open (default 100)")
+    parser.add_argument('--concurrency', type=int, default=200,
+                        help="connections being opened at the same time (default 200)")
+    parser.add_argument('--rate', type=float, default=100,
+                        help="commands per second across all clients (default 100)")
+    parser.add_argument('--duration', type=float, default=10, help="seconds to send for (default 10)")
+    parser.add_argument('--mix', default=DEFAULT_MIX, type=str,
+                        help=f"command weights (default {DEFAULT_MIX})")
+    parser.add_argument('--size', type=int, default=32, help="padding bytes per MSG/DM (default 32)")
+    parser.add_argument('--drain', type=float, default=2,
+                        help="seconds to keep reading after the last command (default 2)")
+    parser.add_argument('--timeout', type=float, default=10, help="login timeout in seconds")
+    parser.add_argument('--json', metavar='FILE', help="write results as JSON to FILE ('-' for stdout)")
+    args = parser.parse_args(argv)
+    try:
+        parse_mix(args.mix)
+    except (argparse.ArgumentTypeError, ValueError) as e:
+        parser.error(f"--mix: {e}")
+    return args
+
+
+def main():
+    args = parse_args()
+    raise_fd_limit()
+    report = asyncio.run(run(args))
+    print_summary(report)
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
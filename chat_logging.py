@@ -0,0 +1,139 @@
+"""Asynchronous logging for the AlgoKart chat servers.
+
+log() calls on the request path only check the level, read a cached
+timestamp string and append a tuple to a bounded queue. A background
+thread formats queued records and writes them to the stream in batches,
+one write() and flush() per batch, so a slow or blocked terminal never
+stalls the server: once the queue is full, new records are dropped and
+counted instead of waiting.
+
+Per-message events (one log line per MSG or DM) can be sampled, keeping
+only one record in every `sample_every`.
+"""
+
+import collections
+import itertools
+import os
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+
+QUEUE_LIMIT = 10000  # records waiting for the writer before new ones are dropped
+BATCH_SIZE = 512  # records written per write()/flush()
+IDLE_WAIT = 0.05  # seconds the writer sleeps when the queue is empty
+
+RESET = '\033[0m'
+
+
+class AsyncLogger:
+    """Level-filtered logger with a background writer thread"""
+
+    def __init__(self, stream=None, level=INFO, sample_every=1, queue_limit=QUEUE_LIMIT):
+        self.stream = stream
+        self.level = level
+        self.sample_every = sample_every
+        self.queue_limit = queue_limit
+        self.dropped = 0
+        self._queue = collections.deque()  # append/popleft are atomic, no lock needed
+        self._samples = itertools.count()
+        self._second = None
+        self._stamp = ''
+        self._running = False
+        self._thread = None
+        if hasattr(os, 'register_at_fork'):
+            # Threads do not survive fork(): give each worker its own writer
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def sample(self, level=INFO):
+        """Whether to keep the next per-message record at level.
+
+        For callers that only build the record if it is kept; they then
+        log() it without sample=True.
+        """
+        return level >= self.level and self._keep_sample()
+
+    def _keep_sample(self):
+        return self.sample_every <= 1 or next(self._samples) % self.sample_every == 0
+
+    def timestamp(self):
+        """Current time as HH:MM:SS, formatted at most once per second"""
+        now = int(time.time())
+        if now != self._second:
+            self._stamp = time.strftime('%H:%M:%S', time.localtime(now))
+            self._second = now
+        return self._stamp
+
+    def log(self, message, color='', level=INFO, sample=False):
+        """Queue message for the writer.
+
+        sample marks a per-message event subject to sample_every.
+        """
+        if level < self.level:
+            return
+        if sample and not self._keep_sample():
+            return
+        if not self._running:
+            self._write([(self.timestamp(), color, message)])
+            return
+        if len(self._queue) >= self.queue_limit:
+            self.dropped += 1
+            return
+        self._queue.append((self.timestamp(), color, message))
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def close(self, timeout=1.0):
+        """Stop the writer after it has written what is queued"""
+        if not self._running:
+            return
+        self._running = False
+        self._thread.join(timeout)
+        if self.dropped:
+            self._write([(self.timestamp(), '', f"{self.dropped} log records dropped")])
+            self.dropped = 0
+
+    def _after_fork(self):
+        self._queue.clear()
+        self._thread = None
+        if self._running:
+            self._running = False
+            self.start()
+
+    def _run(self):
+        queue = self._queue
+        while self._running or queue:
+            if not queue:
+                time.sleep(IDLE_WAIT)
+                continue
+            batch = []
+            while queue and len(batch) < BATCH_SIZE:
+                batch.append(queue.popleft())
+            self._write(batch)
+
+    def _write(self, records):
+        stream = self.stream or sys.stdout
+        lines = []
+        for stamp, color, message in records:
+            if color:
+                lines.append(f"{color}[{stamp}] {message}{RESET}\n")
+            else:
+                lines.append(f"[{stamp}] {message}\n")
+        try:
+            stream.write(''.join(lines))
+            stream.flush()
+        except (OSError, ValueError):
+            pass  # stdout closed or gone; nothing sensible left to do
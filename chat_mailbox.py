@@ -0,0 +1,242 @@
+"""Offline direct messages for the AlgoKart chat server.
+
+A DM to a user who has logged in before but is offline now is appended
+to that user's mailbox file, <directory>/<username>.box, one wire line
+per message. Usernames that have ever logged in are listed in
+<directory>/users.
+
+All disk work happens on one committer thread, in the order it was
+requested. The committer takes everything queued since its last round,
+writes it, and then fsyncs each touched file once (group commit), so a
+burst of offline DMs costs one fsync per mailbox rather than one per
+message. Callers never wait for the disk. Completion callbacks, such as
+the sender's acknowledgement, run through `post` once the file they
+wrote to has been synced, or with False if writing it failed.
+
+On login the mailbox is opened for delivery (see Backlog) and streamed
+to the connection a chunk at a time as its outbox drains, so a large
+backlog is never held in memory. When delivery stops, finish() removes
+what was handed out. If the user disconnected part way through, or new
+messages arrived meanwhile, the rest stays for the next login.
+"""
+
+import collections
+import os
+import shutil
+import threading
+
+BOX_SUFFIX = '.box'
+USERS_FILE = 'users'
+READ_CHUNK = 16384  # bytes handed to a connection at a time
+
+
+def _fsync_directory(directory):
+    """Make created, renamed or removed files in directory durable"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return  # not supported (Windows)
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class Backlog:
+    """A mailbox being delivered: the first `size` bytes at open time"""
+    __slots__ = ('username', 'path', 'file', 'size', 'count', 'offset')
+
+    def __init__(self, username, path, file, size, count):
+        self.username = username
+        self.path = path
+        self.file = file
+        self.size = size
+        self.count = count  # messages in the first size bytes
+        self.offset = 0  # bytes handed out so far
+
+    def read(self):
+        """Next whole lines, at most about READ_CHUNK bytes; b'' at the end"""
+        remaining = self.size - self.offset
+        if remaining <= 0:
+            return b''
+        data = self.file.read(min(READ_CHUNK, remaining))
+        if len(data) < remaining:
+            cut = data.rfind(b'\n') + 1
+            if cut:
+                self.file.seek(cut - len(data), os.SEEK_CUR)
+                data = data[:cut]
+        self.offset += len(data)
+        return data
+
+
+class Mailbox:
+    """Durable per-user queues of encoded DM lines"""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.known = set()
+        self.commits = 0  # fsync rounds
+        self.stored = 0  # messages made durable
+        self._queue = collections.deque()  # (operation, args)
+        self._wakeup = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._post = None
+        try:
+            with open(os.path.join(directory, USERS_FILE), 'rb') as f:
+                self.known.update(line.decode('utf-8') for line in f.read().split() if line)
+        except FileNotFoundError:
+            pass
+
+    def start(self, post):
+        """Start the committer; callbacks run through post(callback, *args)"""
+        self._post = post
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='mailbox', daemon=True)
+        self._thread.start()
+
+    def close(self, timeout=5.0):
+        """Commit what is queued and stop the committer"""
+        if not self._running:
+            return
+        with self._wakeup:
+            self._running = False
+            self._wakeup.notify()
+        self._thread.join(timeout)
+
+    # Requests; each returns at once and is carried out by the committer
+
+    def is_known(self, username):
+        return username in self.known
+
+    def register(self, username):
+        """Remember username as a valid DM target from now on"""
+        if username not in self.known:
+            self.known.add(username)
+            self._submit('register', username)
+
+    def append(self, username, line, done=None):
+        """Queue line for username; done(stored) is posted once it is on
+        disk (stored True) or could not be written (stored False)"""
+        self._submit('append', username, line, done)
+
+    def open_backlog(self, username, ready):
+        """Post ready(backlog), with a Backlog of username's messages or None"""
+        self._submit('open', username, ready)
+
+    def finish(self, backlog):
+        """Drop the part of backlog that was delivered"""
+        self._submit('finish', backlog)
+
+    def finish_now(self, backlog):
+        """finish() on the calling thread, for use after close()"""
+        self._finish(backlog)
+
+    def _submit(self, operation, *args):
+        with self._wakeup:
+            self._queue.append((operation, args))
+            self._wakeup.notify()
+
+    # Committer thread
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                while self._running and not self._queue:
+                    self._wakeup.wait()
+                if not self._queue:
+                    return
+                batch = list(self._queue)
+                self._queue.clear()
+            self._commit(batch)
+
+    def _commit(self, batch):
+        pending = {}  # {path: [lines]} appended since the last fsync round
+        callbacks = {}  # {path: [done]} waiting for those lines
+        for operation, args in batch:
+            if operation == 'append':
+                username, line, done = args
+                path = self._box_path(username)
+                pending.setdefault(path, []).append(line)
+                if done is not None:
+                    callbacks.setdefault(path, []).append(done)
+            elif operation == 'register':
+                pending.setdefault(os.path.join(self.directory, USERS_FILE), []).append(
+                    args[0].encode('utf-8') + b'\n')
+            else:
+                # Later requests must see every earlier append
+                self._write(pending, callbacks)
+                pending, callbacks = {}, {}
+                if operation == 'open':
+                    username, ready = args
+                    self._post(ready, self._open(username))
+                else:
+                    self._finish(args[0])
+        self._write(pending, callbacks)
+
+    def _write(self, pending, callbacks):
+        if not pending:
+            return
+        created = False
+        failed = set()
+        for path, lines in pending.items():
+            try:
+                created = created or not os.path.exists(path)
+                with open(path, 'ab') as f:
+                    f.write(b''.join(lines))
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError:
+                failed.add(path)  # the lines are lost
+                continue
+            if not path.endswith(USERS_FILE):
+                self.stored += len(lines)
+        if created:
+            _fsync_directory(self.directory)
+        self.commits += 1
+        for path, waiting in callbacks.items():
+            for done in waiting:
+                self._post(done, path not in failed)
+
+    def _box_path(self, username):
+        return os.path.join(self.directory, username + BOX_SUFFIX)
+
+    def _open(self, username):
+        path = self._box_path(username)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        size = os.fstat(f.fileno()).st_size
+        count = 0
+        while f.tell() < size:  # count in chunks, never loading the file
+            count += f.read(min(1 << 20, size - f.tell())).count(b'\n')
+        if not count:
+            f.close()
+            return None
+        f.seek(0)
+        return Backlog(username, path, f, size, count)
+
+    def _finish(self, backlog):
+        backlog.file.close()
+        try:
+            size = os.path.getsize(backlog.path)
+            if backlog.offset >= size:
+                os.remove(backlog.path)
+            elif backlog.offset:
+                # Keep the undelivered rest, including anything appended meanwhile
+                temporary = backlog.path + '.tmp'
+                with open(backlog.path, 'rb') as source, open(temporary, 'wb') as target:
+                    source.seek(backlog.offset)
+                    shutil.copyfileobj(source, target)
+                    target.flush()
+                    os.fsync(target.fileno())
+                os.replace(temporary, backlog.path)
+            else:
+                return
+        except OSError:
+            return
+        _fsync_directory(self.directory)
@@ -0,0 +1,185 @@
+"""Metrics for the AlgoKart chat server.
+
+Counters and histograms are plain objects updated in place: counting is
+one attribute increment and a histogram observation is one bisect over a
+fixed tuple of bucket bounds, so both are cheap enough for the message
+path. Updates take no lock; under the threaded engine two racing
+increments can occasionally count as one, which is accepted for the sake
+of speed.
+
+Metrics.render() produces the Prometheus text exposition format, served
+by serve_http() on its own port, and Metrics.stat_lines() feeds the STATS
+command.
+"""
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Seconds: 10us .. 1s, roughly 1-2.5-5 steps
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Bytes: 64 B .. 1 MiB
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in sorted(labels.items())) + '}'
+
+
+class Counter:
+    """Callers add to .value directly, saving a method call per count"""
+    __slots__ = ('name', 'labels', 'value')
+
+    def __init__(self, name, labels=''):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+
+
+class Histogram:
+    """Fixed-bucket histogram; counts[i] holds values <= bounds[i]"""
+    __slots__ = ('name', 'labels', 'bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, name, bounds, labels=''):
+        self.name = name
+        self.labels = labels
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # last bucket is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (inf if beyond)"""
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class TimedLock:
+    """Lock wrapper recording how long each acquisition waited"""
+    __slots__ = ('lock', 'histogram', 'name', 'observer')
+
+    def __init__(self, histogram, name=None):
+        self.lock = threading.Lock()
+        self.histogram = histogram
+        self.name = name
+        self.observer = None  # also called with (name, started, waited), e.g. a tracer
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self.lock.acquire()
+        # Observed while holding the lock, so these updates never race
+        waited = time.perf_counter() - started
+        self.histogram.observe(waited)
+        if self.observer is not None:
+            self.observer(self.name, started, waited)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+class Metrics:
+    """All metrics of one server process"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters = []
+        self.histograms = []
+        self.gauges = []  # [(name, function returning the current value)]
+        self.locks = []
+
+    def counter(self, name, **labels):
+        counter = Counter(name, _label_text(labels))
+        self.counters.append(counter)
+        return counter
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS, **labels):
+        histogram = Histogram(name, buckets, _label_text(labels))
+        self.histograms.append(histogram)
+        return histogram
+
+    def gauge(self, name, function):
+        self.gauges.append((name, function))
+
+    def timed_lock(self, name):
+        """A lock recording its wait times in chat_lock_wait_seconds{lock=name}"""
+        lock = TimedLock(self.histogram('chat_lock_wait_seconds', lock=name), name)
+        self.locks.append(lock)
+        return lock
+
+    def render(self):
+        """Prometheus text format"""
+        lines = [f'chat_uptime_seconds {time.monotonic() - self.started:.3f}']
+        for counter in list(self.counters):
+            lines.append(f'{counter.name}{counter.labels} {counter.value}')
+        for name, function in list(self.gauges):
+            lines.append(f'{name} {function()}')
+        for histogram in list(self.histograms):
+            labels = histogram.labels[1:-1]
+            prefix = labels + ',' if labels else ''
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                cumulative += count
+                lines.append(f'{histogram.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{histogram.name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+            lines.append(f'{histogram.name}_sum{histogram.labels} {histogram.sum}')
+            lines.append(f'{histogram.name}_count{histogram.labels} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def stat_lines(self):
+        """Human-readable summary, one line per metric, for STATS"""
+        uptime = time.monotonic() - self.started
+        lines = [f'uptime_seconds {uptime:.0f}']
+        for counter in list(self.counters):
+            if counter.value:
+                lines.append(f'{counter.name}{counter.labels} {counter.value} '
+                             f'{counter.value / max(uptime, 1):.1f}/s')
+        for name, function in list(self.gauges):
+            lines.append(f'{name} {function()}')
+        for histogram in list(self.histograms):
+            if histogram.count:
+                lines.append(f'{histogram.name}{histogram.labels} count={histogram.count} '
+                             f'mean={histogram.sum / histogram.count:.6g} '
+                             f'p50<={histogram.quantile(0.5)} p90<={histogram.quantile(0.9)} '
+                             f'p99<={histogram.quantile(0.99)}')
+        return lines
+
+
+def serve_http(metrics, host, port):
+    """Serve metrics.render() over HTTP from a daemon thread"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # scrapes would flood the chat log
+
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    return server
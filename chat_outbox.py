@@ -0,0 +1,293 @@
+"""Per-connection outbound queues for the AlgoKart chat server.
+
+Every connection owns an Outbox: a bounded FIFO of encoded chunks that is
+drained with non-blocking sends whenever the socket has room. A reader
+that stops draining its TCP window only grows its own queue; once that
+queue passes the high-water mark the slow-consumer policy decides whether
+to drop its oldest messages or to disconnect it.
+
+An Outbox can also deflate its output (see enable_compression). Queued
+chunks then stay uncompressed until the next write, where everything
+pending is compressed in one call and flushed with Z_SYNC_FLUSH. Each
+write therefore ends on a message boundary the client can decode, and
+drop-oldest can still discard whole messages that have not been
+compressed yet.
+"""
+
+import collections
+import contextlib
+import itertools
+import os
+import selectors
+import socket
+import threading
+import zlib
+
+DEFAULT_HIGH_WATER = 256 * 1024  # bytes queued before the policy kicks in
+
+# Most chunks queued behind each other are written with one vectored send
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+try:
+    IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 64
+if IOV_MAX <= 0:
+    IOV_MAX = 64
+
+# Slow-consumer policies
+DISCONNECT = 'disconnect'
+DROP_OLDEST = 'drop-oldest'
+POLICIES = (DISCONNECT, DROP_OLDEST)
+
+SLOW_CONSUMER_NOTICE = b"INFO slow-consumer\n"
+
+
+class Outbox:
+    """Bounded queue of pending output for one connection.
+
+    Chunks are kept as the bytes objects they were pushed with, so a
+    message shared by many recipients is never copied per recipient.
+    """
+    __slots__ = ('chunks', 'offset', 'queued', 'high_water', 'policy', 'dropped', 'sent',
+                 'compressor', 'uncompressed', 'deflated_in', 'deflated_out')
+
+    def __init__(self, high_water=DEFAULT_HIGH_WATER, policy=DISCONNECT):
+        self.chunks = collections.deque()  # wire-ready data
+        self.offset = 0  # bytes of chunks[0] already written
+        self.queued = 0  # unsent bytes across all chunks
+        self.high_water = high_water
+        self.policy = policy
+        self.dropped = 0
+        self.sent = 0  # bytes written to the socket so far
+        self.compressor = None  # zlib compressobj once compression is on
+        self.uncompressed = collections.deque()  # chunks waiting to be compressed
+        self.deflated_in = 0  # bytes fed to the compressor so far
+        self.deflated_out = 0  # bytes it produced
+
+    def __len__(self):
+        return len(self.chunks) + len(self.uncompressed)
+
+    def enable_compression(self, compressor):
+        """Deflate everything pushed from now on with compressor.
+
+        Data queued before the call still goes out as it is.
+        """
+        self.compressor = compressor
+
+    def deflate(self, data):
+        """Compress data on the connection's stream, ending on a flush point"""
+        out = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.deflated_in += len(data)
+        self.deflated_out += len(out)
+        return out
+
+    def push(self, data):
+        """Queue data; returns False if the connection must be evicted"""
+        if self.compressor is not None:
+            self.uncompressed.append(data)
+        else:
+            self.chunks.append(data)
+        self.queued += len(data)
+        if self.queued > self.high_water:
+            if self.policy != DROP_OLDEST:
+                return False
+            self._drop_oldest()
+        return True
+
+    def _drop_oldest(self):
+        if self.compressor is not None:
+            # Compressed chunks depend on each other: only drop raw messages
+            pending = self.uncompressed
+            while self.queued > self.high_water and len(pending) > 1:
+                self.queued -= len(pending.popleft())
+                self.dropped += 1
+            return
+        chunks = self.chunks
+        # A partially written head must go out whole or the stream is corrupt
+        head = chunks.popleft() if self.offset else None
+        while self.queued > self.high_water and len(chunks) > 1:
+            self.queued -= len(chunks.popleft())
+            self.dropped += 1
+        if head is not None:
+            chunks.appendleft(head)
+
+    def write_to(self, sock):
+        """Send queued chunks without blocking; returns True once drained.
+
+        Everything pending goes out in as few syscalls as possible: one
+        sendmsg() over up to IOV_MAX chunks (or one send() of the joined
+        chunks where sendmsg is unavailable). Connection errors other than
+        "would block" propagate to the caller.
+        """
+        if self.uncompressed:
+            self._compress_pending()
+        chunks = self.chunks
+        while chunks:
+            if len(chunks) == 1:
+                head = chunks[0]
+                data = memoryview(head)[self.offset:] if self.offset else head
+                attempted = len(data)
+            else:
+                batch = list(itertools.islice(chunks, IOV_MAX))
+                if self.offset:
+                    batch[0] = memoryview(batch[0])[self.offset:]
+                attempted = sum(map(len, batch))
+                data = batch if HAVE_SENDMSG else b''.join(batch)
+            try:
+                if type(data) is list:
+                    sent = sock.sendmsg(data)
+                else:
+                    sent = sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                return False
+            self._consume(sent)
+            if sent < attempted:
+                return False  # socket buffer is full
+        return True
+
+    def _compress_pending(self):
+        pending = self.uncompressed
+        data = pending[0] if len(pending) == 1 else b''.join(pending)
+        pending.clear()
+        out = self.deflate(data)
+        self.queued += len(out) - len(data)
+        self.chunks.append(out)
+
+    def _consume(self, sent):
+        self.sent += sent
+        self.queued -= sent
+        chunks = self.chunks
+        sent += self.offset
+        while chunks and sent >= len(chunks[0]):
+            sent -= len(chunks.popleft())
+        self.offset = sent
+
+    def unsent(self):
+        """Everything still queued, as one bytes object (compression off)"""
+        data = b''.join(self.chunks)
+        return data[self.offset:] if self.offset else data
+
+    def clear(self):
+        """Discard everything queued; returns True if a chunk was cut short"""
+        truncated = self.offset > 0
+        self.chunks.clear()
+        self.uncompressed.clear()
+        self.offset = 0
+        self.queued = 0
+        return truncated
+
+    def eviction_notice(self):
+        """Drop the backlog and return the slow-consumer line to send last"""
+        if self.clear():
+            return b"\n" + SLOW_CONSUMER_NOTICE
+        return SLOW_CONSUMER_NOTICE
+
+
+_batch = threading.local()
+
+
+@contextlib.contextmanager
+def coalesced_writes():
+    """Hold back the first write to each connection until the block ends.
+
+    Used by the threaded engine around the processing of one recv():
+    every message produced for a given recipient while the block runs is
+    then written with a single vectored send instead of one send each.
+    """
+    if getattr(_batch, 'conns', None) is not None:
+        yield  # already inside a batch
+        return
+    _batch.conns = conns = []
+    try:
+        yield
+    finally:
+        _batch.conns = None
+        for conn in conns:
+            conn.flush_or_watch()
+
+
+def pending_batch():
+    """List collecting connections to flush for the current thread, if any"""
+    return getattr(_batch, 'conns', None)
+
+
+class OutboundWriter(threading.Thread):
+    """Background thread that drains outboxes the threaded engine could not
+    write immediately.
+
+    Connections are handed over with watch(); the thread waits for their
+    sockets to become writable and calls conn.flush() until it reports
+    that the outbox is empty.
+    """
+
+    def __init__(self):
+        super().__init__(name='outbound-writer', daemon=True)
+        self.selector = selectors.DefaultSelector()
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+    def watch(self, conn):
+        """Ask the writer to flush conn when its socket has room"""
+        with self._pending_lock:
+            self._pending.append(conn)
+        self.wakeup()
+
+    def wakeup(self):
+        """Interrupt select() so closed connections are swept promptly"""
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass  # a wakeup is already pending
+
+    def run(self):
+        watched = {}  # {conn: fd}; raw fds so closed sockets can be unregistered
+        while True:
+            try:
+                events = self.selector.select()
+            except OSError:
+                events = []  # a watched socket was closed under us; swept below
+            for key, _ in events:
+                conn = key.data
+                if conn is None:
+                    self._drain_wakeups()
+                    continue
+                if conn.flush() and conn in watched:
+                    self._unwatch(watched.pop(conn))
+
+            with self._pending_lock:
+                pending, self._pending = self._pending, []
+            for conn in pending:
+                if conn in watched or conn.closed:
+                    continue
+                fd = conn.sock.fileno()
+                if fd < 0:
+                    continue
+                try:
+                    self.selector.register(fd, selectors.EVENT_WRITE, conn)
+                except KeyError:
+                    # fd number reused after a close we have not swept yet
+                    watched.pop(self.selector.get_key(fd).data, None)
+                    self._unwatch(fd)
+                    self.selector.register(fd, selectors.EVENT_WRITE, conn)
+                watched[conn] = fd
+
+            # Sockets closed by their reader threads must leave the selector
+            for conn in [c for c in watched if c.closed]:
+                self._unwatch(watched.pop(conn))
+
+    def _unwatch(self, fd):
+        try:
+            self.selector.unregister(fd)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def _drain_wakeups(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
@@ -0,0 +1,81 @@
+"""Presence coalescing for the AlgoKart chat server.
+
+Announcing every login and logout to every user costs O(users) lines
+per event, so a mass reconnect after a restart costs O(users²) lines.
+PresenceAggregator instead collects joins and leaves for a short window.
+Each client then gets one line per window:
+- a lone event keeps its usual line, "INFO <user> joined the chat" or
+  "INFO <user> disconnected";
+- anything more becomes a digest, "INFO <n> joined, <m> left".
+
+A user who joins and leaves (or leaves and rejoins) within one window
+cancels out and is not announced at all. Clients that asked for full
+presence detail get the individual lines of the window in one write
+instead of the digest.
+"""
+
+import threading
+import time
+
+JOINED = 'joined'
+LEFT = 'left'
+DIGEST = 'digest'
+FULL = 'full'
+MODES = (DIGEST, FULL)
+
+DEFAULT_WINDOW = 0.5  # seconds presence events are held back for coalescing
+
+
+def event_line(username, event):
+    """The classic per-event presence line, encoded"""
+    if event is JOINED:
+        return f"INFO {username} joined the chat\n".encode('utf-8')
+    return f"INFO {username} disconnected\n".encode('utf-8')
+
+
+def digest_line(events, recipient=None):
+    """What events look like to recipient, whose own login is left out:
+    the digest line, the classic line if only one other event remains,
+    or None if none does"""
+    if recipient is not None:
+        events = [(username, event) for username, event in events if username != recipient]
+    if not events:
+        return None
+    if len(events) == 1:
+        return event_line(*events[0])
+    joined = sum(1 for _, event in events if event is JOINED)
+    return f"INFO {joined} joined, {len(events) - joined} left\n".encode('utf-8')
+
+
+class PresenceAggregator:
+    """Net presence changes since the last take(), in arrival order"""
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self.deadline = None  # when the oldest pending event is due, or None
+        self._events = {}  # {username: JOINED or LEFT}; dicts keep insertion order
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._events)
+
+    def record(self, username, event):
+        with self._lock:
+            previous = self._events.pop(username, None)
+            if previous is None or previous is event:
+                self._events[username] = event
+            # otherwise the opposite event is pending: the two cancel out
+            if self.deadline is None:
+                self.deadline = time.monotonic() + self.window
+
+    def due(self, now=None):
+        deadline = self.deadline
+        return deadline is not None and (time.monotonic() if now is None else now) >= deadline
+
+    def take(self):
+        """[(username, event)] recorded since the last call"""
+        with self._lock:
+            events = list(self._events.items())
+            self._events.clear()
+            self.deadline = None
+        return events
@@ -0,0 +1,262 @@
+"""On-demand profiling and request tracing for the AlgoKart chat server.
+
+Profiler runs one bounded profiling session at a time and writes the
+result to a file when it ends:
+- sample: a background thread records the stack of every other thread
+  every few milliseconds. It sees all threads of either engine and costs
+  the server little. The output is in folded-stack format, one
+  "frame;frame;... count" line per distinct stack, which flamegraph.pl,
+  speedscope and similar tools read directly.
+- cprofile: cProfile on the thread that starts the session, which for
+  the event loop engine is the thread doing all the work. Deterministic
+  and precise, but it slows that thread down while it runs. The output is
+  a pstats file (python -m pstats FILE).
+
+Tracer keeps the most recent timed spans (parse, dispatch, lock wait,
+fan-out, send) in a ring buffer while it is enabled. A disabled tracer
+hands out a shared do-nothing span, so the instrumented paths only pay
+for a method call. dump() writes the ring as Chrome trace JSON (load it
+in chrome://tracing or Perfetto) and as folded stacks of self time in
+microseconds.
+"""
+
+import collections
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+
+SAMPLE = 'sample'
+CPROFILE = 'cprofile'
+MODES = (SAMPLE, CPROFILE)
+
+SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+TRACE_CAPACITY = 100000  # spans kept by the tracer
+
+
+def _file_name(directory, kind, suffix):
+    now = time.time()
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now)) + f"{now % 1:.3f}"[1:]
+    return os.path.join(directory, f"{kind}-{os.getpid()}-{stamp}{suffix}")
+
+
+def _write_lines(path, lines):
+    with open(path, 'w') as f:
+        f.write(''.join(f"{line}\n" for line in lines))
+
+
+class _Run:
+    __slots__ = ('mode', 'path', 'stop', 'profile', 'timer')
+
+    def __init__(self, mode, path):
+        self.mode = mode
+        self.path = path
+        self.stop = threading.Event()
+        self.profile = None  # cProfile.Profile (cprofile)
+        self.timer = None  # threading.Timer ending a cprofile run
+
+
+class Profiler:
+    """Bounded profiling runs written to directory"""
+
+    def __init__(self, directory='.', interval=SAMPLE_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.post = lambda callback, *args: callback(*args)  # runs work on the serving thread
+        self.on_done = None  # called with the path of each finished run
+        self._run = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._run is not None
+
+    def start(self, seconds, mode=SAMPLE):
+        """Profile for at most seconds; returns the file the result goes to,
+        or None if a run is already in progress"""
+        with self._lock:
+            if self._run is not None:
+                return None
+            os.makedirs(self.directory, exist_ok=True)
+            suffix = '.pstats' if mode == CPROFILE else '.folded'
+            run = self._run = _Run(mode, _file_name(self.directory, 'profile', suffix))
+        if mode == CPROFILE:
+            run.profile = cProfile.Profile()
+            run.profile.enable()  # this thread only
+            # Only the profiled thread may stop the profile
+            run.timer = threading.Timer(seconds, self.post, (self._finish, run))
+            run.timer.daemon = True
+            run.timer.start()
+        else:
+            threading.Thread(target=self._sample, args=(run, time.monotonic() + seconds),
+                             name='profiler', daemon=True).start()
+        return run.path
+
+    def stop(self):
+        """End the current run early; returns its file, or None if none runs.
+
+        A cprofile run must be stopped from the thread that started it.
+        """
+        run = self._run
+        if run is None:
+            return None
+        if run.mode == CPROFILE:
+            run.timer.cancel()
+            self._finish(run)
+        else:
+            run.stop.set()
+        return run.path
+
+    def _finish(self, run):
+        with self._lock:
+            if self._run is not run:
+                return  # stopped already
+            self._run = None
+        if run.profile is not None:
+            run.profile.disable()
+            run.profile.dump_stats(run.path)
+        if self.on_done is not None:
+            self.on_done(run.path)
+
+    def _sample(self, run, deadline):
+        counts = collections.Counter()
+        me = threading.get_ident()
+        names = {}
+        while not run.stop.wait(self.interval) and time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:"
+                                 f"{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                counts[';'.join(reversed(stack))] += 1
+        try:
+            _write_lines(run.path, (f"{stack} {count}" for stack, count in sorted(counts.items())))
+        except OSError:
+            pass
+        self.post(self._finish, run)
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'detail', 'start', 'child')
+
+    def __init__(self, tracer, name, detail):
+        self.tracer = tracer
+        self.name = name
+        self.detail = detail
+        self.child = 0.0  # time spent in nested spans
+
+    def __enter__(self):
+        self.tracer._stack().append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer._close(self, time.perf_counter() - self.start)
+
+    def label(self):
+        return self.name if self.detail is None else f"{self.name} {self.detail}"
+
+
+class Tracer:
+    """Ring buffer of the most recent spans on every thread"""
+
+    def __init__(self, capacity=TRACE_CAPACITY):
+        self.enabled = False
+        # (name, detail, thread, start, duration, self time, folded path)
+        self.spans = collections.deque(maxlen=capacity)
+        self._local = threading.local()
+
+    def span(self, name, detail=None):
+        """Context manager timing one span, nested under any open span"""
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name, detail)
+
+    def annotate(self, detail):
+        """Attach detail (such as the command name) to the innermost open span"""
+        if self.enabled:
+            stack = self._stack()
+            if stack:
+                stack[-1].detail = detail
+
+    def record(self, name, start, duration, detail=None):
+        """Add a span timed by the caller, nested under any open span"""
+        if not self.enabled:
+            return
+        stack = self._stack()
+        if stack:
+            stack[-1].child += duration
+        path = ';'.join([span.label() for span in stack]
+                        + [name if detail is None else f"{name} {detail}"])
+        self.spans.append((name, detail, threading.get_native_id(), start, duration, duration,
+                           path))
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _close(self, span, duration):
+        stack = self._stack()
+        # A span may outlive a disable/enable cycle; only pop our own entry
+        if stack and stack[-1] is span:
+            stack.pop()
+        if stack:
+            stack[-1].child += duration
+        path = ';'.join([outer.label() for outer in stack] + [span.label()])
+        self.spans.append((span.name, span.detail, threading.get_native_id(), span.start,
+                           duration, duration - span.child, path))
+
+    def dump(self, directory='.'):
+        """Write the ring from a background thread; returns the two file paths"""
+        spans = list(self.spans)
+        os.makedirs(directory, exist_ok=True)
+        chrome = _file_name(directory, 'trace', '.json')
+        folded = _file_name(directory, 'trace', '.folded')
+        threads = {thread.native_id: thread.name for thread in threading.enumerate()}
+        threading.Thread(target=self._write, args=(spans, threads, chrome, folded),
+                         name='trace-dump', daemon=True).start()
+        return chrome, folded
+
+    @staticmethod
+    def _write(spans, threads, chrome, folded):
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                  for tid, name in threads.items()]
+        totals = collections.Counter()
+        for name, detail, tid, start, duration, self_time, path in spans:
+            event = {'name': name if detail is None else f"{name} {detail}", 'ph': 'X',
+                     'pid': pid, 'tid': tid, 'ts': round(start * 1e6, 3),
+                     'dur': round(duration * 1e6, 3)}
+            events.append(event)
+            totals[path] += self_time
+        try:
+            with open(chrome, 'w') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+            _write_lines(folded, (f"{path} {max(1, round(total * 1e6))}"
+                                  for path, total in sorted(totals.items())))
+        except OSError:
+            pass
@@ -0,0 +1,130 @@
+"""Rate limiting and admission control for the AlgoKart chat servers.
+
+Commands: every logged-in connection gets a token bucket per limited
+command (none unless --rate-limit names some). A bucket refills lazily
+from the time of its last use, so checking it is a few float operations
+with no timer, no lock and no shared state; only the connection's own
+reader ever touches its buckets.
+
+Connections: ConnectionLimiter caps the connections open at once, in
+total and per client IP. It is consulted once per accept and once per
+close, and a rejected socket gets a one-line ERR and is closed before
+any per-connection state is allocated.
+"""
+
+import threading
+import time
+
+DEFAULT_SPEC = 'off'  # or e.g. 'msg=10/20,dm=10/20,who=1/5': command=tokens per second/burst
+
+SERVER_FULL = b"ERR server-full\n"
+TOO_MANY_FROM_ADDRESS = b"ERR too-many-connections\n"
+
+
+class TokenBucket:
+    """Allows `burst` commands at once and `rate` per second after that"""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def take(self):
+        """Spend one token; returns False if none is left"""
+        now = time.monotonic()
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.stamp = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+
+def parse_limits(spec):
+    """'msg=10/20,who=1/5' -> {'MSG': (10.0, 20), 'WHO': (1.0, 5)}.
+
+    The burst defaults to the rate; a rate of 0 turns the limit off, as
+    does a spec of 'off'.
+    """
+    limits = {}
+    if spec.strip().lower() == 'off':
+        return limits
+    for part in spec.split(','):
+        command, _, value = part.partition('=')
+        rate, _, burst = value.partition('/')
+        rate = float(rate)
+        burst = int(burst) if burst else max(1, int(rate))
+        if rate < 0 or burst < 1:
+            raise ValueError(f"bad limit '{part.strip()}'")
+        if rate:
+            limits[command.strip().upper()] = (rate, burst)
+    return limits
+
+
+class RateLimits:
+    """Per-command limits, handing out buckets to each new connection"""
+
+    def __init__(self, limits=None):
+        self.limits = parse_limits(DEFAULT_SPEC) if limits is None else dict(limits)
+
+    def buckets(self):
+        """Fresh {command: TokenBucket} for one connection"""
+        return {command: TokenBucket(rate, burst)
+                for command, (rate, burst) in self.limits.items()}
+
+
+class ConnectionLimiter:
+    """Counts open connections in total and per client address"""
+
+    def __init__(self, max_connections=0, per_address=0):
+        self.max_connections = max_connections  # 0 = unlimited
+        self.per_address = per_address  # 0 = unlimited
+        self.open = 0
+        self.by_address = {}  # {ip: open connections}, only while per_address is set
+        self._lock = threading.Lock()
+
+    def admit(self, address):
+        """Count a new connection from address (an IP string).
+
+        Returns None if it may stay, otherwise the ERR line to send it
+        before closing it.
+        """
+        with self._lock:
+            if self.max_connections and self.open >= self.max_connections:
+                return SERVER_FULL
+            if self.per_address:
+                count = self.by_address.get(address, 0)
+                if count >= self.per_address:
+                    return TOO_MANY_FROM_ADDRESS
+                self.by_address[address] = count + 1
+            self.open += 1
+        return None
+
+    def release(self, address):
+        """Forget a connection admit() let in"""
+        with self._lock:
+            self.open -= 1
+            if self.per_address:
+                count = self.by_address.get(address, 0) - 1
+                if count > 0:
+                    self.by_address[address] = count
+                else:
+                    self.by_address.pop(address, None)
+
+
+def reject(sock, reply):
+    """Send a refused connection its ERR line without blocking, then close it"""
+    try:
+        sock.setblocking(False)
+        sock.send(reply)
+    except OSError:
+        pass
+    try:
+        sock.close()
+    except OSError:
+        pass
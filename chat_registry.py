@@ -0,0 +1,89 @@
+"""Registry of logged-in chat users with lock-free reads.
+
+Logins and logouts are rare next to MSG traffic, so the registry makes
+them pay: each mutation takes a private lock, copies the current state
+and publishes a new immutable snapshot with a single reference swap.
+Broadcasts, WHO and DM lookups read whatever snapshot is current without
+taking any lock, and never observe a half-applied change.
+"""
+
+import bisect
+import threading
+import types
+
+
+class RegistrySnapshot:
+    """Immutable view of the connected users at one point in time"""
+    __slots__ = ('by_name', 'connections', 'names')
+
+    def __init__(self, by_name, names=()):
+        self.by_name = types.MappingProxyType(by_name)  # {username: connection}
+        self.connections = tuple(by_name.values())
+        self.names = names  # sorted tuple of usernames
+
+    def __len__(self):
+        return len(self.connections)
+
+
+class ClientRegistry:
+    """Username <-> connection mapping published as copy-on-write snapshots"""
+
+    def __init__(self, lock=None):
+        # Serializes writers only; pass a lock of your own to instrument it
+        self._lock = lock if lock is not None else threading.Lock()
+        self._names = {}  # {connection: username}, private to writers
+        self.snapshot = RegistrySnapshot({})
+
+    def add(self, username, conn):
+        """Register conn under username; returns False if the name is taken"""
+        with self._lock:
+            current = self.snapshot.by_name
+            if username in current or conn in self._names:
+                return False
+            by_name = dict(current)
+            by_name[username] = conn
+            self._names[conn] = username
+            names = list(self.snapshot.names)
+            bisect.insort(names, username)
+            self.snapshot = RegistrySnapshot(by_name, tuple(names))
+        return True
+
+    def add_all(self, entries):
+        """Register many (username, conn) pairs with a single new snapshot.
+
+        Returns the pairs that were not added because the name was taken.
+        """
+        refused = []
+        with self._lock:
+            by_name = dict(self.snapshot.by_name)
+            for username, conn in entries:
+                if username in by_name or conn in self._names:
+                    refused.append((username, conn))
+                    continue
+                by_name[username] = conn
+                self._names[conn] = username
+            self.snapshot = RegistrySnapshot(by_name, tuple(sorted(by_name)))
+        return refused
+
+    def remove(self, conn):
+        """Unregister conn; returns its username, or None if it was unknown"""
+        with self._lock:
+            username = self._names.pop(conn, None)
+            if username is None:
+                return None
+            by_name = dict(self.snapshot.by_name)
+            del by_name[username]
+            names = list(self.snapshot.names)
+            del names[bisect.bisect_left(names, username)]
+            self.snapshot = RegistrySnapshot(by_name, tuple(names))
+        return username
+
+    def lookup(self, username):
+        """Connection logged in as username, or None"""
+        return self.snapshot.by_name.get(username)
+
+    def __contains__(self, username):
+        return username in self.snapshot.by_name
+
+    def __len__(self):
+        return len(self.snapshot)
@@ -0,0 +1,108 @@
+"""Chat rooms for the AlgoKart chat server.
+
+RoomIndex keeps two indexes, room -> members and member -> rooms, so
+JOIN, PART and the cleanup on disconnect are O(1) per room, and a room
+message touches only that room's members. Each room also caches an
+immutable tuple of its members for fan-out. The tuple is rebuilt only
+after a membership change, so broadcasting to a stable room copies
+nothing and takes no lock.
+"""
+
+import threading
+
+MAX_ROOM_NAME = 32  # characters, including the leading '#'
+
+
+def normalize_room(name):
+    """Return the canonical '#name' form, or None if name is not valid"""
+    if not name.startswith('#'):
+        name = '#' + name
+    body = name[1:]
+    if not body or len(name) > MAX_ROOM_NAME:
+        return None
+    if not body.replace('_', '').replace('-', '').isalnum():
+        return None
+    return name.lower()
+
+
+class Room:
+    __slots__ = ('name', 'members', 'snapshot')
+
+    def __init__(self, name):
+        self.name = name
+        self.members = set()
+        self.snapshot = ()  # tuple of members, None after a change
+
+
+class RoomIndex:
+    """Room membership indexed in both directions"""
+
+    def __init__(self, lock=None):
+        # Serializes membership changes; pass a lock of your own to instrument it
+        self._lock = lock if lock is not None else threading.Lock()
+        self.rooms = {}  # {room name: Room}
+        self._rooms_of = {}  # {member: set of room names}
+
+    def join(self, room_name, member):
+        """Add member to room_name; returns False if it already was in it"""
+        with self._lock:
+            room = self.rooms.get(room_name)
+            if room is None:
+                room = self.rooms[room_name] = Room(room_name)
+            if member in room.members:
+                return False
+            room.members.add(member)
+            room.snapshot = None
+            self._rooms_of.setdefault(member, set()).add(room_name)
+        return True
+
+    def part(self, room_name, member):
+        """Remove member from room_name; returns False if it was not in it"""
+        with self._lock:
+            return self._part(room_name, member)
+
+    def part_all(self, member):
+        """Remove member from every room; returns the names it left"""
+        with self._lock:
+            joined = tuple(self._rooms_of.get(member, ()))
+            for room_name in joined:
+                self._part(room_name, member)
+        return joined
+
+    def _part(self, room_name, member):
+        room = self.rooms.get(room_name)
+        if room is None or member not in room.members:
+            return False
+        room.members.discard(member)
+        room.snapshot = None
+        if not room.members:
+            del self.rooms[room_name]
+        joined = self._rooms_of[member]
+        joined.discard(room_name)
+        if not joined:
+            del self._rooms_of[member]
+        return True
+
+    def members(self, room_name):
+        """Immutable tuple of room_name's current members (empty if none)"""
+        room = self.rooms.get(room_name)
+        if room is None:
+            return ()
+        snapshot = room.snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = room.snapshot
+                if snapshot is None:
+                    snapshot = room.snapshot = tuple(room.members)
+        return snapshot
+
+    def is_member(self, room_name, member):
+        return room_name in self._rooms_of.get(member, ())
+
+    def rooms_of(self, member):
+        return tuple(self._rooms_of.get(member, ()))
+
+    def counts(self):
+        """{room name: member count} for every non-empty room"""
+        with self._lock:
+            return {name: len(room.members) for name, room in self.rooms.items()}
@@ -1,165 +1,183 @@
 import socket
 import threading
 import sys
-import time
+
+from chat_commands import (CommandTable, add_standard_commands, validate_username, WELCOME_BANNER,
+                           OK, ERR_USERNAME_TAKEN, ERR_USER_NOT_FOUND, ERR_LINE_TOO_LONG,
+                           ERR_INVALID_ENCODING, ERR_DM_FORMAT, ERR_WHO_FORMAT, ARG_REQUIRED,
+                           LOGGED_OUT)
+from chat_framing import LineFramer, LINE_TOO_LONG
+from chat_logging import AsyncLogger, DEBUG, INFO, WARNING, ERROR
+from chat_ratelimit import ConnectionLimiter, reject
+from chat_registry import ClientRegistry
+from chat_who import WhoIndex, who_reply
 
 DEFAULT_PORT = 4000
-BUFFER_SIZE = 1024
+BUFFER_SIZE = 4096
+MAX_LINE_LENGTH = 4096
+MAX_CONNECTIONS = 1000  # one thread each; more are refused with ERR server-full
+
+registry = ClientRegistry()
+admission = ConnectionLimiter(MAX_CONNECTIONS)
+who_index = WhoIndex()
+commands = CommandTable()  # verb -> handler, filled in below handle_command()
+
+# The debug server logs everything, but from a background thread
+logger = AsyncLogger(level=DEBUG)
+
+def log(message, level=INFO, sample=False):
+    logger.log(message, level=level, sample=sample)
 
-clients = {}
-usernames = {}
-lock = threading.Lock()
+class DebugConnection:
+    """A client socket with what chat_commands handlers expect of a connection"""
+    __slots__ = ('sock', 'address', 'username')
 
-def log(message):
-    print(f"[{time.strftime('%H:%M:%S')}] {message}")
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.username = None
 
-def broadcast_message(message, sender_socket=None):
+    def send(self, data):
+        self.sock.sendall(data)
+
+def broadcast_message(message, sender=None):
     """Send message to all connected clients except sender"""
-    with lock:
-        for client_socket in clients:
-            if client_socket != sender_socket:
-                try:
-                    log(f"Broadcasting to {clients[client_socket]}: {message.strip()}")
-                    client_socket.send(message.encode('utf-8'))
-                except Exception as e:
-                    log(f"Failed to send to {clients[client_socket]}: {e}")
+    data = message.encode('utf-8')
+    recipients = 0
+    for user, conn in registry.snapshot.by_name.items():
+        if conn is not sender:
+            try:
+                conn.send(data)
+                recipients += 1
+            except Exception as e:
+                log(f"Failed to send to {user}: {e}", WARNING)
+    # One line per broadcast, not per recipient
+    log(f"Broadcast to {recipients} users: {message.strip()}", DEBUG, sample=True)
+
+def handle_command(conn, data):
+    """Execute one command line"""
+    log(f"Received from {conn.username or conn.address}: '{data}'", DEBUG, sample=True)
+    verb, _, arg = data.partition(' ')
+    commands.dispatch(conn, verb.upper(), arg)
+
+@commands.command('LOGIN', ARG_REQUIRED, LOGGED_OUT, "LOGIN <username> - Login with username")
+def do_login(conn, arg):
+    requested_username = arg.strip()
+    response = validate_username(requested_username)
+    if response is not None:
+        log(f"Login failed for {requested_username} - invalid username")
+    elif not registry.add(requested_username, conn):
+        response = ERR_USERNAME_TAKEN
+        log(f"Login failed for {requested_username} - username taken")
+    else:
+        conn.username = requested_username
+        response = OK
+        log(f"Login successful for {requested_username}")
+
+    conn.send(response)
+
+    if conn.username:
+        # Notify others
+        broadcast_message(f"INFO {conn.username} joined the chat\n", conn)
+
+@commands.command('MSG', ARG_REQUIRED, help="MSG <message> - Send message to all")
+def do_msg(conn, arg):
+    broadcast_message(f"MSG {conn.username} {arg}\n", conn)
+    log(f"Message from {conn.username}: {arg}", sample=True)
+
+@commands.command('WHO', help="WHO [<offset> <limit> | <prefix>*] - List online users")
+def do_who(conn, arg):
+    listing = who_index.listing(registry.snapshot.names)
+    response = who_reply(listing, arg.strip())
+    if response is None:
+        conn.send(ERR_WHO_FORMAT)
+    else:
+        conn.send(response)
+        log(f"Sent user list ({len(listing)} users) to {conn.username}", DEBUG)
+
+@commands.command('DM', ARG_REQUIRED, help="DM <username> <message> - Send private message")
+def do_dm(conn, arg):
+    dm_parts = arg.split(' ', 1)
+    if len(dm_parts) < 2:
+        conn.send(ERR_DM_FORMAT)
+        return
+    target_user, dm_message = dm_parts
+    target = registry.lookup(target_user)
+    if target is not None:
+        target.send(f"DM {conn.username} {dm_message}\n".encode('utf-8'))
+        conn.send(OK)
+        log(f"DM from {conn.username} to {target_user}: {dm_message}", sample=True)
+    else:
+        conn.send(ERR_USER_NOT_FOUND)
+        log(f"DM failed - {target_user} not found")
+
+add_standard_commands(commands)
 
 def handle_client(client_socket, client_address):
-    username = None
+    conn = DebugConnection(client_socket, client_address)
+    framer = LineFramer(MAX_LINE_LENGTH)
     
     try:
         # Send welcome
-        client_socket.send(b"Welcome to AlgoKart Chat Server!\n")
-        client_socket.send(b"Please login with: LOGIN <username>\n")
+        conn.send(WELCOME_BANNER)
         
         while True:
             try:
-                data = client_socket.recv(BUFFER_SIZE).decode('utf-8').strip()
+                chunk = client_socket.recv(BUFFER_SIZE)
                 
-                if not data:
+                if not chunk:
                     break
                 
-                log(f"Received from {client_address}: '{data}'")
-                parts = data.split(' ', 1)
-                command = parts[0].upper()
-                
-                # LOGIN command
-                if command == "LOGIN" and len(parts) > 1 and not username:
-                    requested_username = parts[1].strip()
-                    
-                    with lock:
-                        if requested_username in usernames:
-                            response = "ERR username-taken\n"
-                            log(f"Login failed for {requested_username} - username taken")
-                        else:
-                            username = requested_username
-                            clients[client_socket] = username
-                            usernames[username] = client_socket
-                            response = "OK\n"
-                            log(f"Login successful for {username}")
-                    
-                    client_socket.send(response.encode('utf-8'))
-                    
-                    if username:
-                        # Notify others
-                        broadcast_message(f"INFO {username} joined the chat\n", client_socket)
-                
-                elif not username:
-                    response = "ERR not-logged-in\n"
-                    client_socket.send(response.encode('utf-8'))
-                    log(f"Command rejected - user not logged in")
-                
-                # MSG command
-                elif command == "MSG" and len(parts) > 1:
-                    message = parts[1]
-                    broadcast_msg = f"MSG {username} {message}\n"
-                    broadcast_message(broadcast_msg, client_socket)
-                    log(f"Message from {username}: {message}")
-                
-                # WHO command
-                elif command == "WHO":
-                    with lock:
-                        response = f"INFO {len(usernames)} users online\n"
-                        client_socket.send(response.encode('utf-8'))
-                        for user in usernames:
-                            response = f"USER {user}\n"
-                            client_socket.send(response.encode('utf-8'))
-                            log(f"Sent user list to {username}: {user}")
-                
-                # PING command
-                elif command == "PING":
-                    client_socket.send(b"PONG\n")
-                    log(f"PONG sent to {username}")
-                
-                # HELP command
-                elif command == "HELP":
-                    help_text = """Available commands:
-LOGIN <username> - Login with username
-MSG <message> - Send message to all
-WHO - List online users
-PING - Check connection
-HELP - Show this help
-"""
-                    client_socket.send(help_text.encode('utf-8'))
-                    log(f"HELP sent to {username}")
-                
-                # DM command
-                elif command == "DM" and len(parts) > 1:
-                    dm_parts = parts[1].split(' ', 1)
-                    if len(dm_parts) >= 2:
-                        target_user = dm_parts[0]
-                        dm_message = dm_parts[1]
-                        
-                        with lock:
-                            if target_user in usernames:
-                                target_socket = usernames[target_user]
-                                dm_msg = f"DM {username} {dm_message}\n"
-                                target_socket.send(dm_msg.encode('utf-8'))
-                                client_socket.send(b"OK\n")
-                                log(f"DM from {username} to {target_user}: {dm_message}")
-                            else:
-                                client_socket.send(b"ERR user-not-found\n")
-                                log(f"DM failed - {target_user} not found")
-                    else:
-                        client_socket.send(b"ERR invalid-format\n")
-                
-                else:
-                    client_socket.send(b"ERR unknown-command\n")
-                    log(f"Unknown command from {username}: {command}")
+                for line in framer.feed(chunk):
+                    if line is LINE_TOO_LONG:
+                        conn.send(ERR_LINE_TOO_LONG)
+                        log(f"Line too long from {conn.username or client_address}")
+                        continue
+                    try:
+                        data = line.decode('utf-8').strip()
+                    except UnicodeDecodeError:
+                        conn.send(ERR_INVALID_ENCODING)
+                        continue
+                    if data:
+                        handle_command(conn, data)
                     
             except Exception as e:
-                log(f"Error handling {username or client_address}: {e}")
+                log(f"Error handling {conn.username or client_address}: {e}", ERROR)
                 break
                 
     except Exception as e:
-        log(f"Fatal error with {username or client_address}: {e}")
+        log(f"Fatal error with {conn.username or client_address}: {e}", ERROR)
     finally:
         # Cleanup
-        if username:
-            with lock:
-                if client_socket in clients:
-                    del clients[client_socket]
-                    del usernames[username]
+        if conn.username:
+            registry.remove(conn)
             
-            broadcast_message(f"INFO {username} disconnected\n")
-            log(f"{username} disconnected")
+            broadcast_message(f"INFO {conn.username} disconnected\n")
+            log(f"{conn.username} disconnected")
         
         client_socket.close()
+        admission.release(client_address[0])
 
 def main():
     port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
     
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    logger.start()
     
     try:
         server_socket.bind(('', port))
-        server_socket.listen(10)
+        server_socket.listen(socket.SOMAXCONN)
         log(f"Chat server started on port {port}")
         
         while True:
             try:
                 client_socket, client_address = server_socket.accept()
+                reply = admission.admit(client_address[0])
+                if reply is not None:
+                    reject(client_socket, reply)
+                    log(f"Refused connection from {client_address}: server full", WARNING)
+                    continue
                 log(f"New connection from {client_address}")
                 
                 thread = threading.Thread(target=handle_client, args=(client_socket, client_address))
@@ -172,6 +190,7 @@ def main():
     finally:
         server_socket.close()
         log("Server stopped")
+        logger.close()
 
 if __name__ == "__main__":
     main()
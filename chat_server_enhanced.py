@@ -1,12 +1,62 @@
+import argparse
+import collections
+import select
+import selectors
+import signal
 import socket
 import threading
-import sys
 import time
 import os
+import zlib
+
+from chat_commands import (CommandTable, add_standard_commands, validate_username, WELCOME_BANNER,
+                           OK, PONG, ERR_NOT_LOGGED_IN, ERR_USERNAME_TAKEN, ERR_USER_NOT_FOUND,
+                           ERR_LINE_TOO_LONG, ERR_INVALID_ENCODING, ERR_NOT_AUTHORIZED,
+                           ERR_DM_FORMAT, NO_ARGS, ARG_REQUIRED, LOGGED_OUT, EITHER)
+from chat_federation import Federation
+from chat_framing import LineFramer, LINE_TOO_LONG
+from chat_binary import (BinaryCodec, USER_ID, OP_LOGIN, OP_MSG, OP_ROOM_MSG, OP_DM, OP_PING,
+                         OP_TEXT, is_valid_text, user_ids)
+from chat_logging import AsyncLogger, LEVELS, INFO, WARNING, ERROR
+from chat_mailbox import Mailbox
+from chat_handoff import (hand_off, take_over, listen as listen_for_handoff, encode_bytes,
+                          decode_bytes, supported as handoff_supported)
+from chat_metrics import Metrics, SIZE_BUCKETS, serve_http
+from chat_history import HistoryRing, SegmentLog, DEFAULT_CAPACITY as HISTORY_CAPACITY
+from chat_profiling import Profiler, Tracer, MODES as PROFILE_MODES, SAMPLE, CPROFILE
+from chat_presence import (PresenceAggregator, event_line, digest_line, JOINED, LEFT, DIGEST,
+                           FULL, MODES, DEFAULT_WINDOW as PRESENCE_WINDOW)
+from chat_ratelimit import (RateLimits, ConnectionLimiter, parse_limits, reject, DEFAULT_SPEC,
+                            SERVER_FULL, TOO_MANY_FROM_ADDRESS)
+from chat_registry import ClientRegistry
+from chat_who import WhoIndex, WhoListing, who_reply
+from chat_rooms import RoomIndex, normalize_room
+from chat_timers import IdleWheel
+from chat_workers import run_workers, supported as workers_supported
+from chat_outbox import (Outbox, OutboundWriter, coalesced_writes, pending_batch,
+                         DEFAULT_HIGH_WATER, DISCONNECT, POLICIES, SLOW_CONSUMER_NOTICE)
 
 # Server configuration
 DEFAULT_PORT = 4000
-BUFFER_SIZE = 1024
+BUFFER_SIZE = 4096
+MAX_LINE_LENGTH = 4096  # longest accepted command line in bytes
+IDLE_TIMEOUT = 60  # seconds without activity before a user is disconnected (0 = never)
+IDLE_CHECK_INTERVAL = 1  # idle expiry precision in seconds
+LISTEN_BACKLOG = socket.SOMAXCONN  # a short backlog drops SYNs during connect storms
+OUTBOX_HIGH_WATER = DEFAULT_HIGH_WATER  # bytes queued per client before it counts as slow
+SLOW_CONSUMER_POLICY = DISCONNECT  # or DROP_OLDEST
+COMPRESS_LEVEL = 6  # zlib level for COMPRESS connections
+INFLATE_CHUNK = 65536  # decompressed bytes processed at a time
+HELD_INPUT_LIMIT = 65536  # bytes a client may send while its LOGIN awaits another node
+HISTORY_DEFAULT = 20  # messages replayed by a bare HISTORY
+HISTORY_MAX = 1000  # most messages a single HISTORY may ask for
+BACKLOG_LOW_WATER = 64 * 1024  # queued bytes below which more offline DMs are read in
+PROFILE_SECONDS = 30  # length of a PROFILE start or SIGUSR1 run without a duration
+PROFILE_MAX_SECONDS = 600  # longest run PROFILE start accepts
+PROFILE_MODE = SAMPLE  # or CPROFILE (event loop engine only)
+ERR_ROOM_NAME = b"ERR room-invalid (#name, alphanumeric, '_' and '-', max 32 chars)\n"
+COMMANDS = ('LOGIN', 'MSG', 'JOIN', 'PART', 'ROOMS', 'WHO', 'DM', 'HISTORY', 'STATS', 'PING', 'HELP',
+            'BINARY', 'COMPRESS', 'PRESENCE', 'PROFILE')
 
 # ANSI color codes for better server logs (works in modern terminals)
 class Colors:
@@ -18,270 +68,1765 @@ class Colors:
     RESET = '\033[0m'
     BOLD = '\033[1m'
 
-# Global dictionaries to track connected clients
-clients = {}  # {socket: username}
-usernames = {}  # {username: socket}
-user_activity = {}  # {socket: last_activity_time}
-lock = threading.Lock()
+# Instrumentation, read by STATS and the --metrics-port listener
+metrics = Metrics()
+connections_opened = metrics.counter('chat_connections_total')
+connections_closed = metrics.counter('chat_disconnections_total')
+bytes_received = metrics.counter('chat_received_bytes_total')
+bytes_sent = metrics.counter('chat_sent_bytes_total')
+idle_evictions = metrics.counter('chat_idle_evictions_total')
+slow_consumer_evictions = metrics.counter('chat_slow_consumer_evictions_total')
+command_counts = {name: metrics.counter('chat_commands_total', command=name.lower())
+                  for name in COMMANDS}
+other_commands = metrics.counter('chat_commands_total', command='other')
+command_latency = metrics.histogram('chat_command_seconds')
+fanout_latency = metrics.histogram('chat_fanout_seconds', scope='global')
+room_fanout_latency = metrics.histogram('chat_fanout_seconds', scope='room')
+flush_sizes = metrics.histogram('chat_outbox_flush_bytes', SIZE_BUCKETS)
+deflate_in = metrics.counter('chat_deflate_input_bytes_total')
+deflate_out = metrics.counter('chat_deflate_output_bytes_total')
+rate_limited = {name: metrics.counter('chat_rate_limited_total', command=name.lower())
+                for name in COMMANDS}
+# Replies in order, so naming the command tells a pipelining client which one was refused
+RATE_LIMITED_REPLIES = {name: f"ERR rate-limited ({name})\n".encode('utf-8') for name in COMMANDS}
+rejected_connections = {SERVER_FULL: metrics.counter('chat_rejected_connections_total',
+                                                     reason='server-full'),
+                        TOO_MANY_FROM_ADDRESS: metrics.counter('chat_rejected_connections_total',
+                                                               reason='per-ip')}
+
+# Logged-in clients; broadcasts read its snapshots without locking
+registry = ClientRegistry(metrics.timed_lock('registry'))
+rooms = RoomIndex(metrics.timed_lock('rooms'))
+admins = frozenset()  # usernames allowed to run STATS (--admin)
+who_index = WhoIndex()  # cached WHO response, rebuilt when users come or go
+commands = CommandTable()  # verb -> handler, filled in below handle_command()
+rate_limits = RateLimits()  # per-user command token buckets (--rate-limit)
+admission = ConnectionLimiter()  # --max-connections and --max-per-ip
+presence = PresenceAggregator(PRESENCE_WINDOW)  # joins/leaves awaiting announcement
+profiler = Profiler()  # PROFILE start/stop and SIGUSR1 (--profile-dir)
+tracer = Tracer()  # parse/dispatch/lock/fan-out/send spans (--trace, PROFILE trace on)
+for timed_lock in metrics.locks:
+    timed_lock.observer = lambda name, started, waited: tracer.record('lock wait', started,
+                                                                      waited, name)
+
+metrics.gauge('chat_users_online', lambda: len(registry))
+metrics.gauge('chat_connections_open', lambda: connections_opened.value - connections_closed.value)
+metrics.gauge('chat_outbox_queued_bytes_max',
+              lambda: max((conn.outbox.queued for conn in registry.snapshot.connections), default=0))
+metrics.gauge('chat_outbox_queued_bytes_total',
+              lambda: sum(conn.outbox.queued for conn in registry.snapshot.connections))
+idle_wheel = None  # IdleWheel tracking logged-in clients, created in main()
+cluster = None  # WorkerBus (--workers) or Federation (--federation) linking us to the others
+history = None  # HistoryRing of recent lobby messages (--history 0 disables)
+mailbox = None  # Mailbox of offline DMs (--mailbox-dir)
+
+# Writes log lines from a background thread once started in main()
+logger = AsyncLogger()
+
+def log(message, color=Colors.RESET, level=INFO, sample=False):
+    """Queue a colored log line; sample marks per-message events (--log-sample)"""
+    logger.log(message, color, level, sample)
+
+
+class ClientConnection:
+    """A connected client as seen by the command handlers.
+
+    Each engine provides its own subclass implementing send() and close()
+    for its I/O model, so the protocol code never touches raw sockets.
+    Output always goes through the connection's bounded Outbox, so a slow
+    reader can never block the thread that is sending to it. Everything is
+    sent as text protocol lines; a connection in binary mode (codec set)
+    converts them to frames on the way into its outbox.
+    """
+    __slots__ = ('sock', 'address', 'username', 'framer', 'outbox', 'closed', 'evicted',
+                 'close_reason', 'last_activity', 'codec', 'inflater', 'buckets', 'presence',
+                 'backlog', 'held')
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.username = None
+        self.framer = LineFramer(MAX_LINE_LENGTH)
+        self.outbox = Outbox(OUTBOX_HIGH_WATER, SLOW_CONSUMER_POLICY)
+        self.closed = False
+        self.evicted = False
+        self.close_reason = None  # logged by the disconnect hang_up() leads to
+        self.last_activity = time.monotonic()
+        self.codec = None  # BinaryCodec once the client sent BINARY
+        self.inflater = None  # zlib decompressobj once the client sent COMPRESS
+        self.buckets = {}  # {command: TokenBucket}, handed out at login
+        self.presence = DIGEST  # or FULL: every join/leave line (PRESENCE full)
+        self.backlog = None  # mailbox Backlog while offline DMs are being delivered
+        self.held = None  # input received while a LOGIN awaits the cluster
+
+    def send(self, data):
+        raise NotImplementedError
+
+    def hang_up(self):
+        """Have the engine disconnect this client once it is safe to"""
+        raise NotImplementedError
+
+    def hold_input(self):
+        """Keep later input (decompressed, unparsed) until resume_input()"""
+        self.held = bytearray()
+
+    def resume_input(self):
+        """Have the engine run the held input; safe from any thread"""
+        raise NotImplementedError
+
+    def eviction_notice(self):
+        notice = self.outbox.eviction_notice()
+        if self.codec is not None:
+            notice = self.codec.encode(SLOW_CONSUMER_NOTICE)
+        if self.outbox.compressor is not None:
+            notice = self.outbox.deflate(notice)
+        return notice
+
+    def start_backlog(self, backlog):
+        """Announce backlog and deliver it from now on; returns False if
+        the connection is gone"""
+        if self.closed or self.username != backlog.username:
+            return False
+        self.send(f"INFO {backlog.count} offline messages\n".encode('utf-8'))
+        self.backlog = backlog
+        return True
+
+    def take_backlog(self):
+        """Stop delivering offline DMs; returns the Backlog to finish, if any"""
+        backlog, self.backlog = self.backlog, None
+        return backlog
+
+    def feed_backlog(self):
+        """Queue more offline DMs while the outbox is nearly empty"""
+        backlog = self.backlog
+        while backlog is not None and not self.closed and self.outbox.queued < BACKLOG_LOW_WATER:
+            chunk = backlog.read()
+            if not chunk:
+                self.backlog = None
+                mailbox.finish(backlog)
+                return
+            if self.codec is None:
+                self.send(chunk)
+            else:
+                # Line by line, so whole chunks don't crowd the frame cache
+                for line in chunk.splitlines(keepends=True):
+                    self.send(line)
+
+    def write_outbox(self):
+        """Write queued output without blocking; returns True once drained"""
+        outbox = self.outbox
+        queued, sent = outbox.queued, outbox.sent
+        deflated_in, deflated_out = outbox.deflated_in, outbox.deflated_out
+        with tracer.span('send'):
+            drained = outbox.write_to(self.sock)
+        bytes_sent.value += outbox.sent - sent
+        flush_sizes.observe(queued)
+        if outbox.compressor is not None:
+            deflate_in.value += outbox.deflated_in - deflated_in
+            deflate_out.value += outbox.deflated_out - deflated_out
+        return drained
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        connections_closed.value += 1
+        admission.release(self.address[0])
+        if self.outbox:
+            # Best effort: push out final notices such as idle-timeout
+            try:
+                self.write_outbox()
+            except OSError:
+                pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ThreadedConnection(ClientConnection):
+    """Connection served by a dedicated reader thread.
+
+    The socket is non-blocking: senders queue into the outbox and write
+    what the kernel accepts right away, leaving any backlog to the shared
+    OutboundWriter thread.
+    """
+    __slots__ = ('writer', 'wlock', 'feeding', 'resumed')
+
+    def __init__(self, sock, address, writer):
+        super().__init__(sock, address)
+        self.writer = writer
+        self.wlock = threading.Lock()
+        self.feeding = threading.Lock()
+        self.resumed = threading.Event()
+        sock.setblocking(False)
+
+    def send(self, data):
+        with self.wlock:
+            if self.closed or self.evicted:
+                return
+            if self.codec is not None:
+                data = self.codec.encode(data)
+            if not self.outbox.push(data):
+                self._evict()
+                return
+            if len(self.outbox) > 1:
+                return  # an earlier chunk's flush will carry this one too
+        batch = pending_batch()
+        if batch is not None:
+            batch.append(self)
+        else:
+            self.flush_or_watch()
+
+    def flush_or_watch(self):
+        """Write now, handing any remainder to the writer thread"""
+        if not self.flush():
+            self.writer.watch(self)
+
+    def flush(self):
+        """Called by the writer thread; returns True once nothing is pending"""
+        with self.wlock:
+            if self.closed or self.evicted:
+                return True
+            drained = self._write()
+        if drained and self.backlog is not None:
+            self.feed_backlog()
+        return drained
+
+    def feed_backlog(self):
+        # Reader, writer and mailbox threads may all get here: one feeds at
+        # a time, and it checks again after letting go in case a drain was
+        # missed meanwhile. The feeder's own sends come back here and return
+        while self.backlog is not None and self.feeding.acquire(blocking=False):
+            try:
+                super().feed_backlog()
+            finally:
+                self.feeding.release()
+            if self.outbox.queued >= BACKLOG_LOW_WATER:
+                return
+
+    def start_backlog(self, backlog):
+        with self.feeding:
+            return super().start_backlog(backlog)
 
-def log(message, color=Colors.RESET):
-    """Print colored log messages"""
-    timestamp = time.strftime("%H:%M:%S")
-    print(f"{color}[{timestamp}] {message}{Colors.RESET}")
+    def take_backlog(self):
+        # A writer or mailbox thread may still be reading the file
+        with self.feeding:
+            return super().take_backlog()
 
-def broadcast_message(message, sender_socket=None, exclude_sockets=None):
-    """Send message to all connected clients except sender and excluded sockets"""
+    def _write(self):
+        try:
+            return self.write_outbox()
+        except OSError:
+            self._abort()
+            return True
+
+    def _evict(self):
+        self.evicted = True
+        try:
+            self.sock.send(self.eviction_notice())
+        except OSError:
+            pass
+        self._abort()
+
+    def hang_up(self):
+        with self.wlock:
+            if not (self.closed or self.evicted):
+                self._write()  # last words such as an ERR line
+        self._abort()
+
+    def resume_input(self):
+        self.resumed.set()
+
+    def run_held(self):
+        """Reader thread: wait for resume_input(), then run the held input"""
+        self.resumed.wait()
+        self.resumed.clear()
+        held, self.held = self.held, None
+        if held:
+            with coalesced_writes():
+                process_data(self, bytes(held))
+
+    def _abort(self):
+        # Wake the reader thread with EOF; it performs the actual disconnect
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        with self.wlock:
+            super().close()
+        self.writer.wakeup()
+
+
+class LoopConnection(ClientConnection):
+    """Connection owned by the event loop.
+
+    Output queued while the loop handles a batch of events is flushed once
+    at the end of the batch, so every message a client received from that
+    batch leaves in a single vectored write. Anything the kernel does not
+    accept is retried when the selector reports the socket writable.
+    """
+    __slots__ = ('server', 'writing', 'dirty')
+
+    def __init__(self, sock, address, server):
+        super().__init__(sock, address)
+        self.server = server
+        self.writing = False
+        self.dirty = False
+
+    def send(self, data):
+        if self.closed or self.evicted:
+            return
+        if self.codec is not None:
+            data = self.codec.encode(data)
+        if not self.outbox.push(data):
+            self.evicted = True
+            try:
+                self.sock.send(self.eviction_notice())
+            except OSError:
+                pass
+            self.server.schedule_close(self)
+            return
+        if not self.dirty and not self.writing:
+            self.dirty = True
+            self.server.dirty.append(self)
+
+    def hang_up(self):
+        self.server.schedule_close(self)
+
+    def resume_input(self):
+        # Posted callbacks run on the loop thread, which owns the input
+        held, self.held = self.held, None
+        if held and not self.closed:
+            self.server.run_input(self, process_data, bytes(held))
+
+    def flush(self):
+        """Write as much queued output as the socket accepts"""
+        try:
+            drained = self.write_outbox()
+        except OSError:
+            self.server.schedule_close(self)
+            return True
+        if drained == self.writing:
+            self.writing = not drained
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if self.writing else selectors.EVENT_READ
+            self.server.selector.modify(self.sock, events, self)
+        if drained and self.backlog is not None:
+            self.feed_backlog()
+        return drained
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.server.selector.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass
+        super().close()
+
+
+def broadcast_message(message, sender_socket=None, exclude_sockets=None, local_only=False):
+    """Send message to all connected clients except sender and excluded sockets
+
+    In multi-worker mode the message is also published once to the other
+    workers, unless local_only is set (used when delivering their traffic).
+    """
+    started = time.perf_counter()
     if exclude_sockets is None:
-        exclude_sockets = []
-    
-    with lock:
-        dead_sockets = []
-        for client_socket in clients:
-            if client_socket != sender_socket and client_socket not in exclude_sockets:
-                try:
-                    client_socket.send(message.encode('utf-8'))
-                except:
-                    dead_sockets.append(client_socket)
-        
-        # Remove dead connections
-        for socket in dead_sockets:
-            remove_client(socket)
-
-def remove_client(client_socket):
-    """Remove a client from all tracking dictionaries"""
-    with lock:
-        if client_socket in clients:
-            username = clients[client_socket]
-            del clients[client_socket]
-            del usernames[username]
-            if client_socket in user_activity:
-                del user_activity[client_socket]
-            return username
-    return None
+        exclude_sockets = ()
+
+    # Encode once; every recipient's outbox shares the same bytes object
+    data = message.encode('utf-8') if isinstance(message, str) else message
+
+    # send() only queues, and failed connections are torn down by their
+    # engine later, so iterating the current snapshot needs no lock
+    with tracer.span('fan-out'):
+        for client_socket in registry.snapshot.connections:
+            if client_socket is not sender_socket and client_socket not in exclude_sockets:
+                client_socket.send(data)
+
+    if cluster is not None and not local_only:
+        cluster.publish(data)
+    fanout_latency.observe(time.perf_counter() - started)
+
+def broadcast_room(room, message, sender_socket=None, local_only=False):
+    """Send message to the members of room only"""
+    started = time.perf_counter()
+    data = message.encode('utf-8') if isinstance(message, str) else message
+
+    with tracer.span('fan-out', room):
+        for member in rooms.members(room):
+            if member is not sender_socket:
+                member.send(data)
+
+    if cluster is not None and not local_only:
+        cluster.publish(data, room)
+    room_fanout_latency.observe(time.perf_counter() - started)
+
+def room_member_names(room):
+    """Usernames in room, across all workers"""
+    names = [member.username for member in rooms.members(room)]
+    if cluster is not None:
+        names.extend(cluster.remote_rooms.get(room, ()))
+    return names
+
+def deliver_direct(username, data):
+    """Deliver a DM routed here from another worker"""
+    conn = registry.lookup(username)
+    if conn is not None:
+        conn.send(data)
+
+def disconnect_client(conn, reason=None):
+    """Remove a client, announce the departure and close its connection"""
+    if reason is None and conn.evicted:
+        reason = "slow consumer"
+    if reason is None:
+        reason = conn.close_reason
+    if conn.evicted and not conn.closed:
+        slow_consumer_evictions.value += 1
+    removed_user = registry.remove(conn)
+    if removed_user:
+        # Other workers drop the user from their room replicas on release
+        rooms.part_all(conn)
+        if cluster is not None:
+            cluster.release(removed_user)
+        announce_presence(removed_user, LEFT)
+        if reason:
+            log(f"User '{removed_user}' disconnected ({reason})", Colors.YELLOW, WARNING)
+        else:
+            log(f"User '{removed_user}' disconnected", Colors.YELLOW)
+    conn.close()
+    # After close(), so a backlog opened meanwhile is not started
+    backlog = conn.take_backlog()
+    if backlog is not None:
+        mailbox.finish(backlog)
+
+def expire_idle_clients():
+    """Disconnect every logged-in client idle for longer than IDLE_TIMEOUT"""
+    for conn in idle_wheel.advance():
+        idle_evictions.value += 1
+        conn.send(b"INFO idle-timeout\n")
+        # The threaded engine's reader thread may be inside the socket: let
+        # each engine disconnect the client from where it is safe to
+        conn.close_reason = "idle timeout"
+        conn.hang_up()
+
+def announce_presence(username, event):
+    """Queue a login or logout for the next presence flush"""
+    presence.record(username, event)
+    if presence.window <= 0:
+        flush_presence()
+
+def receive_presence(username, joined):
+    """A user logged in or out on another worker"""
+    announce_presence(username, JOINED if joined else LEFT)
+
+def flush_presence():
+    """Announce the joins and leaves collected during the presence window"""
+    events = presence.take()
+    if not events:
+        return
+    if len(events) == 1:
+        # A lone event goes out exactly as it always has, minus the joiner
+        username, event = events[0]
+        sender = registry.lookup(username) if event is JOINED else None
+        broadcast_message(event_line(username, event), sender, local_only=True)
+        return
+
+    started = time.perf_counter()
+    digest = digest_line(events)
+    joined = {username for username, event in events if event is JOINED}
+    own_digest = None  # for users whose own login is in the batch
+    detail = None
+    with tracer.span('fan-out', 'presence'):
+        for conn in registry.snapshot.connections:
+            if conn.presence is not FULL:
+                if conn.username not in joined:
+                    conn.send(digest)
+                    continue
+                # Leave out the recipient's own login; past two events
+                # that is the same line for every such recipient
+                if own_digest is None or len(events) == 2:
+                    own_digest = digest_line(events, conn.username)
+                conn.send(own_digest)
+                continue
+            if detail is None:
+                detail = {username: event_line(username, event) for username, event in events}
+                everything = b"".join(detail.values())
+            if conn.username in detail:
+                # Leave out the recipient's own login
+                conn.send(b"".join(line for username, line in detail.items()
+                                   if username != conn.username))
+            else:
+                conn.send(everything)
+    fanout_latency.observe(time.perf_counter() - started)
+
+def deliver_presence():
+    """Background thread flushing presence events (threaded engine)"""
+    while True:
+        time.sleep(presence.window)
+        flush_presence()
 
 def check_idle_clients():
     """Background thread to check for idle clients"""
     while True:
-        time.sleep(10)  # Check every 10 seconds
-        current_time = time.time()
-        idle_sockets = []
-        
-        with lock:
-            for socket, last_activity in user_activity.items():
-                if current_time - last_activity > 60:  # 60 second timeout
-                    idle_sockets.append(socket)
-        
-        for socket in idle_sockets:
+        time.sleep(max(0.0, idle_wheel.next_tick() - time.monotonic()))
+        expire_idle_clients()
+
+def as_text(text):
+    """Message text for a log line: binary clients pass UTF-8 bytes"""
+    return text if type(text) is str else text.decode('utf-8')
+
+def post_message(conn, line, text):
+    """Broadcast conn's encoded lobby MSG line and keep it in history.
+
+    text (str, or bytes from a binary client) is only decoded for the
+    log, and only if the record is kept (--log-sample).
+    """
+    broadcast_message(line, conn)
+    if history is not None:
+        history.append(line)
+    if logger.sample():
+        log(f"{conn.username}: {as_text(text)}", Colors.BLUE)
+
+def post_room_message(conn, room, line, text):
+    """Send conn's encoded MSG line to room, which conn must have joined"""
+    if not rooms.is_member(room, conn):
+        conn.send(b"ERR not-in-room (use JOIN #room first)\n")
+        return
+    broadcast_room(room, line, conn)
+    if logger.sample():
+        log(f"{conn.username} @ {room}: {as_text(text)}", Colors.BLUE)
+
+def send_direct(conn, target_user, line, text):
+    """Deliver conn's encoded DM line to target_user on any worker; text
+    as for post_message"""
+    if target_user == conn.username:
+        conn.send(b"ERR cannot-dm-self\n")
+        return
+    target_socket = registry.lookup(target_user)
+    if target_socket is not None:
+        target_socket.send(line)
+    elif cluster is not None and target_user in cluster.remote_names:
+        cluster.route_dm(target_user, line)
+    elif mailbox is not None and mailbox.is_known(target_user):
+        # Acknowledged once the message is on disk, without waiting here
+        mailbox.append(target_user, line, lambda stored: acknowledge_queued(conn, target_user,
+                                                                            stored))
+        if logger.sample():
+            log(f"DM: {conn.username} -> {target_user} (offline): {as_text(text)}", Colors.YELLOW)
+        return
+    else:
+        conn.send(ERR_USER_NOT_FOUND)
+        return
+    conn.send(OK)
+    if logger.sample():
+        log(f"DM: {conn.username} -> {target_user}: {as_text(text)}", Colors.YELLOW)
+
+def acknowledge_queued(conn, target_user, stored):
+    """Tell conn whether its DM to offline target_user was stored. Replies
+    to conn's later commands may have gone out first, hence the name"""
+    if stored:
+        conn.send(f"OK queued {target_user}\n".encode('utf-8'))
+    else:
+        conn.send(f"ERR not-queued {target_user}\n".encode('utf-8'))
+
+def throttled(conn, command):
+    """Whether conn is over its rate limit for command; tells it so if it is"""
+    bucket = conn.buckets.get(command)
+    if bucket is None or bucket.take():
+        return False
+    rate_limited[command].value += 1
+    conn.send(RATE_LIMITED_REPLIES[command])
+    return True
+
+def start_profile(seconds, mode):
+    """Start a profiler run; returns its output file, or None if one is running"""
+    path = profiler.start(seconds, mode)
+    if path is not None:
+        log(f"Profiling ({mode}) for {seconds:g}s to {path}", Colors.BLUE)
+    return path
+
+def toggle_profile():
+    """SIGUSR1: start a default run, or end the one in progress"""
+    if profiler.running:
+        log(f"Profile stopped: {profiler.stop()}", Colors.BLUE)
+    else:
+        start_profile(PROFILE_SECONDS, PROFILE_MODE)
+
+def dump_trace():
+    """SIGUSR2: write the trace ring to files"""
+    chrome, folded = tracer.dump(profiler.directory)
+    log(f"Trace of {len(tracer.spans)} spans written to {chrome} and {folded}", Colors.BLUE)
+
+def profile_command(args):
+    """Reply to PROFILE start [seconds] [sample|cprofile], stop, or trace on|off|dump"""
+    action = args[0].lower() if args else ''
+    if action == 'start' and len(args) <= 3:
+        seconds, mode = PROFILE_SECONDS, PROFILE_MODE
+        for arg in args[1:]:
+            if arg.isdigit() and int(arg) > 0:
+                seconds = min(int(arg), PROFILE_MAX_SECONDS)
+            elif arg.lower() in PROFILE_MODES:
+                mode = arg.lower()
+            else:
+                action = None
+        if action is not None:
+            if mode == CPROFILE and threading.current_thread() is not threading.main_thread():
+                # cProfile only sees the thread it starts on: the event loop's
+                return b"ERR cprofile-needs-eventloop (use sample)\n"
+            path = start_profile(seconds, mode)
+            if path is None:
+                return b"ERR profile-running\n"
+            return f"OK profiling {seconds:g}s to {path}\n".encode('utf-8')
+    elif action == 'stop' and len(args) == 1:
+        path = profiler.stop()
+        if path is None:
+            return b"ERR not-profiling\n"
+        return f"OK {path}\n".encode('utf-8')
+    elif action == 'trace' and len(args) == 2 and args[1].lower() in ('on', 'off'):
+        tracer.enabled = args[1].lower() == 'on'
+        return b"OK\n"
+    elif action == 'trace' and len(args) == 2 and args[1].lower() == 'dump':
+        chrome, folded = tracer.dump(profiler.directory)
+        return f"OK {chrome} {folded}\n".encode('utf-8')
+    return (b"ERR invalid-format (use PROFILE start [seconds] [sample|cprofile], PROFILE stop "
+            b"or PROFILE trace on|off|dump)\n")
+
+def install_profiling_signals():
+    """SIGUSR1 starts or stops a profiler run, SIGUSR2 dumps the trace ring"""
+    if not hasattr(signal, 'SIGUSR1'):
+        return  # Windows
+    try:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.post(toggle_profile))
+        signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.post(dump_trace))
+    except ValueError:
+        pass  # not the main thread
+
+def deliver_backlog(conn, backlog):
+    """Start streaming the offline DMs found at conn's login"""
+    if backlog is None:
+        return
+    if not conn.start_backlog(backlog):
+        mailbox.finish(backlog)  # gone already; nothing was handed out
+        return
+    conn.feed_backlog()
+    log(f"Delivering {backlog.count} offline messages to '{backlog.username}'", Colors.BLUE)
+
+def handle_command(conn, data):
+    """Parse and execute one command line received from a client"""
+    # Update activity timestamp; the idle wheel picks it up lazily
+    conn.last_activity = time.monotonic()
+
+    verb, _, arg = data.partition(' ')
+    command = verb.upper()
+    command_counts.get(command, other_commands).value += 1
+    tracer.annotate(command if command in command_counts else 'other')
+    commands.dispatch(conn, command, arg)
+
+# Command handlers, in HELP order. Each gets the connection and the rest
+# of the command line; see chat_commands for the rules the table applies
+# before calling one.
+
+@commands.command('LOGIN', ARG_REQUIRED, LOGGED_OUT, "LOGIN <username> - Login with a username")
+def do_login(conn, arg):
+    requested_username = arg.strip()
+    invalid = validate_username(requested_username)
+    if invalid is not None:
+        conn.send(invalid)
+        return
+    if cluster is None:
+        finish_login(conn, requested_username, True)
+        return
+    # The name's owner may be another node: input after the LOGIN waits
+    # for its answer, so the commands that follow run logged in
+    conn.hold_input()
+    cluster.claim(requested_username,
+                  lambda claimed: claim_answered(conn, requested_username, claimed))
+
+def claim_answered(conn, username, claimed):
+    finish_login(conn, username, claimed)
+    conn.resume_input()
+
+def finish_login(conn, requested_username, claimed):
+    """Log conn in once the cluster (if any) has claimed the name for it"""
+    if conn.closed:
+        if claimed and cluster is not None:
+            cluster.release(requested_username)
+    elif claimed is None:
+        # Federation: the node deciding on this name is unreachable
+        conn.send(b"ERR cluster-unavailable (try again later)\n")
+    elif not claimed:
+        conn.send(ERR_USERNAME_TAKEN)
+    elif not registry.add(requested_username, conn):
+        if cluster is not None:
+            cluster.release(requested_username)
+        conn.send(ERR_USERNAME_TAKEN)
+    else:
+        conn.username = requested_username
+        conn.buckets = rate_limits.buckets()
+        if idle_wheel is not None:
+            idle_wheel.schedule(conn)
+        conn.send(OK)
+        log(f"User '{requested_username}' logged in from {conn.address[0]}", Colors.GREEN)
+        if mailbox is not None:
+            mailbox.register(requested_username)
+            mailbox.open_backlog(requested_username,
+                                 lambda backlog: deliver_backlog(conn, backlog))
+
+        # Notify others, coalesced with other logins and logouts
+        announce_presence(requested_username, JOINED)
+
+@commands.command('MSG', ARG_REQUIRED, help="""
+MSG <message> - Send message to all users
+MSG #room <message> - Send message to a room you joined""")
+def do_msg(conn, arg):
+    # "MSG #room <message>" goes to one room only
+    username = conn.username
+    if arg.startswith('#'):
+        room_parts = arg.split(' ', 1)
+        room = normalize_room(room_parts[0])
+        if room is None or len(room_parts) < 2:
+            conn.send(b"ERR invalid-format (use MSG #room <message>)\n")
+        else:
+            line = f"MSG {room} {username} {room_parts[1]}\n".encode('utf-8')
+            post_room_message(conn, room, line, room_parts[1])
+    else:
+        post_message(conn, f"MSG {username} {arg}\n".encode('utf-8'), arg)
+
+@commands.command('JOIN', ARG_REQUIRED, help="JOIN #room - Join (or create) a room")
+def do_join(conn, arg):
+    room = normalize_room(arg.strip())
+    if room is None:
+        conn.send(ERR_ROOM_NAME)
+    elif not rooms.join(room, conn):
+        conn.send(b"ERR already-in-room\n")
+    else:
+        conn.send(OK)
+        if cluster is not None:
+            cluster.announce_join(room, conn.username)
+        broadcast_room(room, f"INFO {conn.username} joined {room}\n", conn)
+        log(f"User '{conn.username}' joined {room}", Colors.GREEN)
+
+@commands.command('PART', ARG_REQUIRED, help="PART #room - Leave a room")
+def do_part(conn, arg):
+    room = normalize_room(arg.strip())
+    if room is None:
+        conn.send(ERR_ROOM_NAME)
+    elif not rooms.part(room, conn):
+        conn.send(b"ERR not-in-room\n")
+    else:
+        conn.send(OK)
+        if cluster is not None:
+            cluster.announce_part(room, conn.username)
+        broadcast_room(room, f"INFO {conn.username} left {room}\n")
+        log(f"User '{conn.username}' left {room}", Colors.YELLOW)
+
+@commands.command('ROOMS', help="ROOMS - List rooms and their sizes")
+def do_rooms(conn, arg):
+    counts = rooms.counts()
+    if cluster is not None:
+        for room, members in cluster.remote_rooms.items():
+            counts[room] = counts.get(room, 0) + len(members)
+
+    conn.send(f"INFO {len(counts)} rooms\n".encode('utf-8'))
+    for room in sorted(counts):
+        conn.send(f"ROOM {room} {counts[room]}\n".encode('utf-8'))
+
+@commands.command('WHO', help="""
+WHO [#room] - List online users, or the members of a room
+WHO <offset> <limit> - List one page of online users
+WHO <prefix>* - List online users whose name starts with prefix""")
+def do_who(conn, arg):
+    # The global list comes pre-encoded from the WHO index ("WHO <offset>
+    # <limit>" pages it, "WHO <prefix>*" searches it); "WHO #room" lists
+    # one room from the room index
+    who_arg = arg.strip()
+    reply = None
+    if not who_arg.startswith('#'):
+        remote_names = cluster.remote_names if cluster is not None else None
+        listing = who_index.listing(registry.snapshot.names, remote_names)
+        reply = who_reply(listing, who_arg, conn.username)
+    if reply is None:
+        room = normalize_room(who_arg)
+        if room is None:
+            conn.send(b"ERR room-invalid\n")
+            return
+        listing = WhoListing(tuple(sorted(room_member_names(room))))
+        reply = (f"INFO {len(listing)} users in {room}\n".encode('utf-8')
+                 + listing.lines(0, len(listing), conn.username))
+    conn.send(reply)
+
+@commands.command('DM', ARG_REQUIRED,
+                  help="DM <username> <message> - Send private message (kept for offline users)")
+def do_dm(conn, arg):
+    dm_parts = arg.split(' ', 1)
+    if len(dm_parts) >= 2:
+        target_user, dm_message = dm_parts
+        send_direct(conn, target_user, f"DM {conn.username} {dm_message}\n".encode('utf-8'),
+                    dm_message)
+    else:
+        conn.send(ERR_DM_FORMAT)
+
+@commands.command('HISTORY', help="HISTORY [count] - Show recent messages (default 20)")
+def do_history(conn, arg):
+    # Replay the most recent lobby messages
+    count_arg = arg.strip()
+    if count_arg and not count_arg.isdigit():
+        conn.send(b"ERR invalid-format (use HISTORY [count])\n")
+        return
+    count = min(int(count_arg), HISTORY_MAX) if count_arg else HISTORY_DEFAULT
+    lines = history.last(count) if history is not None else []
+    conn.send(f"INFO {len(lines)} recent messages\n".encode('utf-8'))
+    if lines:
+        conn.send(b"".join(lines))
+
+@commands.command('STATS', help="STATS - Show server metrics (admins only)")
+def do_stats(conn, arg):
+    if conn.username not in admins:
+        conn.send(ERR_NOT_AUTHORIZED)
+        return
+    lines = metrics.stat_lines()
+    conn.send(f"INFO {len(lines)} stats\n".encode('utf-8'))
+    conn.send("".join(f"STAT {line}\n" for line in lines).encode('utf-8'))
+
+@commands.command('PROFILE', help="""
+PROFILE start [seconds] [sample|cprofile] - Profile the server to a file (admins only)
+PROFILE stop | PROFILE trace on|off|dump - End a profile; record or save trace spans""")
+def do_profile(conn, arg):
+    if conn.username not in admins:
+        conn.send(ERR_NOT_AUTHORIZED)
+    else:
+        conn.send(profile_command(arg.split()))
+
+@commands.command('BINARY', NO_ARGS, EITHER,
+                  help="BINARY - Switch to length-prefixed binary frames (see chat_binary.py)")
+def do_binary(conn, arg):
+    # Switch this connection to binary frames
+    if conn.codec is not None:
+        conn.send(b"ERR already-binary\n")
+    else:
+        conn.send(b"OK binary\n")
+        conn.codec = BinaryCodec()
+
+@commands.command('COMPRESS', NO_ARGS, EITHER,
+                  help="COMPRESS - Switch to zlib-compressed traffic in both directions")
+def do_compress(conn, arg):
+    # Deflate this connection's traffic both ways
+    if conn.inflater is not None:
+        conn.send(b"ERR already-compressed\n")
+    elif conn.codec is not None:
+        # Frames already buffered behind this one would be misread
+        conn.send(b"ERR compress-before-binary\n")
+    else:
+        conn.send(b"OK compress\n")
+        conn.outbox.enable_compression(zlib.compressobj(COMPRESS_LEVEL))
+        conn.inflater = zlib.decompressobj()
+
+@commands.command('PRESENCE', ARG_REQUIRED, EITHER,
+                  help="PRESENCE full|digest - Every join/leave line, or one summary line at a time")
+def do_presence(conn, arg):
+    # Digest (default) or every join/leave line
+    mode = arg.strip().lower()
+    if mode not in MODES:
+        conn.send(b"ERR invalid-format (use PRESENCE full|digest)\n")
+        return
+    conn.presence = FULL if mode == FULL else DIGEST
+    conn.send(OK)
+
+add_standard_commands(commands)
+commands.guard = throttled  # per-user rate limits (--rate-limit)
+
+def process_input(conn, chunk):
+    """Run everything a chunk of received bytes completes"""
+    bytes_received.value += len(chunk)
+    consume(conn, chunk)
+
+def consume(conn, chunk):
+    """Decompress chunk if the client sent COMPRESS, then process it"""
+    inflater = conn.inflater
+    if inflater is None:
+        process_data(conn, chunk)
+        return
+    try:
+        # Bounded steps, so a small compressed chunk cannot balloon in memory
+        data = inflater.decompress(chunk, INFLATE_CHUNK)
+        while True:
+            process_data(conn, data)
+            if not inflater.unconsumed_tail or conn.closed:
+                break
+            data = inflater.decompress(inflater.unconsumed_tail, INFLATE_CHUNK)
+    except zlib.error:
+        conn.send(b"ERR invalid-compression\n")
+        conn.hang_up()
+
+def hold(conn, data):
+    """Keep plain input for after the pending LOGIN"""
+    conn.held += data
+    if len(conn.held) > HELD_INPUT_LIMIT:
+        conn.held.clear()
+        conn.send(b"ERR too-much-input (wait for the LOGIN reply)\n")
+        conn.hang_up()
+
+def process_data(conn, chunk):
+    """Feed plain received bytes through the connection's framer and run
+    every complete command line (or binary frame)"""
+    if conn.held is not None:
+        hold(conn, chunk)
+        return
+    if conn.codec is not None:
+        process_frames(conn, chunk)
+        return
+    # Parse time is the span's self time; the commands nest inside it
+    with tracer.span('parse'):
+        lines = conn.framer.lines(chunk)
+        for line in lines:
+            if line is LINE_TOO_LONG:
+                conn.send(ERR_LINE_TOO_LONG)
+                continue
             try:
-                socket.send(b"INFO idle-timeout\n")
-                username = remove_client(socket)
-                if username:
-                    log(f"User {username} disconnected (idle timeout)", Colors.YELLOW)
-                    broadcast_message(f"INFO {username} disconnected\n")
-                socket.close()
-            except:
-                pass
+                data = line.decode('utf-8').strip()
+            except UnicodeDecodeError:
+                conn.send(ERR_INVALID_ENCODING)
+                continue
+            if data:
+                codec, inflater = conn.codec, conn.inflater
+                started = time.perf_counter()
+                with tracer.span('dispatch'):
+                    handle_command(conn, data)
+                command_latency.observe(time.perf_counter() - started)
+                if (conn.held is not None or conn.codec is not codec
+                        or conn.inflater is not inflater):
+                    break
+        else:
+            return
+        # Switched to binary or compressed input, or started holding it:
+        # closing the generator leaves every byte after the command in the
+        # buffer, and those belong to the new mode (or wait for the LOGIN)
+        lines.close()
+        tail = bytes(conn.framer.buffer)
+        conn.framer.buffer.clear()
+    if tail and conn.inflater is not inflater:
+        consume(conn, tail)  # still compressed
+    elif tail:
+        process_data(conn, tail)
+
+def process_frames(conn, chunk):
+    """Run every complete binary frame in chunk (see chat_binary)"""
+    def run(opcode, payload):
+        started = time.perf_counter()
+        with tracer.span('dispatch', opcode):
+            handle_frame(conn, opcode, payload)
+        command_latency.observe(time.perf_counter() - started)
+        return conn.held is not None  # a LOGIN frame holds the frames after it
+
+    framer = conn.codec.framer
+    with tracer.span('parse'):
+        complete = framer.feed(chunk, run)
+    if not complete:
+        conn.send(b"ERR frame-too-long\n")
+        conn.hang_up()
+    elif conn.held is not None and framer.buffer:
+        tail = bytes(framer.buffer)
+        framer.buffer.clear()
+        hold(conn, tail)
+
+def handle_frame(conn, opcode, payload):
+    """Execute one binary frame; payload is a memoryview valid only here.
+
+    MSG, DM and PING are handled on bytes directly. Anything else is
+    decoded and passed to handle_command.
+    """
+    if opcode == OP_TEXT or opcode == OP_LOGIN:
+        try:
+            data = str(payload, 'utf-8').strip()
+        except UnicodeDecodeError:
+            conn.send(ERR_INVALID_ENCODING)
+            return
+        if opcode == OP_LOGIN:
+            data = "LOGIN " + data
+        if data:
+            handle_command(conn, data)
+        return
+
+    username = conn.username
+    conn.last_activity = time.monotonic()
+    if not username:
+        conn.send(ERR_NOT_LOGGED_IN)
+
+    elif opcode == OP_MSG:
+        command_counts['MSG'].value += 1
+        if throttled(conn, 'MSG'):
+            return
+        text = bytes(payload)
+        if not is_valid_text(text):
+            conn.send(b"ERR invalid-format (use MSG <message>)\n")
+            return
+        line = b"MSG " + username.encode('utf-8') + b" " + text + b"\n"
+        post_message(conn, line, text)
+
+    elif opcode == OP_ROOM_MSG:
+        command_counts['MSG'].value += 1
+        if throttled(conn, 'MSG'):
+            return
+        end = 1 + payload[0] if payload else 0
+        text = bytes(payload[end:])
+        room = normalize_room(str(payload[1:end], 'utf-8', 'replace')) if end else None
+        if room is None or not is_valid_text(text):
+            conn.send(b"ERR invalid-format (use MSG #room <message>)\n")
+            return
+        line = f"MSG {room} {username} ".encode('utf-8') + text + b"\n"
+        post_room_message(conn, room, line, text)
+
+    elif opcode == OP_DM:
+        command_counts['DM'].value += 1
+        if throttled(conn, 'DM'):
+            return
+        target = None
+        if len(payload) > USER_ID.size:
+            uid = USER_ID.unpack_from(payload)[0]
+            start = USER_ID.size
+            if uid:
+                target = user_ids.name(uid)
+            else:
+                start += 1 + payload[start]
+                target = bytes(payload[USER_ID.size + 1:start])
+            text = bytes(payload[start:])
+        if target is None or not is_valid_text(text):
+            conn.send(ERR_DM_FORMAT)
+            return
+        line = b"DM " + username.encode('utf-8') + b" " + text + b"\n"
+        send_direct(conn, target.decode('utf-8', 'replace'), line, text)
+
+    elif opcode == OP_PING:
+        command_counts['PING'].value += 1
+        if throttled(conn, 'PING'):
+            return
+        conn.send(PONG)
+
+    else:
+        conn.send(b"ERR unknown-command\n")
+
+def wait_readable(sock, timeout):
+    """Block until sock is readable (data or EOF) or timeout seconds pass"""
+    if hasattr(select, 'poll'):
+        # poll() has no FD_SETSIZE limit, unlike select() on POSIX
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        return bool(poller.poll(timeout * 1000))
+    readable, _, _ = select.select([sock], [], [], timeout)
+    return bool(readable)
+
+def handle_client(client_socket, client_address, writer):
+    """Handle individual client connection (threaded engine)"""
+    conn = ThreadedConnection(client_socket, client_address, writer)
 
-def handle_client(client_socket, client_address):
-    """Handle individual client connection"""
-    username = None
-    
     try:
-        # Set timeout for socket operations
-        client_socket.settimeout(1.0)
-        
         # Send welcome message
-        client_socket.send(b"Welcome to AlgoKart Chat Server!\n")
-        client_socket.send(b"Please login with: LOGIN <username>\n")
-        
-        while True:
+        conn.send(WELCOME_BANNER)
+
+        while not (conn.evicted or conn.closed):
             try:
-                # Try to receive data
+                # Wait for data, waking up regularly so closed sockets are noticed
+                if not wait_readable(client_socket, 1.0):
+                    continue
                 try:
-                    data = client_socket.recv(BUFFER_SIZE).decode('utf-8').strip()
-                except socket.timeout:
+                    chunk = client_socket.recv(BUFFER_SIZE)
+                except (BlockingIOError, InterruptedError):
                     continue
-                
-                if not data:
+
+                if not chunk:
                     break
-                
-                # Update activity timestamp
-                with lock:
-                    user_activity[client_socket] = time.time()
-                
-                # Parse the command
-                parts = data.split(' ', 1)
-                command = parts[0].upper()
-                
-                # Handle LOGIN command
-                if command == "LOGIN" and len(parts) > 1 and not username:
-                    requested_username = parts[1].strip()
-                    
-                    # Validate username
-                    if len(requested_username) < 3:
-                        client_socket.send(b"ERR username-too-short (min 3 chars)\n")
-                    elif len(requested_username) > 20:
-                        client_socket.send(b"ERR username-too-long (max 20 chars)\n")
-                    elif not requested_username.replace('_', '').isalnum():
-                        client_socket.send(b"ERR username-invalid (alphanumeric and underscore only)\n")
-                    else:
-                        with lock:
-                            if requested_username in usernames:
-                                client_socket.send(b"ERR username-taken\n")
-                            else:
-                                username = requested_username
-                                clients[client_socket] = username
-                                usernames[username] = client_socket
-                                user_activity[client_socket] = time.time()
-                                client_socket.send(b"OK\n")
-                                log(f"User '{username}' logged in from {client_address[0]}", Colors.GREEN)
-                                
-                                # Notify others
-                                broadcast_message(f"INFO {username} joined the chat\n", client_socket)
-                
-                # Commands that require login
-                elif not username:
-                    client_socket.send(b"ERR not-logged-in (use LOGIN <username> first)\n")
-                
-                # Handle MSG command
-                elif command == "MSG" and len(parts) > 1:
-                    message = parts[1]
-                    broadcast_msg = f"MSG {username} {message}\n"
-                    broadcast_message(broadcast_msg, client_socket)
-                    log(f"{username}: {message}", Colors.BLUE)
-                
-                # Handle WHO command
-                elif command == "WHO":
-                    with lock:
-                        user_list = list(usernames.keys())
-                    
-                    client_socket.send(f"INFO {len(user_list)} users online\n".encode('utf-8'))
-                    for user in sorted(user_list):
-                        status = " (you)" if user == username else ""
-                        client_socket.send(f"USER {user}{status}\n".encode('utf-8'))
-                
-                # Handle DM command
-                elif command == "DM" and len(parts) > 1:
-                    dm_parts = parts[1].split(' ', 1)
-                    if len(dm_parts) >= 2:
-                        target_user = dm_parts[0]
-                        dm_message = dm_parts[1]
-                        
-                        if target_user == username:
-                            client_socket.send(b"ERR cannot-dm-self\n")
-                        else:
-                            with lock:
-                                if target_user in usernames:
-                                    target_socket = usernames[target_user]
-                                    target_socket.send(f"DM {username} {dm_message}\n".encode('utf-8'))
-                                    client_socket.send(b"OK\n")
-                                    log(f"DM: {username} -> {target_user}: {dm_message}", Colors.YELLOW)
-                                else:
-                                    client_socket.send(b"ERR user-not-found\n")
-                    else:
-                        client_socket.send(b"ERR invalid-format (use DM <username> <message>)\n")
-                
-                # Handle PING command
-                elif command == "PING":
-                    client_socket.send(b"PONG\n")
-                
-                # Handle HELP command
-                elif command == "HELP":
-                    help_text = """Available commands:
-LOGIN <username> - Login with a username
-MSG <message> - Send message to all users  
-WHO - List online users
-DM <username> <message> - Send private message
-PING - Check connection
-HELP - Show this help
-"""
-                    client_socket.send(help_text.encode('utf-8'))
-                
-                else:
-                    client_socket.send(b"ERR unknown-command (type HELP for commands)\n")
-                    
-            except UnicodeDecodeError:
-                client_socket.send(b"ERR invalid-encoding\n")
+
+                # Everything this chunk produces per recipient goes out in one write
+                with coalesced_writes():
+                    process_input(conn, chunk)
+                # A LOGIN waiting for another node holds back what followed it
+                while conn.held is not None and not (conn.evicted or conn.closed):
+                    conn.run_held()
+
             except Exception as e:
-                log(f"Error in client loop: {e}", Colors.RED)
+                log(f"Error in client loop: {e}", Colors.RED, ERROR)
                 break
-                
+
     except Exception as e:
-        log(f"Error handling client {client_address}: {e}", Colors.RED)
+        log(f"Error handling client {client_address}: {e}", Colors.RED, ERROR)
     finally:
         # Cleanup
-        if username:
-            removed_user = remove_client(client_socket)
-            if removed_user:
-                disconnect_msg = f"INFO {removed_user} disconnected\n"
-                broadcast_message(disconnect_msg)
-                log(f"User '{removed_user}' disconnected", Colors.YELLOW)
-        
-        client_socket.close()
+        disconnect_client(conn)
+
+def admit(client_socket, client_address):
+    """Apply --max-connections and --max-per-ip to a freshly accepted socket.
+
+    A refused socket is answered and closed here, before a thread or a
+    connection object is spent on it.
+    """
+    reply = admission.admit(client_address[0])
+    if reply is None:
+        return True
+    rejected_connections[reply].value += 1
+    reject(client_socket, reply)
+    log(f"Refused connection from {client_address[0]}: {reply.decode().strip()}",
+        Colors.YELLOW, WARNING, sample=True)
+    return False
+
+def run_threaded(server_socket):
+    """Serve clients with one thread per connection"""
+    # Start idle client checker thread
+    if idle_wheel is not None:
+        idle_checker = threading.Thread(target=check_idle_clients)
+        idle_checker.daemon = True
+        idle_checker.start()
+
+    if presence.window > 0:
+        threading.Thread(target=deliver_presence, name='presence', daemon=True).start()
+
+    # Backlogged outboxes are drained by a single writer thread
+    writer = OutboundWriter()
+    writer.start()
+
+    # Main server loop
+    while True:
+        client_socket, client_address = server_socket.accept()
+        if not admit(client_socket, client_address):
+            continue
+        connections_opened.value += 1
+        log(f"New connection from {client_address[0]}:{client_address[1]}", Colors.GREEN)
+
+        # Create a thread to handle this client
+        client_thread = threading.Thread(
+            target=handle_client,
+            args=(client_socket, client_address, writer)
+        )
+        client_thread.daemon = True
+        client_thread.start()
+
+
+class HandedOff(Exception):
+    """Raised out of the event loop once a new process owns every socket"""
+
+    def __init__(self, peer):
+        super().__init__("handed off")
+        self.peer = peer  # closing it tells the new process we are done
+
+
+def export_session(conn):
+    """What a new process needs to carry on serving conn (event loop only).
+
+    Compressed connections cannot be moved: the zlib streams have no
+    portable state.
+    """
+    framer = conn.framer if conn.codec is None else conn.codec.framer
+    return {
+        'address': list(conn.address),
+        'username': conn.username,
+        'rooms': list(rooms.rooms_of(conn)),
+        'idle': time.monotonic() - conn.last_activity,
+        'presence': conn.presence,
+        'binary': sorted(conn.codec.known_ids) if conn.codec is not None else None,
+        'input': encode_bytes(framer.buffer),
+        'discarding': conn.framer.discarding,
+        'output': encode_bytes(conn.outbox.unsent()),
+    }
+
+def restore_session(server, state, sock):
+    """LoopConnection continuing a session exported by the previous process.
+
+    Returns None if --max-connections or --max-per-ip turn it away. The
+    caller logs the user back in.
+    """
+    address = tuple(state['address'])
+    if not admit(sock, address):
+        return None
+    connections_opened.value += 1
+    sock.setblocking(False)
+    conn = LoopConnection(sock, address, server)
+    conn.last_activity -= state['idle']
+    conn.presence = FULL if state['presence'] == FULL else DIGEST
+    if state['binary'] is not None:
+        conn.codec = BinaryCodec()
+        conn.codec.known_ids.update(state['binary'])
+        conn.codec.framer.buffer += decode_bytes(state['input'])
+    else:
+        conn.framer.buffer += decode_bytes(state['input'])
+        conn.framer.discarding = state['discarding']
+    server.selector.register(sock, selectors.EVENT_READ, conn)
+    output = decode_bytes(state['output'])
+    if output:
+        # Already encoded for this client, so it bypasses send()
+        conn.outbox.push(output)
+        conn.dirty = True
+        server.dirty.append(conn)
+    return conn
+
+
+class EventLoopServer:
+    """Single-threaded engine multiplexing every client on one selector.
+
+    Idle connections cost a registered file descriptor and a small
+    LoopConnection, so tens of thousands of them fit on one core.
+    """
+
+    def __init__(self, server_socket, handoff_path=None):
+        self.server_socket = server_socket
+        self.handoff_path = handoff_path  # Unix socket a new process takes over through
+        self.handoff_socket = None
+        self.selector = selectors.DefaultSelector()
+        self.closing = []  # connections to disconnect once the current batch is done
+        self.dirty = []  # connections with output queued during the current batch
+        self.callbacks = collections.deque()  # work posted by other threads
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Run callback(*args) on the loop thread; safe from any thread"""
+        self.callbacks.append((callback, args))
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass  # a wakeup is already pending
+
+    def schedule_close(self, conn):
+        """Disconnect conn after the current round of events.
+
+        Sends can fail deep inside a broadcast, where tearing the
+        connection down (and broadcasting its departure) is not safe.
+        """
+        self.closing.append(conn)
+
+    def serve_forever(self):
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+        if self.handoff_path:
+            self._listen_for_handoff()
+        while True:
+            timeout = None
+            if idle_wheel is not None:
+                timeout = max(0.0, idle_wheel.next_tick() - time.monotonic())
+            if presence.deadline is not None:
+                wait = max(0.0, presence.deadline - time.monotonic())
+                timeout = wait if timeout is None else min(timeout, wait)
+            for key, mask in self.selector.select(timeout):
+                conn = key.data
+                if conn is None:
+                    if key.fileobj is self.server_socket:
+                        self._accept()
+                    elif key.fileobj is self.handoff_socket:
+                        self._hand_off()
+                    else:
+                        self._run_callbacks()
+                    continue
+                if mask & selectors.EVENT_WRITE and not conn.closed:
+                    conn.flush()
+                if mask & selectors.EVENT_READ and not conn.closed:
+                    self._read(conn)
+
+            if idle_wheel is not None and time.monotonic() >= idle_wheel.next_tick():
+                expire_idle_clients()
+            if presence.due():
+                flush_presence()
+
+            self._end_batch()
+
+    def adopt(self, sessions):
+        """Serve [(session, socket)] handed over by the previous process"""
+        restored = []
+        for state, sock in sessions:
+            conn = restore_session(self, state, sock)
+            if conn is not None:
+                restored.append((state, conn))
+        # One registry snapshot for all of them; nobody is told they joined
+        logged_in = [(state['username'], conn) for state, conn in restored if state['username']]
+        for _, conn in registry.add_all(logged_in):
+            self.schedule_close(conn)
+        for state, conn in restored:
+            if not state['username'] or conn in self.closing:
+                continue
+            conn.username = state['username']
+            conn.buckets = rate_limits.buckets()
+            if idle_wheel is not None:
+                idle_wheel.schedule(conn)
+            for room in state['rooms']:
+                rooms.join(room, conn)
+        log(f"Took over {len(restored)} connections ({len(logged_in)} logged in)", Colors.GREEN)
+
+    def _listen_for_handoff(self):
+        try:
+            self.handoff_socket = listen_for_handoff(self.handoff_path)
+        except OSError as e:
+            log(f"Handoff socket {self.handoff_path} failed: {e}", Colors.RED, ERROR)
+            return
+        self.handoff_socket.setblocking(False)
+        self.selector.register(self.handoff_socket, selectors.EVENT_READ, None)
+
+    def close_handoff(self):
+        """Stop listening for a new process and remove the socket file"""
+        if self.handoff_socket is None:
+            return
+        try:
+            self.selector.unregister(self.handoff_socket)
+        except (KeyError, ValueError):
+            pass
+        self.handoff_socket.close()
+        self.handoff_socket = None
+        try:
+            os.unlink(self.handoff_path)
+        except OSError:
+            pass
+
+    def _hand_off(self):
+        """Give the listening socket and every session to a new process.
+
+        Raises HandedOff once the new process has confirmed; if the
+        handoff fails, this process simply carries on serving.
+        """
+        try:
+            peer, _ = self.handoff_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        log("New process connected: handing over", Colors.BLUE)
+        # One taker only, and new connections wait in the listen queue for it
+        self.close_handoff()
+        self.selector.unregister(self.server_socket)
+
+        if mailbox is not None:
+            mailbox.close()
+            self._run_callbacks()  # acknowledgements of DMs just stored, backlogs opened
+        conns = [key.data for key in self.selector.get_map().values() if key.data is not None]
+        for conn in conns:
+            backlog = conn.take_backlog()
+            if backlog is not None:
+                # The rest of the backlog stays in the mailbox for the next login
+                mailbox.finish_now(backlog)
+            if conn.inflater is not None:
+                conn.send(b"INFO server-restart (reconnect)\n")
+                disconnect_client(conn, "compressed session, not handed over")
+        flush_presence()
+        self._end_batch()
+
+        state = {'user_ids': user_ids.export()}
+        if history is not None and history.backing is None:
+            state['history'] = [encode_bytes(line) for line in history.last(history.capacity)]
+        sessions = [(export_session(conn), conn.sock) for conn in conns if not conn.closed]
+        try:
+            hand_off(peer, self.server_socket, state, sessions)
+        except (OSError, ValueError) as e:
+            log(f"Handoff failed, still serving: {e}", Colors.RED, ERROR)
+            peer.close()
+            self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+            if mailbox is not None:
+                mailbox.start(self.call_soon_threadsafe)
+            self._listen_for_handoff()
+            return
+        log(f"Handed over {len(sessions)} connections", Colors.GREEN)
+        raise HandedOff(peer)
+
+    def _end_batch(self):
+        # Flush coalesced output, then tear down connections that failed;
+        # their departure notices may dirty more connections, hence the loop
+        while self.dirty or self.closing:
+            dirty, self.dirty = self.dirty, []
+            for conn in dirty:
+                conn.dirty = False
+                if not conn.closed:
+                    conn.flush()
+
+            closing, self.closing = self.closing, []
+            for conn in closing:
+                disconnect_client(conn)
+
+    def _run_callbacks(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self.callbacks:
+            callback, args = self.callbacks.popleft()
+            callback(*args)
+
+    def _accept(self):
+        # Drain the accept queue so connection storms don't wait a round trip each
+        while True:
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log(f"Accept failed: {e}", Colors.RED, ERROR)
+                return
+
+            if not admit(client_socket, client_address):
+                continue
+            connections_opened.value += 1
+            log(f"New connection from {client_address[0]}:{client_address[1]}", Colors.GREEN)
+            client_socket.setblocking(False)
+            conn = LoopConnection(client_socket, client_address, self)
+            self.selector.register(client_socket, selectors.EVENT_READ, conn)
+            conn.send(WELCOME_BANNER)
+
+    def _read(self, conn):
+        try:
+            chunk = conn.sock.recv(BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            chunk = b""
+
+        if not chunk:
+            disconnect_client(conn)
+            return
+
+        self.run_input(conn, process_input, chunk)
+
+    def run_input(self, conn, process, data):
+        """process(conn, data), disconnecting conn if that fails"""
+        try:
+            process(conn, data)
+        except Exception as e:
+            log(f"Error handling client {conn.address}: {e}", Colors.RED, ERROR)
+            disconnect_client(conn)
+
+
+def raise_fd_limit():
+    """Lift the soft open-file limit to the hard limit where the OS allows it"""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="AlgoKart Chat Server")
+    parser.add_argument('port', nargs='?', type=int, default=DEFAULT_PORT,
+                        help=f"TCP port to listen on (default {DEFAULT_PORT})")
+    parser.add_argument('--engine', choices=('eventloop', 'thread'), default='eventloop',
+                        help="eventloop: single-threaded selectors loop (default); "
+                             "thread: one thread per client")
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help="fork N worker processes sharing the port via SO_REUSEPORT "
+                             "(POSIX only, default 1)")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT, metavar='SECONDS',
+                        help=f"disconnect users idle this long, 0 to disable (default {IDLE_TIMEOUT})")
+    parser.add_argument('--idle-check-interval', type=float, default=IDLE_CHECK_INTERVAL,
+                        metavar='SECONDS',
+                        help="precision of idle expiry: timing wheel tick length "
+                             f"(default {IDLE_CHECK_INTERVAL})")
+    parser.add_argument('--outbox-limit', type=int, default=OUTBOX_HIGH_WATER, metavar='BYTES',
+                        help="per-client outbound queue high-water mark "
+                             f"(default {OUTBOX_HIGH_WATER})")
+    parser.add_argument('--slow-consumer', choices=POLICIES, default=SLOW_CONSUMER_POLICY,
+                        help="what to do when a client's queue passes the high-water mark: "
+                             "disconnect it with 'INFO slow-consumer' (default) or drop its "
+                             "oldest queued messages")
+    parser.add_argument('--history', type=int, default=HISTORY_CAPACITY, metavar='N',
+                        help="recent lobby messages kept in memory for HISTORY, 0 to disable "
+                             f"(default {HISTORY_CAPACITY})")
+    parser.add_argument('--history-dir', metavar='PATH',
+                        help="also append messages to a memory-mapped log in PATH, so "
+                             "history survives restarts")
+    parser.add_argument('--log-level', choices=LEVELS, default='info',
+                        help="lowest level written to the log (default info)")
+    parser.add_argument('--log-sample', type=int, default=1, metavar='N',
+                        help="log only one in N per-message events (MSG, DM); default 1 logs all")
+    parser.add_argument('--max-connections', type=int, default=0, metavar='N',
+                        help="refuse connections beyond N open at once with 'ERR server-full' "
+                             "(per worker; default 0, unlimited)")
+    parser.add_argument('--max-per-ip', type=int, default=0, metavar='N',
+                        help="refuse a client address's connections beyond N open at once "
+                             "(per worker; default 0, unlimited)")
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG, metavar='N',
+                        help=f"listen backlog for pending connections (default {LISTEN_BACKLOG})")
+    parser.add_argument('--rate-limit', default=DEFAULT_SPEC, metavar='SPEC',
+                        help="per-user command limits as command=rate/burst, rate in commands "
+                             "per second, e.g. msg=10/20,who=1/5, or 'off' (default off)")
+    parser.add_argument('--presence-window', type=float, default=PRESENCE_WINDOW, metavar='SECONDS',
+                        help="collect logins and logouts this long and announce them as one "
+                             f"digest line, 0 to announce each at once (default {PRESENCE_WINDOW})")
+    parser.add_argument('--mailbox-dir', metavar='PATH',
+                        help="keep DMs to offline users who have logged in before in PATH and "
+                             "deliver them at their next login (single process only)")
+    parser.add_argument('--federation', metavar='HOST:PORT',
+                        help="join a federation of server nodes: accept peer links on HOST:PORT, "
+                             "the address the other nodes list in their --peers")
+    parser.add_argument('--peers', default='', metavar='LIST',
+                        help="comma-separated HOST:PORT peer addresses of the other nodes")
+    parser.add_argument('--handoff-path', metavar='PATH',
+                        help="listen on Unix socket PATH for a new server process to take over "
+                             "the port and every client (event loop engine only)")
+    parser.add_argument('--takeover', metavar='PATH',
+                        help="instead of binding the port, take over the port and clients of "
+                             "the server whose --handoff-path is PATH")
+    parser.add_argument('--compress-level', type=int, default=COMPRESS_LEVEL, choices=range(1, 10),
+                        metavar='1-9', help=f"zlib level for COMPRESS clients (default {COMPRESS_LEVEL})")
+    parser.add_argument('--profile-dir', default='.', metavar='PATH',
+                        help="where PROFILE and SIGUSR1/SIGUSR2 write profiles and traces "
+                             "(default: current directory)")
+    parser.add_argument('--profile-mode', choices=PROFILE_MODES, default=PROFILE_MODE,
+                        help="sample: stack sampling of all threads, as folded stacks (default); "
+                             "cprofile: cProfile of the event loop, as a pstats file")
+    parser.add_argument('--profile-seconds', type=float, default=PROFILE_SECONDS, metavar='SECONDS',
+                        help=f"length of a run started by SIGUSR1 or a bare PROFILE start "
+                             f"(default {PROFILE_SECONDS})")
+    parser.add_argument('--trace', action='store_true',
+                        help="record parse/dispatch/lock wait/fan-out/send spans from the start "
+                             "(PROFILE trace on does so at runtime)")
+    parser.add_argument('--admin', default='', metavar='NAMES',
+                        help="comma-separated usernames allowed to run STATS")
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help="serve Prometheus-style text metrics over HTTP on PORT "
+                             "(worker N uses PORT + N)")
+    parser.add_argument('--metrics-host', default='127.0.0.1', metavar='ADDR',
+                        help="address for the metrics listener (default 127.0.0.1)")
+    args = parser.parse_args(argv)
+    try:
+        args.rate_limit = parse_limits(args.rate_limit)
+    except ValueError as e:
+        parser.error(f"--rate-limit: {e}")
+    if args.profile_mode == CPROFILE and args.engine != 'eventloop':
+        parser.error("--profile-mode cprofile needs the eventloop engine")
+    unknown = set(args.rate_limit) - set(COMMANDS)
+    if unknown:
+        parser.error(f"--rate-limit: unknown command {', '.join(sorted(unknown))}")
+    return args
+
+def start_metrics_listener(host, port):
+    """Expose metrics over HTTP; failure to bind is logged, not fatal"""
+    try:
+        serve_http(metrics, host, port)
+    except OSError as e:
+        log(f"Metrics listener failed on {host}:{port}: {e}", Colors.RED, ERROR)
+        return
+    log(f"Metrics at http://{host}:{port}/metrics", Colors.BLUE)
+
+def open_history(capacity, directory=None):
+    """Create the history ring, replaying the on-disk log when there is one"""
+    if capacity <= 0:
+        return None
+    backing = SegmentLog(directory) if directory else None
+    ring = HistoryRing(capacity, backing)
+    if backing is not None:
+        log(f"History log in {directory} ({len(ring)} messages replayed)", Colors.BLUE)
+    return ring
+
+def open_mailbox(directory):
+    """Create the offline DM store and export its counters"""
+    store = Mailbox(directory)
+    metrics.gauge('chat_mailbox_stored_messages', lambda: store.stored)
+    metrics.gauge('chat_mailbox_commits', lambda: store.commits)
+    log(f"Mailbox in {directory} ({len(store.known)} known users)", Colors.BLUE)
+    return store
+
+def create_server_socket(port, reuse_port=False):
+    """Bind and listen on port; reuse_port lets several workers share it"""
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        server_socket.bind(('', port))
+        server_socket.listen(LISTEN_BACKLOG)
+    except OSError:
+        server_socket.close()
+        raise
+    return server_socket
+
+def serve(server_socket, engine, handoff_path=None, sessions=None):
+    """Run the chosen engine on server_socket until interrupted.
+
+    The event loop also serves sessions taken over from a previous
+    process, and can hand everything to the next one via handoff_path.
+    """
+    loop = None
+    handed_off = None
+    try:
+        if engine == 'eventloop':
+            raise_fd_limit()
+            loop = EventLoopServer(server_socket, handoff_path)
+            if sessions:
+                loop.adopt(sessions)
+            profiler.post = loop.call_soon_threadsafe
+            install_profiling_signals()
+            if mailbox is not None:
+                mailbox.start(loop.call_soon_threadsafe)
+            if cluster is not None:
+                cluster.start(loop.call_soon_threadsafe, receive_broadcast, deliver_direct,
+                              receive_room, receive_presence)
+            loop.serve_forever()
+        else:
+            install_profiling_signals()
+            if mailbox is not None:
+                mailbox.start(call_now)
+            if cluster is not None:
+                cluster.start(call_now, receive_broadcast, deliver_direct, receive_room,
+                              receive_presence)
+            run_threaded(server_socket)
+
+    except HandedOff as e:
+        handed_off = e.peer
+    except KeyboardInterrupt:
+        log("\nShutting down server...", Colors.YELLOW)
+    except Exception as e:
+        log(f"Server error: {e}", Colors.RED, ERROR)
+    finally:
+        # Clean shutdown. After a handoff the clients belong to the new
+        # process: our copies of their sockets just close when we exit
+        if loop is not None:
+            loop.close_handoff()
+        if handed_off is None:
+            for conn in registry.snapshot.connections:
+                conn.send(b"INFO server-shutdown\n")
+                conn.close()
+                backlog = conn.take_backlog()
+                if backlog is not None:
+                    mailbox.finish(backlog)
+        if mailbox is not None:
+            mailbox.close()
+
+        server_socket.close()
+        if history is not None:
+            history.close()
+        if handed_off is not None:
+            handed_off.close()  # the new process may open history and mailbox now
+
+def call_now(callback, *args):
+    """The threaded engine's connections are thread-safe: run right away"""
+    callback(*args)
+
+def receive_broadcast(data):
+    """Deliver a broadcast published by another worker to local clients"""
+    broadcast_message(data, local_only=True)
+    if history is not None and data.startswith(b"MSG "):
+        history.append(data)
+
+def receive_room(room, data):
+    """Deliver a room message published by another worker to local members"""
+    broadcast_room(room, data, local_only=True)
 
 def main():
+    global OUTBOX_HIGH_WATER, SLOW_CONSUMER_POLICY, COMPRESS_LEVEL, LISTEN_BACKLOG
+    global idle_wheel, history, admins, rate_limits, admission, presence, mailbox, cluster
+    global profiler, PROFILE_MODE, PROFILE_SECONDS
+
+    args = parse_args()
+    LISTEN_BACKLOG = args.backlog
+    OUTBOX_HIGH_WATER = args.outbox_limit
+    SLOW_CONSUMER_POLICY = args.slow_consumer
+    COMPRESS_LEVEL = args.compress_level
+    if args.idle_timeout > 0:
+        idle_wheel = IdleWheel(args.idle_timeout, args.idle_check_interval)
+    logger.level = LEVELS[args.log_level]
+    logger.sample_every = max(1, args.log_sample)
+    admins = frozenset(name.strip() for name in args.admin.split(',') if name.strip())
+    rate_limits = RateLimits(args.rate_limit)
+    admission = ConnectionLimiter(args.max_connections, args.max_per_ip)
+    presence = PresenceAggregator(max(0.0, args.presence_window))
+    profiler = Profiler(args.profile_dir)
+    profiler.on_done = lambda path: log(f"Profile written to {path}", Colors.BLUE)
+    PROFILE_MODE = args.profile_mode
+    PROFILE_SECONDS = args.profile_seconds
+    tracer.enabled = args.trace
+
     # Clear screen for clean start
     os.system('cls' if os.name == 'nt' else 'clear')
-    
+
     # ASCII Art Banner
     print(Colors.HEADER + """
     ╔═══════════════════════════════════════╗
     ║     AlgoKart Chat Server v1.0         ║
     ╚═══════════════════════════════════════╝
     """ + Colors.RESET)
-    
-    # Get port from command line or use default
-    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
-    
-    # Create server socket
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    
-    try:
-        server_socket.bind(('', port))
-        server_socket.listen(10)
-        
-        log(f"Server started on port {port}", Colors.GREEN)
-        log("Waiting for connections...", Colors.BLUE)
-        log("Press Ctrl+C to stop the server\n", Colors.YELLOW)
-        
-        # Start idle client checker thread
-        idle_checker = threading.Thread(target=check_idle_clients)
-        idle_checker.daemon = True
-        idle_checker.start()
-        
-        # Main server loop
-        while True:
+    logger.start()
+
+    port = args.port
+
+    if args.handoff_path or args.takeover:
+        if not handoff_supported():
+            log("--handoff-path and --takeover need Unix sockets, which this platform lacks",
+                Colors.RED)
+            return
+        if args.engine != 'eventloop' or args.workers > 1 or args.federation:
+            log("--handoff-path and --takeover work with a single event loop process only",
+                Colors.RED)
+            return
+
+    if args.workers > 1:
+        if not workers_supported():
+            log("--workers needs fork() and SO_REUSEPORT, which this platform lacks", Colors.RED)
+            return
+        if args.mailbox_dir:
+            # A user's mailbox would be written by one worker and read by another
+            log("--mailbox-dir is not supported with --workers", Colors.RED)
+            return
+        if args.federation:
+            log("--federation is not supported with --workers", Colors.RED)
+            return
+
+        def run_worker(bus):
+            global cluster, history
+            cluster = bus
+            # Every worker sees every lobby message, so each keeps its own log
+            history_dir = args.history_dir and os.path.join(args.history_dir, f"worker-{bus.index}")
+            history = open_history(args.history, history_dir)
+            if args.metrics_port:
+                start_metrics_listener(args.metrics_host, args.metrics_port + bus.index)
             try:
-                client_socket, client_address = server_socket.accept()
-                log(f"New connection from {client_address[0]}:{client_address[1]}", Colors.GREEN)
-                
-                # Create a thread to handle this client
-                client_thread = threading.Thread(
-                    target=handle_client,
-                    args=(client_socket, client_address)
-                )
-                client_thread.daemon = True
-                client_thread.start()
-                
-            except KeyboardInterrupt:
-                log("\nShutting down server...", Colors.YELLOW)
-                break
-                
-    except Exception as e:
-        log(f"Error starting server: {e}", Colors.RED)
-    finally:
-        # Clean shutdown
-        with lock:
-            for client_socket in list(clients.keys()):
-                try:
-                    client_socket.send(b"INFO server-shutdown\n")
-                    client_socket.close()
-                except:
-                    pass
-        
-        server_socket.close()
+                serve(create_server_socket(port, reuse_port=True), args.engine)
+            finally:
+                logger.close()
+
+        log(f"Server started on port {port} ({args.workers} workers, {args.engine} engine)",
+            Colors.GREEN)
+        log("Press Ctrl+C to stop the server\n", Colors.YELLOW)
+        run_workers(args.workers, run_worker, lambda message: log(message, Colors.YELLOW))
         log("Server stopped", Colors.RED)
+        return
+
+    sessions = None
+    try:
+        if args.takeover:
+            server_socket, state, sessions = take_over(args.takeover)
+            port = server_socket.getsockname()[1]
+            user_ids.restore(state['user_ids'])
+            log(f"Took over port {port} and {len(sessions)} connections via {args.takeover}",
+                Colors.GREEN)
+        history = open_history(args.history, args.history_dir)
+        if sessions is not None and history is not None and history.backing is None:
+            for line in state.get('history', ()):
+                history.append(decode_bytes(line))
+        if args.mailbox_dir:
+            mailbox = open_mailbox(args.mailbox_dir)
+        if args.federation:
+            peers = [peer.strip() for peer in args.peers.split(',') if peer.strip()]
+            cluster = Federation(args.federation.strip(), peers)
+            log(f"Federation node {cluster.address} with peers {', '.join(peers) or '(none)'}",
+                Colors.BLUE)
+        if sessions is None:
+            server_socket = create_server_socket(port)
+    except Exception as e:
+        log(f"Error starting server: {e}", Colors.RED, ERROR)
+        return
+
+    log(f"Server started on port {port} ({args.engine} engine)", Colors.GREEN)
+    if args.metrics_port:
+        start_metrics_listener(args.metrics_host, args.metrics_port)
+    log("Waiting for connections...", Colors.BLUE)
+    log("Press Ctrl+C to stop the server\n", Colors.YELLOW)
+
+    serve(server_socket, args.engine, args.handoff_path, sessions)
+    log("Server stopped", Colors.RED)
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        logger.close()
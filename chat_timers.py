@@ -0,0 +1,79 @@
+"""Idle-connection expiry for the AlgoKart chat server.
+
+IdleWheel is a hashed timing wheel with lazy rescheduling. Recording
+activity is a plain attribute write on the connection (no lock, no data
+structure update); the wheel only looks at a connection when the slot
+holding its last known deadline comes due. At that point the connection
+either really is idle and is returned for eviction, or it was active in
+the meantime and is moved to the slot of its new deadline. Each tick
+touches only the connections filed under that slot, so there is no
+periodic scan of every client.
+"""
+
+import math
+import threading
+import time
+
+
+class IdleWheel:
+    """Timing wheel expiring connections idle for longer than timeout.
+
+    Tracked objects must expose `last_activity` (a time.monotonic()
+    timestamp) and `closed`. Expiry happens at most `resolution` seconds
+    late. schedule() and advance() may be called from different threads.
+    """
+
+    def __init__(self, timeout, resolution=1.0, now=None):
+        self.timeout = timeout
+        self.resolution = resolution
+        # One spare slot so a full timeout never wraps onto the cursor
+        self.size = int(math.ceil(timeout / resolution)) + 2
+        self.slots = [set() for _ in range(self.size)]
+        self.cursor = 0
+        self.cursor_time = time.monotonic() if now is None else now
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(map(len, self.slots))
+
+    def _slot_for(self, deadline):
+        ticks = math.ceil((deadline - self.cursor_time) / self.resolution)
+        ticks = min(max(ticks, 1), self.size - 1)
+        return (self.cursor + ticks) % self.size
+
+    def schedule(self, conn):
+        """Start tracking conn from its current last_activity"""
+        deadline = conn.last_activity + self.timeout
+        with self._lock:
+            self.slots[self._slot_for(deadline)].add(conn)
+
+    def next_tick(self):
+        """Monotonic time at which advance() has work to do next"""
+        return self.cursor_time + self.resolution
+
+    def advance(self, now=None):
+        """Move the wheel up to now; returns the connections that expired.
+
+        Closed connections are dropped silently, so disconnects need no
+        explicit cancellation.
+        """
+        if now is None:
+            now = time.monotonic()
+        expired = []
+        with self._lock:
+            while self.cursor_time + self.resolution <= now:
+                self.cursor = (self.cursor + 1) % self.size
+                self.cursor_time += self.resolution
+                due = self.slots[self.cursor]
+                if not due:
+                    continue
+                self.slots[self.cursor] = set()
+                for conn in due:
+                    if conn.closed:
+                        continue
+                    deadline = conn.last_activity + self.timeout
+                    if deadline <= self.cursor_time:
+                        expired.append(conn)
+                    else:
+                        self.slots[self._slot_for(deadline)].add(conn)
+        return expired
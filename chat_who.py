@@ -0,0 +1,96 @@
+"""WHO responses for the AlgoKart chat servers.
+
+The registry keeps its usernames sorted as logins and logouts happen, so
+WHO never sorts. WhoIndex turns that sorted list into one encoded block
+of "USER <name>" lines plus the offset of every line, and caches it until
+the membership changes. A WHO is then a single write of slices of that
+block:
+- the full list;
+- a page (WHO <offset> <limit>), cut at the line offsets;
+- a prefix match (WHO <prefix>*), located by bisecting the sorted names.
+
+The requester's own "(you)" marker is spliced in at its line's offset.
+"""
+
+import bisect
+import itertools
+
+WHO_MARKER = b" (you)"
+MAX_PAGE = 1000  # most users in one WHO <offset> <limit> reply
+
+
+class WhoListing:
+    """Immutable encoded user list: line i is body[starts[i]:starts[i + 1]]"""
+    __slots__ = ('names', 'body', 'starts')
+
+    def __init__(self, names):
+        self.names = names  # sorted tuple of str
+        lines = [b"USER " + name.encode('utf-8') + b"\n" for name in names]
+        self.body = b"".join(lines)
+        self.starts = (0,) + tuple(itertools.accumulate(map(len, lines)))
+
+    def __len__(self):
+        return len(self.names)
+
+    def lines(self, first, last, you=None):
+        """Encoded lines first..last-1, marking you's line if it is among them"""
+        body, starts = self.body, self.starts
+        if you is not None:
+            index = bisect.bisect_left(self.names, you)
+            if first <= index < last and self.names[index] == you:
+                end = starts[index + 1] - 1  # before the newline
+                return b"".join((body[starts[first]:end], WHO_MARKER, body[end:starts[last]]))
+        if first == 0 and last == len(self.names):
+            return body
+        return body[starts[first]:starts[last]]
+
+    def prefix_range(self, prefix):
+        """(first, last) line numbers of the names starting with prefix"""
+        first = bisect.bisect_left(self.names, prefix)
+        last = bisect.bisect_left(self.names, prefix + '\U0010ffff', first)
+        return first, last
+
+
+class WhoIndex:
+    """Cache of the WhoListing for the current set of users"""
+
+    def __init__(self):
+        self._cached = (None, None, WhoListing(()))
+
+    def listing(self, names, remote_names=None):
+        """WhoListing for the sorted tuple names plus an optional set of
+        names held elsewhere (other workers).
+
+        Rebuilt only when either argument is a different object from the
+        previous call: both are replaced, never mutated, on a change.
+        """
+        local, remote, listing = self._cached
+        if names is local and remote_names is remote:
+            return listing
+        merged = names
+        if remote_names:
+            merged = tuple(sorted(itertools.chain(names, remote_names)))
+        listing = WhoListing(merged)
+        self._cached = (names, remote_names, listing)
+        return listing
+
+
+def who_reply(listing, arg, you=None):
+    """Encoded reply to WHO [arg] for the global list, or None if arg is
+    not '', '<offset> <limit>' or '<prefix>*'"""
+    total = len(listing)
+    if not arg:
+        header = f"INFO {total} users online\n"
+        first, last = 0, total
+    elif arg.endswith('*'):
+        prefix = arg[:-1]
+        first, last = listing.prefix_range(prefix)
+        header = f"INFO {last - first} users matching {prefix}*\n"
+    else:
+        page = arg.split()
+        if len(page) != 2 or not page[0].isdigit() or not page[1].isdigit():
+            return None
+        first = min(int(page[0]), total)
+        last = min(first + min(int(page[1]), MAX_PAGE), total)
+        header = f"INFO {total} users online, showing {last - first} from {first}\n"
+    return header.encode('utf-8') + listing.lines(first, last, you)
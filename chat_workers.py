@@ -0,0 +1,348 @@
+"""Multi-process mode for the AlgoKart chat server.
+
+`--workers N` forks N worker processes that each accept on the same port
+through SO_REUSEPORT, so the kernel spreads connections across all cores.
+The parent process stays behind as a hub connected to every worker by two
+Unix socket pairs:
+
+* the bus carries asynchronous traffic. Broadcast lines fan out to every
+  other worker once, DMs go to the worker holding the target, and
+  join/leave events keep a replica of the global user list in each worker
+  so WHO and DM lookups stay local.
+* the rpc channel carries synchronous username claims, so uniqueness is
+  decided by the hub alone.
+
+Bus frames are single lines: "B <line>" (broadcast), "R <room> <line>"
+(room message), "D <user> <line>" (direct message), "J <user>" /
+"L <user>" (presence) and "M <room> <user>" / "P <room> <user>" (room
+membership). Claims are "C <user>" answered with "1" or "0".
+"""
+
+import os
+import selectors
+import signal
+import socket
+import sys
+import threading
+
+from chat_framing import LineFramer, LINE_TOO_LONG
+from chat_outbox import Outbox, DISCONNECT
+
+BUS_MAX_LINE = 1024 * 1024
+BUS_HIGH_WATER = 64 * 1024 * 1024  # a worker this far behind is considered dead
+RECV_SIZE = 65536
+
+
+class WorkerBus:
+    """Worker-side end of the hub connection.
+
+    Delivery callbacks run through `post`, the engine's thread-safe way of
+    scheduling work (the event loop's call_soon_threadsafe, or a direct
+    call for the threaded engine).
+    """
+
+    def __init__(self, index, bus_sock, rpc_sock):
+        self.index = index
+        self.bus_sock = bus_sock
+        self.rpc_sock = rpc_sock
+        self.remote_names = frozenset()  # users logged in on other workers
+        self.remote_rooms = {}  # {room: frozenset of remote members}, replaced on change
+        self._send_lock = threading.Lock()
+        self._rpc_lock = threading.Lock()
+        self._rpc_framer = LineFramer(BUS_MAX_LINE)
+        self._rpc_replies = []
+
+    def start(self, post, on_broadcast, on_direct, on_room, on_presence=None):
+        """Start the bus reader thread.
+
+        on_broadcast(line), on_direct(username, line) and on_room(room, line)
+        receive encoded wire lines (including the trailing newline) from
+        other workers. on_presence(username, joined) is told about users
+        logging in (joined True) or out on other workers.
+        """
+        self._post = post
+        self._on_broadcast = on_broadcast
+        self._on_direct = on_direct
+        self._on_room = on_room
+        self._on_presence = on_presence
+        reader = threading.Thread(target=self._read_bus, name='worker-bus', daemon=True)
+        reader.start()
+
+    # Outgoing traffic
+
+    def _send(self, frame):
+        with self._send_lock:
+            self.bus_sock.sendall(frame)
+
+    def publish(self, line, room=None):
+        """Deliver an encoded broadcast (or room) line to every other worker"""
+        if room is None:
+            self._send(b"B " + line)
+        else:
+            self._send(b"R " + room.encode('utf-8') + b" " + line)
+
+    def announce_join(self, room, username):
+        self._send(f"M {room} {username}\n".encode('utf-8'))
+
+    def announce_part(self, room, username):
+        self._send(f"P {room} {username}\n".encode('utf-8'))
+
+    def route_dm(self, username, line):
+        """Forward an encoded DM line to the worker holding username"""
+        self._send(b"D " + username.encode('utf-8') + b" " + line)
+
+    def release(self, username):
+        self._send(b"L " + username.encode('utf-8') + b"\n")
+
+    def claim(self, username, done):
+        """Reserve username cluster-wide and call done(granted) right away.
+
+        The hub is a local process that answers at once, so unlike
+        Federation.claim this asks it on the calling thread.
+        """
+        with self._rpc_lock:
+            self.rpc_sock.sendall(b"C " + username.encode('utf-8') + b"\n")
+            while not self._rpc_replies:
+                chunk = self.rpc_sock.recv(RECV_SIZE)
+                if not chunk:
+                    raise ConnectionError("worker hub went away")
+                self._rpc_replies.extend(self._rpc_framer.feed(chunk))
+            granted = self._rpc_replies.pop(0) == b"1"
+        done(granted)
+
+    # Incoming traffic
+
+    def _read_bus(self):
+        framer = LineFramer(BUS_MAX_LINE)
+        while True:
+            try:
+                chunk = self.bus_sock.recv(RECV_SIZE)
+            except OSError:
+                chunk = b""
+            if not chunk:
+                return  # hub is gone; the parent is shutting down
+            for frame in framer.feed(chunk):
+                if frame is not LINE_TOO_LONG:
+                    self._dispatch(frame)
+
+    def _dispatch(self, frame):
+        kind, _, rest = frame.partition(b" ")
+        if kind == b"B":
+            self._post(self._on_broadcast, rest + b"\n")
+        elif kind == b"R":
+            room, _, line = rest.partition(b" ")
+            self._post(self._on_room, room.decode('utf-8'), line + b"\n")
+        elif kind == b"D":
+            target, _, line = rest.partition(b" ")
+            self._post(self._on_direct, target.decode('utf-8'), line + b"\n")
+        elif kind == b"J":
+            username = rest.decode('utf-8')
+            self.remote_names = self.remote_names | {username}
+            if self._on_presence is not None:
+                self._post(self._on_presence, username, True)
+        elif kind == b"L":
+            username = rest.decode('utf-8')
+            self.remote_names = self.remote_names - {username}
+            if self._on_presence is not None:
+                self._post(self._on_presence, username, False)
+            if any(username in members for members in self.remote_rooms.values()):
+                self.remote_rooms = {room: members - {username}
+                                     for room, members in self.remote_rooms.items()
+                                     if members - {username}}
+        elif kind in (b"M", b"P"):
+            room, _, name = rest.decode('utf-8').partition(" ")
+            remote_rooms = dict(self.remote_rooms)
+            members = remote_rooms.get(room, frozenset())
+            members = members | {name} if kind == b"M" else members - {name}
+            if members:
+                remote_rooms[room] = members
+            else:
+                remote_rooms.pop(room, None)
+            self.remote_rooms = remote_rooms
+
+
+class WorkerHub:
+    """Parent-side relay between workers and owner of the global user list"""
+
+    def __init__(self, channels, log):
+        self.selector = selectors.DefaultSelector()
+        self.log = log
+        self.owners = {}  # {username: worker index}
+        self.buses = []
+        for index, (bus_sock, rpc_sock) in enumerate(channels):
+            bus_sock.setblocking(False)
+            rpc_sock.setblocking(False)
+            bus = _HubChannel(index, bus_sock)
+            rpc = _HubChannel(index, rpc_sock)
+            self.buses.append(bus)
+            self.selector.register(bus_sock, selectors.EVENT_READ, (self._on_bus, bus))
+            self.selector.register(rpc_sock, selectors.EVENT_READ, (self._on_rpc, rpc))
+
+    def serve_forever(self):
+        while any(not bus.closed for bus in self.buses):
+            for key, mask in self.selector.select():
+                handler, channel = key.data
+                if mask & selectors.EVENT_WRITE:
+                    self._flush(channel)
+                if mask & selectors.EVENT_READ and not channel.closed:
+                    self._read(handler, channel)
+
+    def _read(self, handler, channel):
+        try:
+            chunk = channel.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            chunk = b""
+        if not chunk:
+            self._close(channel)
+            return
+        for frame in channel.framer.feed(chunk):
+            if frame is not LINE_TOO_LONG:
+                handler(channel, frame)
+
+    def _on_rpc(self, channel, frame):
+        kind, _, name = frame.partition(b" ")
+        if kind != b"C":
+            return
+        username = name.decode('utf-8')
+        if username in self.owners:
+            self._send(channel, b"0\n")
+            return
+        self.owners[username] = channel.index
+        self._send(channel, b"1\n")
+        self._send_others(channel.index, b"J " + name + b"\n")
+
+    def _on_bus(self, channel, frame):
+        kind, _, rest = frame.partition(b" ")
+        if kind in (b"B", b"R", b"M", b"P"):
+            self._send_others(channel.index, frame + b"\n")
+        elif kind == b"D":
+            target = rest.partition(b" ")[0].decode('utf-8')
+            owner = self.owners.get(target)
+            if owner is not None and owner != channel.index:
+                self._send(self.buses[owner], frame + b"\n")
+        elif kind == b"L":
+            username = rest.decode('utf-8')
+            if self.owners.get(username) == channel.index:
+                del self.owners[username]
+                self._send_others(channel.index, frame + b"\n")
+
+    def _send_others(self, index, frame):
+        for bus in self.buses:
+            if bus.index != index and not bus.closed:
+                self._send(bus, frame)
+
+    def _send(self, channel, frame):
+        if channel.closed:
+            return
+        was_idle = not channel.outbox
+        if not channel.outbox.push(frame):
+            self.log(f"Worker {channel.index} stopped reading its bus, dropping it")
+            self._close(channel)
+            return
+        if was_idle:
+            self._flush(channel)
+
+    def _flush(self, channel):
+        try:
+            drained = channel.outbox.write_to(channel.sock)
+        except OSError:
+            self._close(channel)
+            return
+        events = selectors.EVENT_READ if drained else selectors.EVENT_READ | selectors.EVENT_WRITE
+        self.selector.modify(channel.sock, events, self.selector.get_key(channel.sock).data)
+
+    def _close(self, channel):
+        if channel.closed:
+            return
+        channel.closed = True
+        self.selector.unregister(channel.sock)
+        channel.sock.close()
+        # A dead worker's users are gone for everybody else too
+        gone = [name for name, owner in self.owners.items() if owner == channel.index]
+        for username in gone:
+            del self.owners[username]
+            self._send_others(channel.index, b"L " + username.encode('utf-8') + b"\n")
+
+
+class _HubChannel:
+    __slots__ = ('index', 'sock', 'framer', 'outbox', 'closed')
+
+    def __init__(self, index, sock):
+        self.index = index
+        self.sock = sock
+        self.framer = LineFramer(BUS_MAX_LINE)
+        self.outbox = Outbox(BUS_HIGH_WATER, DISCONNECT)
+        self.closed = False
+
+
+def _terminate(signum, frame):
+    # Let a worker run its normal shutdown path (INFO server-shutdown to clients)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+def supported():
+    """Whether this platform can run multiple workers on one port"""
+    return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')
+
+
+def run_workers(count, run_worker, log):
+    """Fork count workers and relay between them until they all exit.
+
+    run_worker(bus) runs in each child with its WorkerBus and must not
+    return until the worker is done serving.
+    """
+    channels = []
+    for _ in range(count):
+        bus_parent, bus_child = socket.socketpair()
+        rpc_parent, rpc_child = socket.socketpair()
+        channels.append(((bus_parent, rpc_parent), (bus_child, rpc_child)))
+
+    pids = []
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            signal.signal(signal.SIGTERM, _terminate)
+            try:
+                for other, (parent_ends, child_ends) in enumerate(channels):
+                    for sock in parent_ends:
+                        sock.close()
+                    if other != index:
+                        for sock in child_ends:
+                            sock.close()
+                bus_sock, rpc_sock = channels[index][1]
+                run_worker(WorkerBus(index, bus_sock, rpc_sock))
+            except KeyboardInterrupt:
+                pass
+            except Exception as e:
+                log(f"Worker {index} failed: {e}")
+                status = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(status)
+        pids.append(pid)
+        log(f"Worker {index} started (pid {pid})")
+
+    for _, child_ends in channels:
+        for sock in child_ends:
+            sock.close()
+
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        WorkerHub([parent_ends for parent_ends, _ in channels], log).serve_forever()
+    except KeyboardInterrupt:
+        pass  # the workers got the same SIGINT and shut down on their own
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
@@ -0,0 +1,31 @@
+"""Stand-ins for the server's sockets"""
+
+import socket
+
+import chat_server_enhanced as server
+
+
+class FakeConnection(server.ClientConnection):
+    """Connection over a socketpair; output() returns what the server sent it"""
+    __slots__ = ('hung_up', 'peer')
+
+    def __init__(self):
+        sock, self.peer = socket.socketpair()
+        super().__init__(sock, ('127.0.0.1', 12345))
+        self.hung_up = False
+
+    def send(self, data):
+        if self.codec is not None:
+            data = self.codec.encode(data)
+        self.outbox.push(data)
+
+    def hang_up(self):
+        self.hung_up = True
+
+    def output(self):
+        assert self.outbox.write_to(self.sock)
+        self.peer.setblocking(False)
+        try:
+            return self.peer.recv(65536)
+        except BlockingIOError:
+            return b""
@@ -0,0 +1,84 @@
+"""Binary frames: encoding server lines and parsing client frames"""
+
+from chat_binary import (HEADER, OP_MSG, OP_PING, OUT_DM, OUT_ERR, OUT_MSG, OUT_NAME,
+                         OUT_OK, OUT_PONG, OUT_ROOM_MSG, OUT_TEXT, USER_ID, BinaryCodec,
+                         BinaryFramer, frame, from_text, is_valid_text, user_ids)
+
+
+def frames(data):
+    """[(opcode, payload)] in an encoded reply"""
+    out = []
+    while data:
+        length, opcode = HEADER.unpack_from(data)
+        out.append((opcode, data[HEADER.size:HEADER.size + length]))
+        data = data[HEADER.size + length:]
+    return out
+
+
+def test_text_lines_become_frames():
+    uid = USER_ID.pack(user_ids.intern(b"alice"))
+    encoded, ids = from_text(b"OK\nPONG\nERR nope\nMSG alice hi there\n"
+                             b"MSG #dev alice yo\nDM alice psst\nINFO welcome\n")
+    assert frames(encoded) == [
+        (OUT_OK, b""),
+        (OUT_PONG, b""),
+        (OUT_ERR, b"nope"),
+        (OUT_MSG, uid + b"hi there"),
+        (OUT_ROOM_MSG, uid + b"\x04#dev" + b"yo"),
+        (OUT_DM, uid + b"psst"),
+        (OUT_TEXT, b"INFO welcome"),
+    ]
+    assert ids == (user_ids.intern(b"alice"),) * 3
+
+
+def test_other_msg_lines_pass_through_as_text():
+    encoded, ids = from_text(b"MSG <user> text: send to the lobby\n")
+    assert frames(encoded) == [(OUT_TEXT, b"MSG <user> text: send to the lobby")]
+    assert ids == ()
+
+
+def test_codec_names_each_sender_once():
+    codec = BinaryCodec()
+    uid = user_ids.intern(b"bob")
+    first = frames(codec.encode(b"MSG bob one\nMSG bob two\n"))
+    assert first == [(OUT_NAME, USER_ID.pack(uid) + b"bob"),
+                     (OUT_MSG, USER_ID.pack(uid) + b"one"),
+                     (OUT_MSG, USER_ID.pack(uid) + b"two")]
+    assert frames(codec.encode(b"MSG bob three\n")) == [(OUT_MSG, USER_ID.pack(uid) + b"three")]
+
+
+def test_framer_round_trip_across_segments():
+    data = frame(OP_MSG, b"hello") + frame(OP_PING)
+    framer = BinaryFramer()
+    got = []
+    handle = lambda opcode, payload: got.append((opcode, bytes(payload)))
+    assert framer.feed(data[:3], handle)
+    assert framer.feed(data[3:9], handle)
+    assert got == []
+    assert framer.feed(data[9:], handle)
+    assert got == [(OP_MSG, b"hello"), (OP_PING, b"")]
+    assert not framer.buffer
+
+
+def test_framer_stops_when_the_handler_asks():
+    framer = BinaryFramer()
+    rest = frame(OP_PING) + b"WHO\n"
+    got = []
+    assert framer.feed(frame(OP_MSG, b"stop") + rest,
+                       lambda opcode, payload: got.append(opcode) or True)
+    assert got == [OP_MSG]
+    assert bytes(framer.buffer) == rest
+
+
+def test_framer_rejects_oversized_frames():
+    framer = BinaryFramer(max_frame=4)
+    assert not framer.feed(frame(OP_MSG, b"too long"), lambda opcode, payload: None)
+
+
+def test_valid_text():
+    assert is_valid_text(b"hi")
+    assert is_valid_text("café".encode())
+    assert not is_valid_text(b"")
+    assert not is_valid_text(b"two\nlines")
+    assert not is_valid_text(b"carriage\rreturn")
+    assert not is_valid_text(b"\xff\xfe")
@@ -0,0 +1,41 @@
+"""Splitting the input stream into lines"""
+
+from chat_framing import LINE_TOO_LONG, LineFramer
+
+
+def test_lines_split_across_segments():
+    framer = LineFramer()
+    assert framer.feed(b"LOGIN al") == []
+    assert framer.pending() == 8
+    assert framer.feed(b"ice\r\nWHO\nPI") == [b"LOGIN alice", b"WHO"]
+    assert framer.feed(b"NG\n") == [b"PING"]
+    assert framer.pending() == 0
+
+
+def test_empty_lines_are_kept():
+    assert LineFramer().feed(b"\n\r\nWHO\n") == [b"", b"", b"WHO"]
+
+
+def test_overlong_line_is_reported_once_and_skipped():
+    framer = LineFramer(max_line_length=8)
+    assert framer.feed(b"0123456789") == []
+    assert framer.pending() == 0  # the oversized prefix is not kept
+    assert framer.feed(b"more") == []
+    assert framer.feed(b"tail\nWHO\n") == [LINE_TOO_LONG, b"WHO"]
+
+
+def test_overlong_line_within_one_segment():
+    framer = LineFramer(max_line_length=4)
+    assert framer.feed(b"PING\nTOOLONG\nWHO\n") == [b"PING", LINE_TOO_LONG, b"WHO"]
+
+
+def test_line_at_the_limit_is_accepted():
+    assert LineFramer(max_line_length=4).feed(b"PING\r\n") == [b"PING"]
+
+
+def test_closing_early_leaves_the_rest_as_received():
+    framer = LineFramer()
+    lines = framer.lines(b"BINARY\r\n\x00\x00\r\nWHO\npartial")
+    assert next(lines) == b"BINARY"
+    lines.close()
+    assert bytes(framer.buffer) == b"\x00\x00\r\nWHO\npartial"
@@ -0,0 +1,69 @@
+"""Offline DM storage and acknowledgements"""
+
+import os
+
+import pytest
+
+from chat_mailbox import Mailbox
+
+
+@pytest.fixture
+def mailbox(tmp_path):
+    posted = []
+    mailbox = Mailbox(str(tmp_path))
+    mailbox.posted = posted
+    mailbox.start(lambda callback, *args: posted.append((callback, args)))
+    yield mailbox
+    mailbox.close()
+
+
+def run_posted(mailbox):
+    mailbox.close()
+    for callback, args in mailbox.posted:
+        callback(*args)
+
+
+def test_acknowledged_once_stored(mailbox, tmp_path):
+    acks = []
+    mailbox.append('alice', b"DM bob hi\n", lambda stored: acks.append(('alice', stored)))
+    mailbox.append('alice', b"DM bob again\n", lambda stored: acks.append(('alice', stored)))
+    run_posted(mailbox)
+    assert acks == [('alice', True), ('alice', True)]
+    assert (tmp_path / 'alice.box').read_bytes() == b"DM bob hi\nDM bob again\n"
+    assert mailbox.stored == 2
+
+
+def test_failed_write_is_reported_to_its_senders_only(mailbox, tmp_path):
+    os.mkdir(tmp_path / 'carol.box')  # cannot be opened for appending
+    acks = []
+    mailbox.append('carol', b"DM bob lost\n", lambda stored: acks.append(('carol', stored)))
+    mailbox.append('alice', b"DM bob kept\n", lambda stored: acks.append(('alice', stored)))
+    run_posted(mailbox)
+    assert sorted(acks) == [('alice', True), ('carol', False)]
+    assert mailbox.stored == 1
+
+
+def test_backlog_sees_earlier_appends_and_finish_removes_them(mailbox):
+    opened = []
+    mailbox.register('alice')
+    mailbox.append('alice', b"DM bob one\n")
+    mailbox.append('alice', b"DM bob two\n")
+    mailbox.open_backlog('alice', opened.append)
+    run_posted(mailbox)
+    backlog, = opened
+    assert backlog.count == 2
+    assert backlog.read() == b"DM bob one\nDM bob two\n"
+    assert backlog.read() == b""
+    mailbox.finish_now(backlog)
+    assert not os.path.exists(backlog.path)
+    assert Mailbox(mailbox.directory).is_known('alice')
+
+
+def test_partly_delivered_backlog_keeps_the_rest(tmp_path):
+    mailbox = Mailbox(str(tmp_path))
+    (tmp_path / 'alice.box').write_bytes(b"DM bob one\n" + b"DM bob two\n" * 3000)
+    backlog = mailbox._open('alice')
+    first = backlog.read()
+    assert first.endswith(b"\n") and len(first) < backlog.size
+    mailbox.finish_now(backlog)
+    assert (tmp_path / 'alice.box').read_bytes() == b"DM bob two\n" * (3000 - first.count(b"\n") + 1)
@@ -0,0 +1,64 @@
+"""Switching a connection to BINARY or COMPRESS mid-stream"""
+
+import zlib
+
+import pytest
+
+import chat_server_enhanced as server
+from chat_binary import HEADER, OP_LOGIN, OP_PING, OUT_OK, OUT_PONG, frame
+from fakes import FakeConnection
+
+
+@pytest.fixture
+def conn():
+    conn = FakeConnection()
+    yield conn
+    server.registry.remove(conn)
+    conn.sock.close()
+    conn.peer.close()
+
+
+def frames(data):
+    """[(opcode, payload)] in a server reply"""
+    out = []
+    while data:
+        length, opcode = HEADER.unpack_from(data)
+        out.append((opcode, data[HEADER.size:HEADER.size + length]))
+        data = data[HEADER.size + length:]
+    return out
+
+
+def test_binary_frames_in_the_same_segment(conn):
+    server.process_input(conn, b"BINARY\n" + frame(OP_LOGIN, b"alice") + frame(OP_PING))
+    assert conn.output().startswith(b"OK binary\n")
+    assert not conn.hung_up
+    assert conn.username == 'alice'
+
+
+def test_binary_frames_after_pipelined_lines(conn):
+    # Frames whose bytes contain "\r\n" must reach the binary framer intact
+    login = HEADER.pack(len(b"bob\r\n"), OP_LOGIN) + b"bob\r\n"
+    server.process_input(conn, b"PRESENCE full\nBINARY\n" + login + frame(OP_PING))
+    reply = conn.output()
+    assert reply.startswith(b"OK\nOK binary\n")
+    assert [opcode for opcode, _ in frames(reply[len(b"OK\nOK binary\n"):])] == \
+        [OUT_OK, OUT_PONG]
+    assert conn.username == 'bob'
+
+
+def test_binary_frames_split_across_segments(conn):
+    data = b"BINARY\n" + frame(OP_LOGIN, b"carol")
+    server.process_input(conn, data[:9])
+    server.process_input(conn, data[9:])
+    assert conn.username == 'carol'
+
+
+def test_compressed_input_in_the_same_segment(conn):
+    compressor = zlib.compressobj()
+    deflated = compressor.compress(b"LOGIN dave\nPING\n") + compressor.flush(zlib.Z_SYNC_FLUSH)
+    server.process_input(conn, b"COMPRESS\n" + deflated)
+    assert not conn.hung_up
+    assert conn.username == 'dave'
+    reply = conn.output()
+    assert reply.startswith(b"OK compress\n")
+    assert zlib.decompressobj().decompress(reply[len(b"OK compress\n"):]) == b"OK\nPONG\n"
@@ -0,0 +1,108 @@
+"""Outbound queues and the slow-consumer policies"""
+
+import socket
+import zlib
+
+import pytest
+
+from chat_outbox import DISCONNECT, DROP_OLDEST, SLOW_CONSUMER_NOTICE, Outbox
+
+
+@pytest.fixture
+def pair():
+    sock, peer = socket.socketpair()
+    sock.setblocking(False)
+    peer.setblocking(False)
+    yield sock, peer
+    sock.close()
+    peer.close()
+
+
+class PartialSocket:
+    """Accepts at most `room` bytes per send"""
+
+    def __init__(self, room):
+        self.room = room
+        self.data = b""
+
+    def send(self, data):
+        sent = bytes(data[:self.room])
+        self.data += sent
+        return len(sent)
+
+    def sendmsg(self, buffers):
+        return self.send(b"".join(buffers))
+
+
+def test_chunks_are_written_in_order(pair):
+    sock, peer = pair
+    outbox = Outbox()
+    for line in (b"one\n", b"two\n", b"three\n"):
+        assert outbox.push(line)
+    assert outbox.write_to(sock)
+    assert peer.recv(100) == b"one\ntwo\nthree\n"
+    assert outbox.queued == 0 and len(outbox) == 0
+    assert outbox.sent == 14
+
+
+def test_partial_write_resumes_where_it_stopped():
+    outbox = Outbox()
+    outbox.push(b"hello\n")
+    outbox.push(b"world\n")
+    sock = PartialSocket(4)
+    assert not outbox.write_to(sock)
+    assert outbox.unsent() == b"o\nworld\n"
+    sock.room = 100
+    assert outbox.write_to(sock)
+    assert sock.data == b"hello\nworld\n"
+
+
+def test_disconnect_policy_reports_overflow():
+    outbox = Outbox(high_water=10, policy=DISCONNECT)
+    assert outbox.push(b"0123456789")
+    assert not outbox.push(b"x")
+
+
+def test_drop_oldest_keeps_the_newest_messages():
+    outbox = Outbox(high_water=10, policy=DROP_OLDEST)
+    for line in (b"aaaa\n", b"bbbb\n", b"cccc\n"):
+        assert outbox.push(line)
+    assert outbox.unsent() == b"bbbb\ncccc\n"
+    assert outbox.dropped == 1
+    assert outbox.queued == 10
+
+
+def test_drop_oldest_never_cuts_a_partially_written_message():
+    outbox = Outbox(high_water=10, policy=DROP_OLDEST)
+    outbox.push(b"aaaa\n")
+    outbox.push(b"bbbb\n")
+    assert not outbox.write_to(PartialSocket(2))
+    outbox.push(b"cccc\n")
+    outbox.push(b"dddd\n")
+    assert outbox.unsent() == b"aa\ndddd\n"
+    assert outbox.dropped == 2
+
+
+def test_compressed_output_decodes_after_each_write(pair):
+    sock, peer = pair
+    outbox = Outbox()
+    outbox.enable_compression(zlib.compressobj())
+    inflater = zlib.decompressobj()
+    outbox.push(b"MSG alice hi\n")
+    outbox.push(b"MSG bob hello\n")
+    assert outbox.write_to(sock)
+    assert inflater.decompress(peer.recv(1000)) == b"MSG alice hi\nMSG bob hello\n"
+    outbox.push(b"PONG\n")
+    assert outbox.write_to(sock)
+    assert inflater.decompress(peer.recv(1000)) == b"PONG\n"
+    assert outbox.deflated_in == 32
+
+
+def test_eviction_notice_ends_a_cut_message_first():
+    outbox = Outbox()
+    outbox.push(b"hello\n")
+    assert outbox.eviction_notice() == SLOW_CONSUMER_NOTICE
+    outbox.push(b"hello\n")
+    outbox.write_to(PartialSocket(2))
+    assert outbox.eviction_notice() == b"\n" + SLOW_CONSUMER_NOTICE
+    assert outbox.queued == 0 and len(outbox) == 0
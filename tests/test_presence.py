@@ -0,0 +1,70 @@
+"""Presence digests"""
+
+import pytest
+
+import chat_server_enhanced as server
+from chat_presence import FULL, JOINED, LEFT, PresenceAggregator, digest_line
+from fakes import FakeConnection
+
+
+@pytest.fixture
+def users():
+    conns = {}
+
+    def login(name, presence=None):
+        conn = FakeConnection()
+        conn.username = name
+        if presence is not None:
+            conn.presence = presence
+        assert server.registry.add(name, conn)
+        conns[name] = conn
+        return conn
+
+    yield login
+    for conn in conns.values():
+        server.registry.remove(conn)
+        conn.sock.close()
+        conn.peer.close()
+
+
+@pytest.fixture
+def announce(monkeypatch):
+    monkeypatch.setattr(server, 'presence', PresenceAggregator(10))
+
+    def announce(*events):
+        for username, event in events:
+            server.presence.record(username, event)
+        server.flush_presence()
+
+    return announce
+
+
+def test_digest_leaves_out_the_recipients_own_login(users, announce):
+    alice, bob, carol = users('alice'), users('bob'), users('carol')
+    announce(('alice', JOINED), ('bob', JOINED), ('dave', LEFT))
+    assert alice.output() == b"INFO 1 joined, 1 left\n"
+    assert bob.output() == b"INFO 1 joined, 1 left\n"
+    assert carol.output() == b"INFO 2 joined, 1 left\n"
+
+
+def test_two_events_leave_a_joiner_the_other_ones_line(users, announce):
+    alice, bob, carol = users('alice'), users('bob'), users('carol')
+    announce(('alice', JOINED), ('bob', JOINED))
+    assert alice.output() == b"INFO bob joined the chat\n"
+    assert bob.output() == b"INFO alice joined the chat\n"
+    assert carol.output() == b"INFO 2 joined, 0 left\n"
+
+
+def test_full_presence_lists_everyone_else(users, announce):
+    alice = users('alice', FULL)
+    announce(('alice', JOINED), ('bob', JOINED), ('dave', LEFT))
+    assert alice.output() == b"INFO bob joined the chat\nINFO dave disconnected\n"
+
+
+def test_join_and_leave_in_one_window_cancel_out():
+    presence = PresenceAggregator(10)
+    presence.record('alice', JOINED)
+    presence.record('alice', LEFT)
+    presence.record('bob', LEFT)
+    assert presence.take() == [('bob', LEFT)]
+    assert digest_line([('alice', JOINED)], 'alice') is None